@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+""" Measures how long m2mtool takes to start, so cold-start regressions are caught.
+
+Each entry point is imported in a fresh interpreter (several times, keeping the median), timing the import
+with -X importtime and listing the heavy dependencies it pulled in. The 'startup' entry point is what every
+run pays before it parses its arguments, and all that opening an existing deposition needs, so it must not
+import any of them.
+
+    python3 -m benchmarks.import_benchmark
+    python3 -m benchmarks.import_benchmark --runs 10 --max-startup-ms 50 """
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+# The modules imported by each entry point
+ENTRY_POINTS = {
+    'startup': 'm2mtool.m2mtool',
+    'headless': 'm2mtool.cli',
+    'batch': 'm2mtool.batch',
+    'gui': 'm2mtool.file_selector',
+}
+
+# Dependencies which are slow to import, and which the startup path must not import
+HEAVY_MODULES = ['PyQt5', 'requests', 'urllib3', 'dbus', 'aiohttp', 'multiprocessing', 'concurrent.futures.process']
+
+# A line of -X importtime output: self and cumulative microseconds, and the (indented) module name
+_IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$')
+
+
+def measure(module: str) -> dict:
+    """ Imports module in a fresh interpreter and returns its cumulative import time and the heavy modules
+    it imported. The time spent in site (which depends on the environment, not m2mtool) is left out. """
+
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(),
+                                                                           os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, universal_newlines=True, env=environment)
+    if result.returncode:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr}')
+
+    total_us, imported = 0, set()
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        imported.add(name)
+        # top level imports, made by the -c statement rather than by site
+        if indent == 1 and name != 'site':
+            total_us += cumulative
+    heavy = [name for name in HEAVY_MODULES if name in imported]
+    return {'ms': total_us / 1000, 'heavy_modules': heavy}
+
+
+def run(entry_points: List[str], runs: int) -> Dict[str, dict]:
+    results = {}
+    for name in entry_points:
+        measurements = [measure(ENTRY_POINTS[name]) for _ in range(runs)]
+        results[name] = {'module': ENTRY_POINTS[name],
+                         'median_ms': round(statistics.median(m['ms'] for m in measurements), 1),
+                         'min_ms': round(min(m['ms'] for m in measurements), 1),
+                         'heavy_modules': measurements[0]['heavy_modules']}
+    return results
+
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the m2mtool entry points.')
+    parser.add_argument('--entry-points', nargs='+', choices=sorted(ENTRY_POINTS), default=list(ENTRY_POINTS),
+                        help='The entry points to measure.')
+    parser.add_argument('--runs', type=int, default=5, help='The number of fresh interpreters per entry point.')
+    parser.add_argument('--max-startup-ms', type=float,
+                        help='Fail if the median startup import time is above this.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_arguments(argv)
+    results = run(args.entry_points, args.runs)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'entry point':<12} {'module':<24} {'median ms':>9} {'min ms':>7}  heavy modules")
+        for name, result in results.items():
+            print(f"{name:<12} {result['module']:<24} {result['median_ms']:>9} {result['min_ms']:>7}  "
+                  f"{', '.join(result['heavy_modules']) or '-'}")
+
+    failures = []
+    startup = results.get('startup')
+    if startup and startup['heavy_modules']:
+        failures.append(f"startup imports {', '.join(startup['heavy_modules'])}")
+    if startup and args.max_startup_ms is not None and startup['median_ms'] > args.max_startup_ms:
+        failures.append(f"startup takes {startup['median_ms']} ms (more than {args.max_startup_ms} ms)")
+    for failure in failures:
+        print(f'regression: {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
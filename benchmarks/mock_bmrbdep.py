@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+""" A local stand-in for the BMRBdep API, for benchmarks and tests.
+
+It implements the endpoints m2mtool uses (deposition creation, file upload and deletion, and the
+content addressed blob endpoints), and the NMRbox API ones it logs in and fetches the deposition metadata
+with. Uploads are read in blocks and discarded, keeping only the size and
+digest of each uploaded file, so the server's memory doesn't grow with the files and the benchmark can
+check what arrived. Latency, bandwidth limits and 5xx/429 faults can be injected, and request statistics
+(including the digest of every uploaded file, by name) are available from GET /_stats. """
+
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid
+from email.message import Message
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+# The size of the blocks request bodies are read in
+BLOCK_SIZE = 64 * 1024
+
+# The deposition metadata the NMRbox API endpoint answers with
+METADATA = b"data_mock\nsave_contact\n_Contact_person.Email_address mock@example.com\nsave_\n"
+
+
+class MockOptions:
+    """ The behaviour of the mock server. """
+
+    def __init__(self, latency: float = 0, bandwidth: float = 0, error_rate: float = 0, throttle_rate: float = 0,
+                 retry_after: int = 1, capacity: int = 0, blobs: bool = False, blob_status: int = 200,
+                 seed: Optional[int] = None, metadata_latency: float = 0, login_status: int = 200,
+                 auth_status: int = 401):
+        # seconds added before every response
+        self.latency: float = latency
+        # the maximum rate, in bytes per second, at which each request body is read (0 for unlimited); it applies
+        # to every request on its own, as a limit per connection, not to all of them together as a shared link
+        # would (the client's rate limit models that)
+        self.bandwidth: float = bandwidth
+        # the fraction of uploads answered with a 503, and with a 429 (with a Retry-After header)
+        self.error_rate: float = error_rate
+        self.throttle_rate: float = throttle_rate
+        self.retry_after: int = retry_after
+        # the number of uploads which may be in progress at once; any more are answered with a 429 (0 for no limit)
+        self.capacity: int = capacity
+        # whether the content addressed blob endpoints are supported, and the status the blob query answers with
+        self.blobs: bool = blobs
+        self.blob_status: int = blob_status
+        self.seed: Optional[int] = seed
+        # the seconds the NMRbox API takes to generate the deposition metadata, the status its login answers with
+        # (any other than 200 rejects the token), and the status it answers requests without a valid session with
+        self.metadata_latency: float = metadata_latency
+        self.login_status: int = login_status
+        self.auth_status: int = auth_status
+
+
+def parse_header(value: str):
+    """ Returns the value of a header such as Content-Type without its parameters, and the parameters. """
+
+    message = Message()
+    message['header'] = value
+    params = message.get_params(header='header') or [('', '')]
+    return params[0][0].lower(), dict(params[1:])
+
+
+class PartDigest:
+    """ Follows a multipart/form-data body as it is received, keeping the size and SHA-256 digest of every
+    file part (by its file name), without holding the body in memory. """
+
+    def __init__(self, boundary: str):
+        self.delimiter: bytes = b'\r\n--' + boundary.encode()
+        # the body starts with a delimiter without the line break
+        self.buffer: bytes = b'\r\n'
+        self.state: str = 'preamble'
+        self.file_name: Optional[str] = None
+        self.digest = None
+        self.size: int = 0
+        self.files: Dict[str, dict] = {}
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+        while True:
+            if self.state in ('preamble', 'body'):
+                end = self.buffer.find(self.delimiter)
+                if end < 0:
+                    # keep what could be the start of a delimiter
+                    keep = len(self.delimiter) - 1
+                    self.update(self.buffer[:-keep])
+                    self.buffer = self.buffer[-keep:]
+                    return
+                self.update(self.buffer[:end])
+                self.finish_part()
+                self.buffer = self.buffer[end + len(self.delimiter):]
+                self.state = 'delimiter'
+            elif self.state == 'delimiter':
+                if len(self.buffer) < 2:
+                    return
+                self.state = 'done' if self.buffer.startswith(b'--') else 'headers'
+                self.buffer = self.buffer[2:]
+            elif self.state == 'headers':
+                end = self.buffer.find(b'\r\n\r\n')
+                if end < 0:
+                    return
+                self.start_part(self.buffer[:end].decode('utf-8', 'replace'))
+                self.buffer = self.buffer[end + 4:]
+                self.state = 'body'
+            else:
+                self.buffer = b''
+                return
+
+    def start_part(self, headers: str) -> None:
+        for line in headers.split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-disposition':
+                self.file_name = parse_header(value)[1].get('filename')
+        if self.file_name is not None:
+            self.digest, self.size = hashlib.sha256(), 0
+
+    def update(self, data: bytes) -> None:
+        if self.state == 'body' and self.digest and data:
+            self.digest.update(data)
+            self.size += len(data)
+
+    def finish_part(self) -> None:
+        if self.state == 'body' and self.digest:
+            self.files[self.file_name] = {'bytes': self.size, 'sha256': self.digest.hexdigest()}
+        self.file_name, self.digest = None, None
+
+
+class MockBMRBDepServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options: MockOptions):
+        super().__init__(address, MockBMRBDepHandler)
+        self.options: MockOptions = options
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.blobs = set()
+        # the NMRbox API sessions logged in
+        self.sessions = set()
+        self.in_progress = 0
+        # the number of upload bodies being received
+        self.receiving = 0
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats = {'requests': 0, 'uploads': 0, 'upload_bytes': 0, 'deletes': 0, 'links': 0,
+                          'errors_injected': 0, 'throttles_injected': 0, 'over_capacity': 0, 'logins': 0,
+                          'metadata_requests': 0, 'most_concurrent_uploads': 0}
+            # the size and digest of every file received, by name
+            self.files: Dict[str, dict] = {}
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += amount
+
+
+class MockBMRBDepHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: MockBMRBDepServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self, keep: bool = True) -> bytes:
+        """ Reads the request body (plain or chunked) in blocks, throttled to the configured bandwidth.
+
+        A multipart body has the size and digest of its files recorded in self.received. The body is returned
+        if keep, and discarded as it is read otherwise (for uploads). """
+
+        self.received_bytes = 0
+        self.received: Dict[str, dict] = {}
+        self.read_start = time.monotonic()
+        content_type, parameters = parse_header(self.headers.get('Content-Type', ''))
+        parts = PartDigest(parameters['boundary']) if content_type == 'multipart/form-data' else None
+        kept: List[bytes] = []
+
+        def consume(size: int) -> None:
+            for block in self.throttled_read(size):
+                if parts:
+                    parts.feed(block)
+                if keep:
+                    kept.append(block)
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                consume(size)
+                self.rfile.readline()
+        else:
+            consume(int(self.headers.get('Content-Length', 0)))
+        if parts:
+            self.received = parts.files
+        return b''.join(kept)
+
+    def throttled_read(self, size: int):
+        """ Yields the next size bytes of the body in blocks, at most at the configured bandwidth. """
+
+        bandwidth = self.server.options.bandwidth
+        remaining = size
+        while remaining > 0:
+            block = self.rfile.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            self.received_bytes += len(block)
+            yield block
+            if bandwidth:
+                delay = self.received_bytes / bandwidth - (time.monotonic() - self.read_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def respond(self, status: int, body=None, headers: dict = None) -> None:
+        if self.server.options.latency:
+            time.sleep(self.server.options.latency)
+        # a body given as bytes is sent as text, anything else as JSON
+        if isinstance(body, bytes):
+            payload, content_type = body, 'text/plain'
+        else:
+            payload, content_type = json.dumps(body if body is not None else {}).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def inject_fault(self) -> bool:
+        """ Answers the request with a fault, if one is due. """
+
+        options, roll = self.server.options, self.server.random.random()
+        if roll < options.throttle_rate:
+            self.server.count('throttles_injected')
+            self.respond(429, {'error': 'Too many requests.'}, {'Retry-After': str(options.retry_after)})
+            return True
+        if roll < options.throttle_rate + options.error_rate:
+            self.server.count('errors_injected')
+            self.respond(503, {'error': 'Service unavailable.'})
+            return True
+        return False
+
+    def do_GET(self):
+        self.read_body()
+        self.server.count('requests')
+        path = urlsplit(self.path).path
+        if path == '/_stats':
+            with self.server.lock:
+                self.respond(200, dict(self.server.stats, files=self.server.files))
+        elif path == '/user/automatic-login':
+            self.login()
+        elif path == '/user/get-bmrbdep-metadata':
+            self.server.count('metadata_requests')
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            if 'sessionid' not in cookie or cookie['sessionid'].value not in self.server.sessions:
+                self.respond(self.server.options.auth_status, {'error': 'Not logged in.'})
+                return
+            time.sleep(self.server.options.metadata_latency)
+            self.respond(200, METADATA)
+        else:
+            self.respond(404, {'error': 'Not found.'})
+
+    def login(self) -> None:
+        """ Logs in to the NMRbox API, answering with the cookie of a new session. """
+
+        self.server.count('logins')
+        if self.server.options.login_status != 200:
+            self.respond(self.server.options.login_status, {'error': 'Invalid token.'})
+            return
+        session_id = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.sessions.add(session_id)
+        self.respond(200, {}, {'Set-Cookie': f'sessionid={session_id}; Path=/'})
+
+    def over_capacity(self) -> bool:
+        """ Answers the request with a 429 if more uploads than the capacity are in progress. """
+
+        capacity = self.server.options.capacity
+        if capacity and self.server.in_progress > capacity:
+            self.server.count('over_capacity')
+            self.respond(429, {'error': 'Too many requests.'}, {'Retry-After': str(self.server.options.retry_after)})
+            return True
+        return False
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.in_progress += 1
+        try:
+            self.handle_post()
+        finally:
+            with self.server.lock:
+                self.server.in_progress -= 1
+
+    def handle_post(self):
+        upload = re.fullmatch(r'/deposition/[^/]+/file', self.path) is not None
+        if upload:
+            # only while the body arrives, as the client may start its next upload once it has the response
+            with self.server.lock:
+                self.server.receiving += 1
+                self.server.stats['most_concurrent_uploads'] = max(self.server.stats['most_concurrent_uploads'],
+                                                                   self.server.receiving)
+        try:
+            body = self.read_body(keep=not upload)
+        finally:
+            if upload:
+                with self.server.lock:
+                    self.server.receiving -= 1
+        self.server.count('requests')
+
+        if self.path == '/_reset':
+            self.server.reset()
+            self.respond(200)
+        elif self.path == '/deposition/new':
+            self.respond(200, {'deposition_id': str(uuid.uuid4())})
+        elif upload:
+            if self.over_capacity() or self.inject_fault():
+                return
+            self.server.count('uploads')
+            self.server.count('upload_bytes', self.received_bytes)
+            with self.server.lock:
+                self.server.files.update(self.received)
+            self.respond(200, {'filename': 'uploaded'})
+        elif re.fullmatch(r'/deposition/[^/]+/blobs', self.path) and self.server.options.blobs:
+            if self.server.options.blob_status != 200:
+                self.respond(self.server.options.blob_status, {'error': 'Blob query failed.'})
+                return
+            digests = json.loads(body)['digests']
+            self.respond(200, {'present': [digest for digest in digests if digest in self.server.blobs]})
+        elif re.fullmatch(r'/deposition/[^/]+/blob/[^/]+', self.path) and self.server.options.blobs:
+            if self.inject_fault():
+                return
+            self.server.count('links')
+            self.respond(200)
+        else:
+            self.respond(404, {'error': 'Not found.'})
+
+    def do_DELETE(self):
+        self.read_body()
+        self.server.count('requests')
+        if re.fullmatch(r'/deposition/[^/]+/file/.+', self.path):
+            self.server.count('deletes')
+            self.respond(200)
+        else:
+            self.respond(404, {'error': 'Not found.'})
+
+
+def _serve(options: MockOptions, ready: multiprocessing.Queue) -> None:
+    server = MockBMRBDepServer(('127.0.0.1', 0), options)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+class MockServerProcess:
+    """ Runs the mock server in a separate process, so it doesn't affect the CPU and memory use measured in the
+    benchmarking process. Use as a context manager; `url` is the root URL of the server. """
+
+    def __init__(self, options: MockOptions = None):
+        self.options: MockOptions = options or MockOptions()
+        self.process: Optional[multiprocessing.Process] = None
+        self.url: Optional[str] = None
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_serve, args=(self.options, ready), daemon=True)
+        self.process.start()
+        self.url = f'http://127.0.0.1:{ready.get(timeout=30)}'
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the BMRBdep API.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added before every response.')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Bytes per second at which each request body is read (per request, not shared).')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of uploads answered with a 503.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of uploads answered with a 429.')
+    parser.add_argument('--capacity', type=int, default=0, help='The number of uploads accepted at once.')
+    parser.add_argument('--blobs', action='store_true', help='Support the content addressed blob endpoints.')
+    args = parser.parse_args()
+
+    mock_options = MockOptions(args.latency, args.bandwidth, args.error_rate, args.throttle_rate,
+                               capacity=args.capacity, blobs=args.blobs)
+    print(f'Serving on http://127.0.0.1:{args.port}')
+    MockBMRBDepServer(('127.0.0.1', args.port), mock_options).serve_forever()
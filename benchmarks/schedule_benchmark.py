@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+""" Compares the upload scheduling policies (m2mtool.schedule) against a local mock BMRBdep server.
+
+The generated deposition mixes a few large time-domain files with many small files, and has an NMR-STAR file
+and a peak list which are selected last (as when they sit in a folder which sorts after the spectra). Each
+policy deposits it in turn, and the benchmark reports the time the whole upload took (its makespan), and
+how long it was until the NMR-STAR file and peak list were uploaded, when the deposition becomes usable.
+
+By default the uploads share one link (the client's rate limit), as they do on a VM, which is where
+interleaving the small files with the large ones pays off; with --rate-limit unlimited --bandwidth 32M
+each connection is limited on its own instead, which favours starting every large file at once (lpt).
+
+    python3 -m benchmarks.schedule_benchmark
+    python3 -m benchmarks.schedule_benchmark --large-files 4 --large-size 200000000 --rate-limit 20M """
+
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import requests
+
+from benchmarks.mock_bmrbdep import MockOptions, MockServerProcess
+from benchmarks.upload_benchmark import STAR, BenchmarkListener
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.configuration import configuration
+from m2mtool.deposit import Deposition
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from m2mtool.ratelimit import parse_rate
+from m2mtool.schedule import SCHEDULERS
+
+# The files which make the deposition usable, selected after everything else
+CRITICAL_FILES = ['zz_analysis/assigned_shifts.str', 'zz_analysis/hsqc_peaks.list']
+
+
+def generate_deposition(directory: str, large_files: int, large_size: int, small_files: int,
+                        small_size: int) -> List[str]:
+    """ Writes the files of a synthetic deposition below directory, and returns their relative paths in the
+    order the file selector would collect them. """
+
+    files = [os.path.join(f'{number + 1}', 'ser') for number in range(large_files)]
+    files += [os.path.join('processed', f'spectrum{number:05d}.dat') for number in range(small_files)]
+    files += CRITICAL_FILES
+    block = os.urandom(1024 * 1024)
+    for file_name in files:
+        size = large_size if file_name.endswith('ser') else small_size
+        os.makedirs(os.path.join(directory, os.path.dirname(file_name)), exist_ok=True)
+        with open(os.path.join(directory, file_name), 'wb') as file:
+            # every file starts with its own name, so none is deduplicated
+            header = file_name.encode()[:size]
+            file.write(header)
+            remaining = size - len(header)
+            while remaining > 0:
+                remaining -= file.write(block[:remaining])
+    return files
+
+
+def run_policy(url: str, directory: str, files: List[str], policy: str) -> dict:
+    """ Deposits the files with the scheduling policy and returns the measurements. """
+
+    requests.post(f'{url}/_reset')
+    configuration['upload_schedule'] = policy
+    session_file = os.path.join(directory, SESSION_FILE_NAME)
+    listener = BenchmarkListener()
+
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='benchmark@example.com',
+                        nickname='benchmark') as bmrbdep_session:
+        manifest = UploadManifest(session_file, bmrbdep_session.sid, nickname='benchmark')
+        manifest.add_files(files)
+        deposition = Deposition(directory, 'benchmark', files, session_file, manifest, listener=listener)
+        start = time.monotonic()
+        deposition.upload_files(bmrbdep_session)
+        elapsed = time.monotonic() - start
+    os.unlink(session_file)
+
+    # when each file finished uploading, from the start of the upload
+    offset = start - deposition.telemetry.start
+    finished: Dict[str, float] = {entry['name']: entry['offset'] + entry['seconds'] - offset
+                                  for entry in deposition.telemetry.uploads if 'error' not in entry}
+    critical = [finished.get(file_name) for file_name in CRITICAL_FILES]
+    return {'policy': policy,
+            'files': len(files),
+            'uploaded': listener.uploaded,
+            'errors': listener.errors,
+            'seconds': round(elapsed, 3),
+            'critical_seconds': round(max(critical), 3) if None not in critical else None,
+            'mb_per_second': round(deposition.total_bytes / elapsed / 1024 ** 2, 2)}
+
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Compare the upload scheduling policies against a local mock '
+                                                 'BMRBdep server.')
+    parser.add_argument('--policies', nargs='+', choices=sorted(SCHEDULERS), default=list(SCHEDULERS),
+                        help='The scheduling policies to compare.')
+    parser.add_argument('--large-files', type=int, default=3, help='The number of large (ser) files.')
+    parser.add_argument('--large-size', type=int, default=96 * 1024 * 1024, help='The size of each large file.')
+    parser.add_argument('--small-files', type=int, default=400, help='The number of small files.')
+    parser.add_argument('--small-size', type=int, default=64 * 1024, help='The size of each small file.')
+    parser.add_argument('--concurrency', type=int, default=4, help='The (fixed) upload concurrency.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the server waits before every response.')
+    parser.add_argument('--bandwidth', type=parse_rate, default='unlimited', metavar='RATE',
+                        help='The rate at which the server reads each request body, such as 32M.')
+    parser.add_argument('--rate-limit', type=parse_rate, default='48M', metavar='RATE',
+                        help='The rate of all the uploads together, as a shared link limits it (unlimited for '
+                             'none).')
+    parser.add_argument('--directory', help='Generate the deposition here rather than in a temporary directory.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_arguments(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    options = MockOptions(latency=args.latency, bandwidth=args.bandwidth or 0, seed=0)
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory, MockServerProcess(options) as server:
+        configuration['bmrbdep_root_url'] = server.url
+        configuration['upload_rate_limit'] = args.rate_limit
+        configuration['upload_concurrency'] = args.concurrency
+        configuration['adaptive_concurrency'] = False
+        files = generate_deposition(directory, args.large_files, args.large_size, args.small_files,
+                                    args.small_size)
+        for policy in args.policies:
+            results.append(run_policy(server.url, directory, files, policy))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f'{args.large_files} files of {args.large_size} bytes, {args.small_files} of {args.small_size} bytes '
+              f'and {len(CRITICAL_FILES)} critical files, concurrency {args.concurrency}')
+        print(f"{'policy':<12} {'seconds':>8} {'critical s':>10} {'MB/s':>8}")
+        for result in results:
+            print(f"{result['policy']:<12} {result['seconds']:>8} {result['critical_seconds']!s:>10} "
+                  f"{result['mb_per_second']:>8}")
+            for error in result['errors']:
+                print(f'  error: {error}')
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
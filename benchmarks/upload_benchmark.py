@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+""" Measures upload throughput against a local mock BMRBdep server.
+
+Each run generates a synthetic directory tree, deposits it through Deposition (the same code the Qt
+Uploader and the headless mode run), and reports files/s, MB/s, the CPU time of this process per GB sent,
+its peak RSS and the number of faults the server injected (each of which the client has to retry). With
+--bodies zero-copy buffered, every level is measured with and without the zero-copy upload bodies. After
+each run, the digest of every file the server received is checked against the file, and a mismatch is
+reported as an error.
+
+    python3 -m benchmarks.upload_benchmark --scenario small --concurrency 1 4 8
+    python3 -m benchmarks.upload_benchmark --scenario large --latency 0.05 --error-rate 0.02
+    python3 -m benchmarks.upload_benchmark --scenario large --concurrency 2 --bodies zero-copy buffered """
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import List
+
+import requests
+
+from benchmarks.mock_bmrbdep import MockOptions, MockServerProcess
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.configuration import configuration
+from m2mtool.deposit import Deposition, UploadListener
+from m2mtool.hashing import file_digest
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from m2mtool.ratelimit import parse_rate
+
+# The metadata sent when the deposition is created; the mock server ignores it
+STAR = b"data_benchmark\nsave_contact\n_Contact_person.Email_address benchmark@example.com\nsave_\n"
+
+# The upload bodies which can be measured, and the zero_copy_uploads setting each needs
+BODIES = {'zero-copy': True, 'buffered': False}
+
+# (number of files, size of each file in bytes, files per directory)
+SCENARIOS = {
+    'small': (10000, 1024, 500),
+    'large': (2, 1024 ** 3, 1),
+}
+
+
+class BenchmarkListener(UploadListener):
+    """ Records the outcome of a benchmark run. """
+
+    def __init__(self):
+        self.uploaded: int = 0
+        self.errors: List[str] = []
+
+    def on_file_uploaded(self, uploaded_count: int) -> None:
+        self.uploaded = uploaded_count
+
+    def on_error(self, err: Exception, error_data: str) -> None:
+        self.errors.append(f'{error_data}: {err}')
+
+
+def generate_tree(directory: str, file_count: int, file_size: int, per_directory: int) -> List[str]:
+    """ Writes file_count files of file_size bytes below directory, and returns their relative paths.
+
+    Every file starts with its own name, so no two files have the same contents and none is deduplicated. """
+
+    files = []
+    block = os.urandom(min(file_size, 1024 * 1024))
+    for number in range(file_count):
+        file_name = os.path.join(f'dir{number // per_directory:04d}', f'file{number:06d}.dat')
+        os.makedirs(os.path.join(directory, os.path.dirname(file_name)), exist_ok=True)
+        with open(os.path.join(directory, file_name), 'wb') as file:
+            header = file_name.encode()[:file_size]
+            file.write(header)
+            remaining = file_size - len(header)
+            while remaining > 0:
+                written = file.write(block[:remaining])
+                remaining -= written
+        files.append(file_name)
+    return files
+
+
+def run_once(url: str, directory: str, files: List[str], concurrency: int, adaptive: bool = True,
+             body: str = 'zero-copy') -> dict:
+    """ Deposits the files once and returns the measurements. """
+
+    requests.post(f'{url}/_reset')
+    configuration['upload_concurrency'] = concurrency
+    configuration['adaptive_concurrency'] = adaptive
+    configuration['zero_copy_uploads'] = BODIES[body]
+    session_file = os.path.join(directory, SESSION_FILE_NAME)
+    listener = BenchmarkListener()
+
+    start, cpu_start = time.monotonic(), time.process_time()
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='benchmark@example.com',
+                        nickname='benchmark') as bmrbdep_session:
+        manifest = UploadManifest(session_file, bmrbdep_session.sid, nickname='benchmark')
+        manifest.add_files(files)
+        deposition = Deposition(directory, 'benchmark', files, session_file, manifest, listener=listener)
+        deposition.upload_files(bmrbdep_session)
+    elapsed, cpu_seconds = time.monotonic() - start, time.process_time() - cpu_start
+    os.unlink(session_file)
+
+    stats = requests.get(f'{url}/_stats').json()
+    # the files uploaded on their own (rather than bundled or linked) must have arrived intact
+    selected = set(files)
+    for file_name, received in stats['files'].items():
+        path = os.path.join(directory, file_name)
+        if file_name in selected and received['sha256'] != file_digest(path):
+            listener.errors.append(f"{file_name}: the server received {received['bytes']} bytes with another digest")
+    telemetry = deposition.telemetry.summary()
+    total_bytes = sum(os.path.getsize(os.path.join(directory, file)) for file in files)
+    return {'concurrency': concurrency,
+            'adaptive': adaptive,
+            'body': body,
+            'final_concurrency': (telemetry['concurrency'] or {}).get('final_limit', concurrency),
+            'files': len(files),
+            'uploaded': listener.uploaded,
+            'errors': listener.errors,
+            'seconds': round(elapsed, 3),
+            'hash_seconds': telemetry['phases'].get('hashing'),
+            'files_per_second': round(len(files) / elapsed, 1),
+            'mb_per_second': round(total_bytes / elapsed / 1024 ** 2, 2),
+            'cpu_seconds': round(cpu_seconds, 3),
+            'cpu_seconds_per_gb': round(cpu_seconds / total_bytes * 1024 ** 3, 2) if total_bytes else None,
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'retries': stats['errors_injected'] + stats['throttles_injected'] + stats['over_capacity'],
+            'client_retries': telemetry['retries'],
+            'latency_p50': telemetry['latency']['p50'],
+            'latency_p99': telemetry['latency']['p99'],
+            'requests': stats['requests']}
+
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark m2mtool uploads against a local mock BMRBdep server.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='small',
+                        help='small: 10k files of 1 KiB; large: 2 files of 1 GiB.')
+    parser.add_argument('--files', type=int, help='Override the number of files of the scenario.')
+    parser.add_argument('--size', type=int, help='Override the file size (in bytes) of the scenario.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4],
+                        help='The upload concurrency levels to measure.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the server waits before every response.')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='The bytes per second at which the server reads each request body (0 for unlimited).')
+    parser.add_argument('--error-rate', type=float, default=0, help='The fraction of uploads answered with a 503.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='The fraction of uploads answered with a 429.')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='Answer uploads with a 429 while more than this many are in progress (0 for no limit).')
+    parser.add_argument('--fixed', action='store_true',
+                        help='Keep the concurrency fixed rather than adapting it to the server.')
+    parser.add_argument('--rate-limit', type=parse_rate, metavar='RATE',
+                        help='Limit the upload bandwidth of the client, such as 500K or 2M bytes per second.')
+    parser.add_argument('--bodies', nargs='+', choices=list(BODIES), default=['zero-copy'],
+                        help='The upload bodies to measure: sent with sendfile() (zero-copy) or read through '
+                             'Python (buffered).')
+    parser.add_argument('--blobs', action='store_true', help='Have the server support the blob endpoints.')
+    parser.add_argument('--directory', help='Generate the tree here rather than in a temporary directory.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_arguments(argv)
+    file_count, file_size, per_directory = SCENARIOS[args.scenario]
+    file_count = args.files if args.files is not None else file_count
+    file_size = args.size if args.size is not None else file_size
+    logging.getLogger().setLevel(logging.WARNING)
+
+    options = MockOptions(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate, capacity=args.capacity, blobs=args.blobs, seed=0)
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory, MockServerProcess(options) as server:
+        configuration['bmrbdep_root_url'] = server.url
+        configuration['upload_rate_limit'] = args.rate_limit
+        files = generate_tree(directory, file_count, file_size, per_directory)
+        for concurrency in args.concurrency:
+            for body in args.bodies:
+                results.append(run_once(server.url, directory, files, concurrency, not args.fixed, body))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f'{args.scenario}: {file_count} files of {file_size} bytes')
+        print(f"{'concurrency':>11} {'final':>5} {'body':>9} {'files/s':>9} {'MB/s':>8} {'seconds':>8} "
+              f"{'CPU s/GB':>8} {'peak RSS MB':>11} {'retries':>7}")
+        for result in results:
+            print(f"{result['concurrency']:>11} {result['final_concurrency']:>5} {result['body']:>9} "
+                  f"{result['files_per_second']:>9} {result['mb_per_second']:>8} {result['seconds']:>8} "
+                  f"{result['cpu_seconds_per_gb']:>8} {result['peak_rss_mb']:>11} {result['retries']:>7}")
+            for error in result['errors']:
+                print(f'  error: {error}')
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
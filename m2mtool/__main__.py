@@ -1,3 +1,4 @@
 from m2mtool.m2mtool import run_m2mtool
 
-run_m2mtool()
+if __name__ == '__main__':
+    run_m2mtool()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import os
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import aiohttp
+except ImportError as err:
+    # aiohttp is only needed by this module, so it is an optional dependency
+    raise ImportError("The asyncio upload client needs aiohttp; install it with `pip install m2mtool[async]` "
+                      "or `pip install aiohttp`.") from err
+
+from m2mtool.configuration import configuration
+from m2mtool.multipart import MultipartFileEncoder
+
+# Set up logging
+logging.basicConfig()
+
+# Responses which are retried, as with the Retry policy of BMRBDepSession
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncBMRBDepSession:
+    """ An asyncio counterpart of BMRBDepSession.
+
+    All requests share one aiohttp connection pool, and at most `concurrency` of them are in flight at once,
+    so a single event loop can multiplex many uploads without a thread per connection. """
+
+    def __init__(self, nmrstar_file=None, user_email=None, nickname=None, sid=None, concurrency: int = None,
+                 retries: int = 3, backoff_factor: float = 1):
+        if not sid and (not nmrstar_file or not user_email or not nickname):
+            raise ValueError('Must provide either sid or nmrstar_file, user_email, and nickname.')
+        self.sid: Optional[str] = sid
+        self.nmrstar_file = nmrstar_file
+        self.user_email: Optional[str] = user_email
+        self.nickname: Optional[str] = nickname
+        if concurrency is None:
+            concurrency = configuration.get('upload_concurrency', 1)
+        self.concurrency: int = max(1, int(concurrency))
+        self.retries: int = retries
+        self.backoff_factor: float = backoff_factor
+
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self):
+        """ Start the session.
+
+        Creates the shared aiohttp ClientSession and, unless we already have a SID, a BMRBDep deposition. """
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        if not self.sid:
+            try:
+                await self.new()
+            except BaseException:
+                await self.session.close()
+                raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """ End the HTTP session. """
+        await self.session.close()
+
+    async def _request(self, method: str, url: str, body_factory: Callable[[], Tuple] = None) -> str:
+        """ Performs a request and returns the text of the response, raising ClientResponseError on failure.
+
+        Connection errors and RETRY_STATUSES are retried with exponential backoff, or after the delay the server
+        asks for in Retry-After. The request body and headers are rebuilt for every attempt by body_factory. """
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    # the body is only built (and any file opened) once the request may start
+                    data, headers = body_factory() if body_factory else (None, None)
+                    async with self.session.request(method, url, data=data, headers=headers) as response:
+                        text = await response.text()
+                        if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                            if response.status >= 400:
+                                logging.warning('Exception on server - server message: %s', text)
+                                raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                                  status=response.status, message=text,
+                                                                  headers=response.headers)
+                            return text
+                        status, retry_after = response.status, response.headers.get('Retry-After')
+            except aiohttp.ClientConnectionError:
+                if attempt >= self.retries:
+                    raise
+                status, retry_after = None, None
+
+            delay = self.backoff_factor * (2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logging.info("Retrying %s %s in %.1fs (status %s).", method, url, delay, status)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def new(self) -> str:
+        """ Creates a new deposition and returns its ID. """
+
+        logging.info("Creating session.")
+
+        def form() -> Tuple[aiohttp.FormData, None]:
+            if hasattr(self.nmrstar_file, 'seek'):
+                self.nmrstar_file.seek(0)
+            data = aiohttp.FormData()
+            data.add_field('email', self.user_email)
+            data.add_field('deposition_nickname', self.nickname)
+            data.add_field('nmrstar_file', self.nmrstar_file, filename='m2mtool_generated.str')
+            return data, None
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/new"
+        text = await self._request('POST', url, form)
+
+        # Find the session ID
+        self.sid = json.loads(text)['deposition_id']
+        logging.info("Session ID: %s" % self.sid)
+        return self.sid
+
+    async def delete_file(self, file_name: str) -> None:
+        """ Delete a file file from the session. """
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/file/{file_name}"
+        logging.info(f"Deleting file '{file_name}'.")
+        await self._request('DELETE', url)
+
+    async def upload_file(self, file_name: str, path: str, callback: Callable[[int], None] = None,
+                          category: str = None) -> Optional[str]:
+        """ Uploads a given file to the session, streaming it from disk, and returns the digest of its contents.
+
+        File reads happen on the default executor so they don't block the event loop. If a callback is provided
+        it is called with the number of bytes sent as the upload progresses. If a category (one of the
+        BMRBDepSession.file_types) is provided, it is sent along with the file. """
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/file"
+        encoders: List[MultipartFileEncoder] = []
+
+        async def stream(body: MultipartFileEncoder) -> AsyncIterator[bytes]:
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, body.read, body.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+        def body_factory() -> Tuple[AsyncIterator[bytes], dict]:
+            # a retried upload starts again from a fresh encoder; the previous one is closed first
+            if encoders:
+                encoders[-1].close()
+                if callback:
+                    callback(-encoders[-1].sent_file_bytes)
+            body = MultipartFileEncoder('file', file_name, os.path.join(path, file_name),
+                                        fields={'category': category} if category else None, callback=callback)
+            encoders.append(body)
+            return stream(body), {'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+
+        logging.info("Sending file '%s'.", file_name)
+
+        try:
+            await self._request('POST', url, body_factory)
+        finally:
+            if encoders:
+                encoders[-1].close()
+        return encoders[-1].hexdigest
+
+    async def upload_files(self, file_names: Iterable[str], path: str, callback: Callable[[int], None] = None,
+                           categories: Dict[str, str] = None) \
+            -> AsyncIterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        """ Uploads the files concurrently, yielding (file_name, digest, error) as each finishes. Files with an
+        entry in categories are sent with that upload category.
+
+        The files are taken from file_names as the session concurrency allows, by that many worker tasks, so it
+        may be a lazy iterable of any length: only the uploads in flight exist at any time. Closing the
+        iterator early cancels them. """
+
+        files, categories = iter(file_names), categories or {}
+        # the workers wait for the caller to take their results, rather than queuing them all
+        results: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+
+        async def worker() -> None:
+            for file_name in files:
+                try:
+                    digest = await self.upload_file(file_name, path, callback, categories.get(file_name))
+                except Exception as err:
+                    await results.put((file_name, None, err))
+                else:
+                    await results.put((file_name, digest, None))
+            # no files are left
+            await results.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is None:
+                    running -= 1
+                else:
+                    yield result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    @property
+    def session_url(self) -> str:
+        """ Returns the session URL."""
+        return f"{configuration['bmrbdep_root_url']}/entry/load/{self.sid}"
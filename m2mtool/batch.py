@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from m2mtool import tracing
+from m2mtool.cli import JsonProgress, run_headless
+from m2mtool.configuration import configuration
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from m2mtool.upload import limit_connections
+
+# Set up logging
+logging.basicConfig()
+
+
+class BatchProgress(JsonProgress):
+    """ Keeps the last report of each kind of progress event of one deposition of a batch, rather than
+    writing them out, so they can be summarized once it finishes. """
+
+    def __init__(self):
+        super().__init__()
+        self.events: Dict[str, dict] = {}
+
+    def emit(self, event: str, **fields) -> None:
+        with self.lock:
+            self.events[event] = fields
+
+
+def read_directory_list(list_file: str) -> List[Tuple[str, Optional[str]]]:
+    """ Returns the (directory, nickname) pairs listed in a batch file.
+
+    A .json file holds a list of directories, or of objects with a "path" and an optional "nickname". Any
+    other file lists one directory per line, optionally followed by a tab and the nickname; blank lines and
+    lines starting with '#' are ignored. Relative directories are relative to the batch file. """
+
+    base = os.path.dirname(os.path.abspath(list_file))
+    with open(list_file, 'r') as listing:
+        if list_file.endswith('.json'):
+            entries = [(entry, None) if isinstance(entry, str) else (entry['path'], entry.get('nickname'))
+                       for entry in json.load(listing)]
+        else:
+            entries = []
+            for line in listing:
+                line = line.rstrip('\n')
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                path, _, nickname = line.partition('\t')
+                entries.append((path.strip(), nickname.strip() or None))
+    return [(os.path.join(base, os.path.expanduser(path)), nickname) for path, nickname in entries]
+
+
+def _initialize_worker(settings: dict, connections, tracing_files: Tuple[Optional[str], Optional[str]]) -> None:
+    # runs in every worker process: applies the settings of the parent, the shared connection limit, and tracing
+    configuration.update(settings)
+    logging.getLogger().setLevel(logging.WARNING)
+    limit_connections(connections)
+    tracing.start_worker(*tracing_files)
+
+
+def deposit_directory(path: str, nickname: Optional[str], include: List[str] = None, exclude: List[str] = None,
+                      sync: bool = False) -> dict:
+    """ Deposits (or resumes, or syncs) one directory of a batch without the GUI, and returns its report. """
+
+    progress = BatchProgress()
+    start = time.monotonic()
+    try:
+        status = run_headless(path, nickname or os.path.basename(os.path.normpath(path)), include, exclude,
+                              sync=sync, progress=progress)
+    except Exception as err:
+        logging.exception("Deposition of '%s' failed.", path)
+        progress.on_error(err, '')
+        status = 1
+    seconds = time.monotonic() - start
+
+    report = {'path': path, 'status': 'failed' if status else 'deposited', 'sid': None, 'session_url': None,
+              'files': progress.file_count, 'bytes': 0, 'seconds': round(seconds, 3), 'mb_per_second': None,
+              'error': None}
+    session_file = os.path.join(path, SESSION_FILE_NAME)
+    if os.path.isfile(session_file):
+        manifest = UploadManifest.load(session_file)
+        report.update(sid=manifest.sid, session_url=manifest.session_url)
+    if 'existing_session' in progress.events:
+        report.update(status='up to date', files=0)
+    if 'upload_cancelled' in progress.events:
+        report['status'] = 'cancelled'
+    if 'bytes_uploaded' in progress.events:
+        report['bytes'] = progress.events['bytes_uploaded']['sent_bytes']
+        report['mb_per_second'] = round(report['bytes'] / seconds / 1024 ** 2, 2) if seconds else None
+    if 'error' in progress.events:
+        error = progress.events['error']
+        report['error'] = f"{error['file']}: {error['error']}" if error['file'] else error['error']
+    return report
+
+
+def run_batch(directories: List[Tuple[str, Optional[str]]], jobs: int = None, max_connections: int = None,
+              include: List[str] = None, exclude: List[str] = None, sync: bool = False,
+              stream: TextIO = None) -> int:
+    """ Deposits several directories at once, each in its own worker process, and returns the exit status.
+
+    At most jobs directories are deposited at a time, and their uploads share max_connections connections
+    (a semaphore shared by the worker processes). The hashing processes and any upload rate limit are split
+    between the jobs. The report of each directory is written to stream as a JSON object when it finishes,
+    followed by a summary of the batch. """
+
+    stream = stream or sys.stdout
+    jobs = max(1, min(jobs or configuration.get('batch_jobs') or 1, len(directories) or 1))
+    max_connections = max_connections or configuration.get('batch_max_connections')
+
+    settings = dict(configuration)
+    if not settings.get('hash_processes'):
+        settings['hash_processes'] = max(1, (os.cpu_count() or 1) // jobs)
+    if settings.get('upload_rate_limit'):
+        settings['upload_rate_limit'] /= jobs
+    connections = multiprocessing.BoundedSemaphore(max_connections) if max_connections else None
+
+    def emit(event: str, **fields) -> None:
+        stream.write(json.dumps({'event': event, **fields}) + '\n')
+        stream.flush()
+
+    start = time.monotonic()
+    reports: List[dict] = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_initialize_worker,
+                             initargs=(settings, connections, tracing.files())) as executor:
+        futures = {executor.submit(deposit_directory, path, nickname, include, exclude, sync): path
+                   for path, nickname in directories}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as err:
+                # the worker process itself failed
+                report = {'path': futures[future], 'status': 'failed', 'sid': None, 'session_url': None,
+                          'files': 0, 'bytes': 0, 'seconds': None, 'mb_per_second': None, 'error': str(err)}
+            reports.append(report)
+            emit('deposition_finished', **report)
+
+    seconds = time.monotonic() - start
+    total_bytes = sum(report['bytes'] for report in reports)
+    failed = [report['path'] for report in reports if report['status'] in ('failed', 'cancelled')]
+    emit('batch_finished', depositions=len(reports), failed=failed, bytes=total_bytes, seconds=round(seconds, 3),
+         mb_per_second=round(total_bytes / seconds / 1024 ** 2, 2) if seconds else None)
+    return 1 if failed else 0
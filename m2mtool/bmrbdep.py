@@ -5,7 +5,12 @@ import os
 
 import requests
 
+from m2mtool import tracing
+from m2mtool.bundle import tar_stream
 from m2mtool.configuration import configuration
+from m2mtool.hashing import DIGEST_ALGORITHM
+from m2mtool.multipart import MultipartFileEncoder, ZeroCopyFileEncoder, multipart_stream
+from m2mtool.zerocopy import ZeroCopyAdapter
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
@@ -20,6 +25,10 @@ class BMRBDepSession:
     session = None
     nmrstar_file = None
     user_email = None
+    # the number of times the last request was retried
+    last_retries = 0
+    # the responses which are retried
+    retry_statuses = [429, 500, 502, 503, 504]
 
     file_types = {
         "upload_category_1": "Assigned NMR chemical shifts",
@@ -64,7 +73,14 @@ class BMRBDepSession:
         "Image": "An image"
     }
 
-    def __init__(self, nmrstar_file=None, user_email=None, nickname=None, sid=None):
+    def __init__(self, nmrstar_file=None, user_email=None, nickname=None, sid=None, retry_statuses=None,
+                 rate_limiter=None, control=None):
+        if retry_statuses is not None:
+            self.retry_statuses = retry_statuses
+        # a TokenBucket shared by every session uploading for the deposition, which paces the uploaded bytes
+        self.rate_limiter = rate_limiter
+        # pauses or cancels the uploads of every session of the deposition between the chunks they send
+        self.control = control
         if sid:
             self.sid = sid
         else:
@@ -81,19 +97,28 @@ class BMRBDepSession:
         self.session = requests.Session()
 
         # Allow a retry
-        retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
-                        method_whitelist=["POST", "DELETE"])
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        # (urllib3 retries a 413, 429 or 503 with a Retry-After header whatever the status_forcelist says, so that
+        # is only allowed if those statuses are meant to be retried here; see UploadPool)
+        retries = Retry(total=3, backoff_factor=1, status_forcelist=self.retry_statuses,
+                        method_whitelist=["POST", "DELETE"],
+                        respect_retry_after_header=bool({429, 503} & set(self.retry_statuses)))
+        adapter = ZeroCopyAdapter if configuration.get('zero_copy_uploads') else HTTPAdapter
+        self.session.mount('https://', adapter(max_retries=retries))
+        self.session.mount('http://', adapter(max_retries=retries))
+        self.session.hooks['response'].append(self._count_retries)
+        if tracing.enabled():
+            self.session.hooks['response'].append(tracing.trace_response)
 
         # Don't create a new session if we already have a SID
         if self.sid:
-            return
+            return self
 
         logging.info("Creating session.")
-        r = self.session.post(f"{configuration['bmrbdep_root_url']}/deposition/new",
-                              data={'email': self.user_email,
-                                    'deposition_nickname': self.nickname},
-                              files={'nmrstar_file': ('m2mtool_generated.str', self.nmrstar_file)})
+        with tracing.span('create_session', 'bmrbdep'):
+            r = self.session.post(f"{configuration['bmrbdep_root_url']}/deposition/new",
+                                  data={'email': self.user_email,
+                                        'deposition_nickname': self.nickname},
+                                  files={'nmrstar_file': ('m2mtool_generated.str', self.nmrstar_file)})
         # If there was an error closing the session raise it
         r.raise_for_status()
 
@@ -109,26 +134,95 @@ class BMRBDepSession:
         # End the HTTP session
         self.session.close()
 
-    def delete_file(self, file_name):
-        """ Delete a file file from the session. """
+    def _count_retries(self, r, *args, **kwargs):
+        """ Records how many times urllib3 retried the request which produced the response. """
+        retries = getattr(r.raw, 'retries', None)
+        self.last_retries = len(retries.history) if retries else 0
+
+    def delete_file(self, file_name, missing_ok=False):
+        """ Delete a file file from the session. If missing_ok, a file which isn't in the session is ignored. """
 
         url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/file/{file_name}"
         logging.info(f"Deleting file '{file_name}'.")
         r = self.session.delete(url)
+        if missing_ok and r.status_code == 404:
+            return
         r.raise_for_status()
 
-    def upload_file(self, file_name, path):
-        """ Uploads a given file to the session. """
+    def upload_file(self, file_name, path, callback=None, category=None):
+        """ Uploads a given file to the session.
+
+        The file is streamed from disk rather than loaded into memory. If a callback is provided it is
+        called with the number of bytes sent as the upload progresses. If a category (one of file_types)
+        is provided, it is sent along with the file. Returns the digest of the uploaded file contents. """
 
         url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/file"
-        files = {'file': (file_name, open(os.path.join(path, file_name), 'rb'))}
 
         logging.info("Sending file '%s'.", file_name)
 
-        r = self.session.post(url, files=files)
+        fields = {'category': category} if category else None
+        encoder = ZeroCopyFileEncoder if configuration.get('zero_copy_uploads') else MultipartFileEncoder
+        with encoder('file', file_name, os.path.join(path, file_name), fields=fields,
+                     callback=callback, rate_limiter=self.rate_limiter, control=self.control) as body:
+            r = self.session.post(url, data=body, headers={'Content-Type': body.content_type})
+        if r.status_code != 200:
+            logging.warning('Exception on server - server message: %s', r.text)
+        r.raise_for_status()
+        return body.hexdigest
+
+    def upload_bundle(self, bundle_name, path, file_names, callback=None):
+        """ Uploads a group of files as a single gzip compressed tar archive, which is compressed as it is sent.
+
+        The archive members keep the file names relative to path. If a callback is provided it is called
+        with the size of each file as it is added to the archive. Returns the digests of the files' contents,
+        keyed by file name. """
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/file"
+
+        logging.info("Sending %d files in bundle '%s'.", len(file_names), bundle_name)
+
+        digests = {}
+        content_type, body = multipart_stream('file', bundle_name, tar_stream(path, file_names, callback, digests),
+                                              fields={'archive': 'tar.gz'})
+        if self.rate_limiter:
+            body = self.rate_limiter.limit(body, self.control)
+        if self.control:
+            body = self.control.checked(body)
+        r = self.session.post(url, data=body, headers={'Content-Type': content_type})
+        if r.status_code != 200:
+            logging.warning('Exception on server - server message: %s', r.text)
+        r.raise_for_status()
+        return digests
+
+    def find_blobs(self, digests):
+        """ Returns the subset of the given content digests which the server already holds.
+
+        Returns None if the server does not support content addressed uploads, in which case every file
+        has to be uploaded in full. As linking files is only an optimisation, any failure of the query is
+        taken to mean that it isn't supported, rather than failing the deposition. """
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/blobs"
+        try:
+            r = self.session.post(url, json={'algorithm': DIGEST_ALGORITHM, 'digests': sorted(digests)})
+            r.raise_for_status()
+            return set(r.json()['present'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as err:
+            logging.info("Server does not support content addressed uploads: %s", err)
+            return None
+
+    def link_file(self, file_name, digest, category=None):
+        """ Adds a file to the session using contents the server already holds, rather than uploading it. """
+
+        url = f"{configuration['bmrbdep_root_url']}/deposition/{self.sid}/blob/{digest}"
+        logging.info("Linking file '%s' to existing contents.", file_name)
+        data = {'filename': file_name}
+        if category:
+            data['category'] = category
+        r = self.session.post(url, data=data)
         if r.status_code != 200:
             logging.warning('Exception on server - server message: %s', r.text)
         r.raise_for_status()
+        return digest
 
     @property
     def session_url(self):
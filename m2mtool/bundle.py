@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import tarfile
+from array import array
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from m2mtool.hashing import new_digest
+
+BUNDLE_NAME = 'm2mtool_bundle_{:04d}.tar.gz'
+
+
+class _ChunkSink:
+    """ A write-only file object which collects what tarfile writes, so it can be handed on as chunks. """
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class _HashingReader:
+    """ A read-only file object which hashes the contents read through it. """
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = new_digest()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+
+def group_small_files(files: Sequence[int], sizes: Sequence[int], threshold: int, max_bundle_size: int) \
+        -> Tuple[Dict[str, array], array]:
+    """ Groups the files smaller than threshold bytes into bundles of at most max_bundle_size bytes
+    (uncompressed), keeping their order. The files are given by their positions in the selection, and sizes
+    holds the size of the file at each position.
+
+    Returns the positions of the files in each bundle, keyed by archive name, and those of the files that are
+    uploaded on their own. A threshold of zero disables bundling. """
+
+    bundles: Dict[str, array] = {}
+    if threshold <= 0:
+        return bundles, array('I', files)
+
+    single = array('I')
+    current = array('I')
+    current_size = 0
+    for position in files:
+        size = sizes[position]
+        if size >= threshold:
+            single.append(position)
+            continue
+        if current and current_size + size > max_bundle_size:
+            bundles[BUNDLE_NAME.format(len(bundles) + 1)] = current
+            current, current_size = array('I'), 0
+        current.append(position)
+        current_size += size
+    if current:
+        bundles[BUNDLE_NAME.format(len(bundles) + 1)] = current
+    return bundles, single
+
+
+def tar_stream(directory: str, files: Iterable[str], callback: Optional[Callable[[int], None]] = None,
+               digests: Optional[Dict[str, str]] = None) -> Iterator[bytes]:
+    """ Yields a gzip compressed tar archive of the files (relative to directory) as it is written.
+
+    Nothing is written to disk, and only about one file's worth of data is held in memory at once. The
+    members are named by their relative paths. If a callback is given, it is called with the size of each
+    file once it has been added. If digests is given, the digest of each file is recorded in it as the file
+    is added. """
+
+    sink = _ChunkSink()
+    with tarfile.open(fileobj=sink, mode='w|gz') as tar:
+        for file_name in files:
+            with open(os.path.join(directory, file_name), 'rb') as file:
+                info = tar.gettarinfo(arcname=file_name, fileobj=file)
+                reader = _HashingReader(file)
+                tar.addfile(info, reader)
+            if digests is not None:
+                digests[file_name] = reader.digest.hexdigest()
+            if callback:
+                callback(info.size)
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import getpass
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Optional
+
+from m2mtool.configuration import configuration
+
+# Set up logging
+logging.basicConfig()
+
+
+def cache_directory() -> str:
+    """ Returns the directory the cache is kept in: cache_directory from the configuration, or m2mtool in the
+    user's cache directory. """
+
+    directory = configuration.get('cache_directory')
+    if not directory:
+        directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'm2mtool')
+    return directory
+
+
+class DiskCache:
+    """ A small per-user cache of JSON values on disk, such as the NMRbox login session and the generated
+    deposition metadata.
+
+    Entries are keyed by a tuple of strings, which always includes the current user, and expire ttl seconds
+    after they were stored. Every named cache shares one directory, which is kept below max_size bytes by
+    evicting the least recently used entries. The directory and entries are only readable by the user, as
+    they may hold session cookies. A ttl of zero disables the cache. Errors reading or writing the cache are
+    logged and otherwise ignored: the cache only ever saves round trips. """
+
+    def __init__(self, name: str, ttl: float, directory: str = None, max_size: int = None):
+        self.name: str = name
+        self.ttl: float = ttl
+        self.directory: str = directory or cache_directory()
+        self.max_size: int = max_size if max_size is not None else configuration.get('cache_max_size', 0)
+
+    def _path(self, key: tuple) -> str:
+        key = json.dumps([getpass.getuser(), os.getuid(), *key])
+        return os.path.join(self.directory, f'{self.name}-{hashlib.sha256(key.encode()).hexdigest()}.json')
+
+    def get(self, *key: str) -> Optional[Any]:
+        """ Returns the value stored for the key, or None if there is none or it has expired. """
+
+        if self.ttl <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r') as cache_file:
+                entry = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (IOError, OSError, ValueError) as err:
+            logging.warning("Ignoring unreadable cache entry '%s': %s", path, err)
+            self.invalidate(*key)
+            return None
+
+        if time.time() - entry['stored'] > self.ttl:
+            self.invalidate(*key)
+            return None
+        try:
+            # mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['value']
+
+    def put(self, value: Any, *key: str) -> None:
+        """ Stores a value for the key, evicting old entries if the cache grows too large. """
+
+        if self.ttl <= 0:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            temp_file = f'{path}.tmp'
+            with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+                json.dump({'stored': time.time(), 'value': value}, cache_file)
+            os.replace(temp_file, path)
+        except (IOError, OSError, TypeError) as err:
+            logging.warning("Could not write cache entry '%s': %s", path, err)
+            return
+        self.evict()
+
+    def invalidate(self, *key: str) -> None:
+        """ Removes the entry for the key, if there is one. """
+
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.warning("Could not remove cache entry: %s", err)
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until the cache directory holds at most max_size bytes. """
+
+        if not self.max_size:
+            return
+        try:
+            with os.scandir(self.directory) as entries:
+                files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries
+                         if entry.is_file() and entry.name.endswith('.json')]
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
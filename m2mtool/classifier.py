@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+from m2mtool.bmrbdep import BMRBDepSession
+
+# The file type definitions: the extensions, file names and leading bytes of each MIME type, and the
+# BMRBdep upload category files of that type belong to
+EXTENSIONS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'extensions.json')
+
+
+class FileClassifier:
+    """ Pre-assigns BMRBdep upload categories (the keys of BMRBDepSession.file_types) to files.
+
+    A file is recognised by its name (Bruker 'fid' and 'ser' files have no extension), then by its extension,
+    both of which are single dictionary lookups. Only files which neither identifies have their first
+    header_size bytes read and compared with the known magic bytes. Files which can't be classified, or whose
+    type has no upload category, are left for the depositor to categorize. """
+
+    # The most that is read from a file to recognise it by its contents
+    header_size = 512
+    # The number of threads reading file headers
+    sniff_threads = 8
+
+    def __init__(self, definitions: dict):
+        categories = definitions.get('categories', {})
+        for mime_type, category in categories.items():
+            if category not in BMRBDepSession.file_types:
+                raise ValueError(f"Unknown upload category '{category}' for '{mime_type}'.")
+        self.categories: Dict[str, str] = categories
+
+        # the lookup tables, from the lower case name or extension to the MIME type
+        self.names: Dict[str, str] = {name.lower(): mime_type
+                                      for mime_type, names in definitions.get('file_names', {}).items()
+                                      for name in names}
+        self.extensions: Dict[str, str] = {extension.lower(): mime_type
+                                           for mime_type, extensions in definitions.get('extensions', {}).items()
+                                           for extension in extensions}
+        self.magic: List[Tuple[int, bytes, str]] = []
+        self.patterns: List[Tuple[Pattern, str]] = []
+        for mime_type, signatures in definitions.get('magic', {}).items():
+            for signature in signatures:
+                try:
+                    if 'hex' in signature:
+                        self.magic.append((signature.get('offset', 0), bytes.fromhex(signature['hex']), mime_type))
+                    else:
+                        self.patterns.append((re.compile(signature['text']), mime_type))
+                except (KeyError, TypeError, ValueError, re.error) as err:
+                    raise ValueError(f"Invalid signature {signature!r} for '{mime_type}': {err}") from err
+
+    @classmethod
+    def load(cls, path: str = EXTENSIONS_FILE) -> 'FileClassifier':
+        with open(path, 'r') as definitions:
+            return cls(json.load(definitions))
+
+    def known_type(self, file_name: str) -> Optional[str]:
+        """ Returns the MIME type of a file as given by its name or extension, or None if neither is known. """
+
+        base_name = file_name[file_name.rfind('/') + 1:].lower()
+        mime_type = self.names.get(base_name)
+        if mime_type is None:
+            # as with os.path.splitext, a leading dot doesn't start an extension
+            dot = base_name.rfind('.')
+            if dot > 0:
+                mime_type = self.extensions.get(base_name[dot:])
+        return mime_type
+
+    def sniff(self, path: str) -> Optional[str]:
+        """ Returns the MIME type of a file as given by its first bytes, or None if they are not recognised. """
+
+        try:
+            with open(path, 'rb') as file:
+                header = file.read(self.header_size)
+        except OSError:
+            return None
+
+        for offset, magic, mime_type in self.magic:
+            if header[offset:offset + len(magic)] == magic:
+                return mime_type
+        text = header.decode('latin-1')
+        for pattern, mime_type in self.patterns:
+            if pattern.search(text):
+                return mime_type
+        return None
+
+    def classify(self, directory: str, files: Iterable[str], sniff: bool = True) -> Dict[str, str]:
+        """ Returns the upload category of each of the files (relative to directory) which could be classified. """
+
+        categories: Dict[str, str] = {}
+        unknown: List[str] = []
+        known_type, type_categories = self.known_type, self.categories
+        for file_name in files:
+            mime_type = known_type(file_name)
+            if mime_type is None:
+                unknown.append(file_name)
+            elif mime_type in type_categories:
+                categories[file_name] = type_categories[mime_type]
+
+        if sniff and unknown:
+            # the headers are read in batches, so the threads aren't kept busy handing out single files
+            batch_size = max(1, min(256, len(unknown) // self.sniff_threads))
+            batches = [[os.path.join(directory, file_name) for file_name in unknown[start:start + batch_size]]
+                       for start in range(0, len(unknown), batch_size)]
+            with ThreadPoolExecutor(max_workers=self.sniff_threads, thread_name_prefix='m2mtool-sniff') as executor:
+                mime_types = (mime_type for batch in executor.map(self._sniff_batch, batches) for mime_type in batch)
+                for file_name, mime_type in zip(unknown, mime_types):
+                    if mime_type in self.categories:
+                        categories[file_name] = self.categories[mime_type]
+        return categories
+
+    def _sniff_batch(self, paths: List[str]) -> List[Optional[str]]:
+        return [self.sniff(path) for path in paths]
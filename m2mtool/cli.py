@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import sys
+import threading
+from fnmatch import fnmatch
+from typing import List, TextIO
+
+from m2mtool import tracing
+from m2mtool.control import cancel_on_interrupt
+from m2mtool.deposit import Deposition, UploadListener
+from m2mtool.file_index import FileIndex
+from m2mtool.manifest import SESSION_FILE_NAME, SESSION_FILES, UploadManifest
+from m2mtool.selection import FileSelection
+from m2mtool.telemetry import ThroughputMeter
+
+# Set up logging
+logging.basicConfig()
+
+
+class JsonProgress(UploadListener):
+    """ Reports the progress of a deposition as one JSON object per line. """
+
+    def __init__(self, stream: TextIO = None):
+        self.stream: TextIO = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.file_count: int = 0
+        self.failed: bool = False
+        self.throughput: ThroughputMeter = ThroughputMeter()
+
+    def emit(self, event: str, **fields) -> None:
+        # progress is reported from the upload workers as well as the main thread
+        with self.lock:
+            self.stream.write(json.dumps({'event': event, **fields}) + '\n')
+            self.stream.flush()
+
+    def on_start_upload(self) -> None:
+        self.emit('start_upload', files=self.file_count)
+
+    def on_file_uploaded(self, uploaded_count: int) -> None:
+        self.emit('file_uploaded', uploaded=uploaded_count, files=self.file_count)
+
+    def on_bytes_uploaded(self, sent_bytes: int, total_bytes: int) -> None:
+        rate = self.throughput.update(sent_bytes)
+        remaining = self.throughput.remaining(sent_bytes, total_bytes, rate)
+        self.emit('bytes_uploaded', sent_bytes=sent_bytes, total_bytes=total_bytes, bytes_per_second=round(rate),
+                  seconds_remaining=None if remaining is None else round(remaining))
+
+    def on_upload_finished(self, session_url: str) -> None:
+        self.emit('upload_finished', session_url=session_url)
+
+    def on_upload_cancelled(self) -> None:
+        self.emit('upload_cancelled')
+
+    def on_error(self, err: Exception, error_data: str) -> None:
+        self.failed = True
+        self.emit('error', error=str(err), file=error_data or None)
+
+
+def select_files(directory: str, include: List[str] = None, exclude: List[str] = None) -> FileSelection:
+    """ Returns the files in directory (recursively) which the user can upload, filtered by glob patterns.
+
+    Paths are relative to directory and use '/' as the separator. A file is selected if it matches any of the
+    include patterns (or there are none) and none of the exclude patterns. The session files m2mtool writes
+    itself are never selected. """
+
+    index = FileIndex(directory)
+    with tracing.span('check_prohibited', 'filesystem'):
+        prohibited = index.check_prohibited(index.root)
+    if prohibited:
+        logging.warning("Some files/folders in this directory cannot be uploaded (you do not have permission).")
+
+    selected = FileSelection()
+    with tracing.span('collect_selection', 'filesystem'):
+        for node in index.iter_files(index.root):
+            if node.path in SESSION_FILES:
+                continue
+            if include and not any(fnmatch(node.path, pattern) for pattern in include):
+                continue
+            if exclude and any(fnmatch(node.path, pattern) for pattern in exclude):
+                continue
+            selected.add(node.path, node.size, node.mtime)
+    return selected
+
+
+def run_headless(path: str, nickname: str = None, include: List[str] = None, exclude: List[str] = None,
+                 stream: TextIO = None, sync: bool = False, progress: JsonProgress = None) -> int:
+    """ Deposits (or resumes the deposition of) a directory without the GUI. Returns the exit status.
+
+    With sync, an existing deposition is brought up to date with the selected files: the new and changed
+    ones are uploaded, and the deposited files which were removed locally are deleted from it. Progress is
+    written to stream, unless another progress listener is given. Ctrl-C cancels the deposition cleanly, so
+    that running this again resumes it. """
+
+    progress = progress or JsonProgress(stream)
+    session_file = os.path.join(path, SESSION_FILE_NAME)
+
+    manifest = None
+    if os.path.isfile(session_file):
+        manifest = UploadManifest.load(session_file)
+        if sync:
+            files = manifest.sync(select_files(path, include, exclude))
+            manifest.save()
+        elif not manifest.complete:
+            logging.info("Resuming incomplete session...")
+            files = manifest.pending_files()
+        if manifest.complete:
+            progress.emit('existing_session', session_url=manifest.session_url)
+            return 0
+        nickname = manifest.nickname
+    else:
+        if not nickname:
+            progress.on_error(ValueError('A deposition nickname is required.'), '')
+            return 2
+        files = select_files(path, include, exclude)
+
+    progress.file_count = len(files)
+    deposition = Deposition(path, nickname, files, session_file, manifest, listener=progress)
+    with cancel_on_interrupt(deposition.control):
+        deposition.run()
+    if deposition.control.cancelled:
+        return 130
+    return 1 if progress.failed else 0
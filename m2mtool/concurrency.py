@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import email.utils
+import logging
+import threading
+import time
+from typing import Optional
+
+from m2mtool.control import UploadControl
+
+# Set up logging
+logging.basicConfig()
+
+# Responses which mean the server wants us to slow down
+THROTTLE_STATUSES = {429, 503}
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """ Returns the delay asked for by a Retry-After header (in seconds, or as an HTTP date), or None. """
+
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """ Limits the number of requests in flight, adjusting the limit to what the server can take with an
+    AIMD (additive increase, multiplicative decrease) policy.
+
+    Until the server first pushes back, every request that succeeds raises the limit by increase / limit, so
+    it grows by about `increase` per round of requests; after that, it is raised by `increase` at most every
+    increase_interval seconds, so it stays near what the server can take. A 429 or 503 response, or small
+    requests taking latency_tolerance times longer than the fastest seen recently, cut the limit by the
+    decrease factor, at most once per cooldown period. After a 429 or 503 no request is started until the
+    time the server asked for in Retry-After (or an exponential backoff if it didn't say) has passed. The
+    workers call acquire() before and release() after each request. """
+
+    # Requests up to this size (in bytes) are used to judge the server's latency; the latency of larger ones
+    # mostly depends on the bandwidth
+    latency_request_size = 1024 * 1024
+    # Latency within this many seconds of the baseline is never taken as a sign of congestion
+    latency_slack = 0.05
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, increase: float = 1, decrease: float = 0.5,
+                 latency_tolerance: float = 3, backoff_factor: float = 1, max_backoff: float = 60,
+                 cooldown: float = 1, increase_interval: float = 5):
+        self.minimum: int = max(1, minimum)
+        self.maximum: int = max(self.minimum, maximum)
+        self.limit: float = float(min(max(initial, self.minimum), self.maximum))
+        self.increase: float = increase
+        self.decrease: float = decrease
+        self.latency_tolerance: float = latency_tolerance
+        self.backoff_factor: float = backoff_factor
+        self.max_backoff: float = max_backoff
+        self.cooldown: float = cooldown
+        self.increase_interval: float = increase_interval
+
+        self.in_flight: int = 0
+        self.resume_at: float = 0
+        self.last_decrease: float = 0
+        self.last_increase: float = 0
+        self.consecutive_throttles: int = 0
+        # an exponentially weighted average of the latency of small requests, and a slowly rising minimum of it
+        self.latency: Optional[float] = None
+        self.base_latency: Optional[float] = None
+        self.decreases: int = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, control: Optional[UploadControl] = None) -> None:
+        """ Waits until another request may be started. If a control is given, the wait stops (raising
+        UploadCancelled) once the uploads are cancelled. """
+
+        with self._condition:
+            while True:
+                delay = self.resume_at - time.monotonic()
+                if delay > 0 or self.in_flight >= int(self.limit):
+                    timeout = delay if delay > 0 else None
+                    if control:
+                        control.wait(self._condition, timeout)
+                    else:
+                        self._condition.wait(timeout)
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, seconds: float, size: int = 0, status: Optional[int] = None,
+                retry_after: Optional[float] = None) -> None:
+        """ Records the outcome of a request started with acquire(): how long it took, how many bytes it sent,
+        and its HTTP status (None if no response was received). """
+
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                self.consecutive_throttles += 1
+                delay = retry_after
+                if delay is None:
+                    delay = min(self.max_backoff, self.backoff_factor * 2 ** (self.consecutive_throttles - 1))
+                self.resume_at = max(self.resume_at, now + delay)
+                self._decrease(now, f'status {status}, pausing for {delay:.1f}s')
+            elif status is not None and status < 400:
+                self.consecutive_throttles = 0
+                if size <= self.latency_request_size and self._latency_rising(seconds):
+                    self._decrease(now, f'latency {self.latency:.3f}s against {self.base_latency:.3f}s')
+                elif self.limit < self.maximum:
+                    self._increase(now)
+            self._condition.notify_all()
+
+    def _latency_rising(self, seconds: float) -> bool:
+        # updates the latency averages, and returns whether the latency is well above its baseline
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+        if self.base_latency is None or self.latency < self.base_latency:
+            self.base_latency = self.latency
+        else:
+            # let the baseline follow lasting changes, such as a move to a slower network
+            self.base_latency *= 1.001
+        return self.latency > max(self.latency_tolerance * self.base_latency, self.base_latency + self.latency_slack)
+
+    def _increase(self, now: float) -> None:
+        previous = self.limit
+        if not self.decreases:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+        elif now - max(self.last_increase, self.last_decrease) >= self.increase_interval:
+            self.limit = min(self.maximum, self.limit + self.increase)
+            self.last_increase = now
+        if int(self.limit) > int(previous):
+            logging.info("Raising the upload concurrency to %d.", self.limit)
+
+    def _decrease(self, now: float, reason: str) -> None:
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        previous, self.limit = self.limit, max(self.minimum, self.limit * self.decrease)
+        self.decreases += 1
+        logging.info("Reducing the upload concurrency from %d to %d (%s).", previous, self.limit, reason)
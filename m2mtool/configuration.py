@@ -2,7 +2,46 @@
 
 import os
 import json
+from collections.abc import MutableMapping
 
-# Load the configuration file
+# The configuration file
 _DIR = os.path.dirname(os.path.realpath(__file__))
-configuration = json.loads(open(os.path.join(_DIR, "config.json"), "r").read())
+CONFIG_FILE = os.path.join(_DIR, "config.json")
+
+
+class Configuration(MutableMapping):
+    """ The settings in config.json. The file is only read the first time a setting is used (or changed), so
+    importing a module doesn't pay for it. """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self._settings = None
+
+    @property
+    def settings(self) -> dict:
+        if self._settings is None:
+            with open(self.path, "r") as config_file:
+                self._settings = json.load(config_file)
+        return self._settings
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __setitem__(self, key, value):
+        self.settings[key] = value
+
+    def __delitem__(self, key):
+        del self.settings[key]
+
+    def __iter__(self):
+        return iter(self.settings)
+
+    def __len__(self):
+        return len(self.settings)
+
+    def __repr__(self):
+        return repr(self.settings)
+
+
+# The settings, read from the configuration file when first used
+configuration = Configuration(CONFIG_FILE)
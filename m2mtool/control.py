@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import logging
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Set up logging
+logging.basicConfig()
+
+
+class UploadCancelled(Exception):
+    """ Raised in the upload workers (and the thread running the deposition) once it was cancelled.
+
+    It is deliberately not an IOError, so neither urllib3 nor the deposition retry or report it as a
+    failed request. """
+
+
+class UploadControl:
+    """ Lets the uploads of a deposition be paused, resumed and cancelled from another thread, such as the GUI.
+
+    The upload workers call checkpoint() before each chunk they send: it returns at once while the uploads
+    run, blocks while they are paused, and raises UploadCancelled once they are cancelled. A transfer in
+    flight therefore stops within one chunk, unwinding through requests and urllib3 (which close its
+    connection and file) rather than the thread being killed. A paused transfer keeps its connection; if
+    the server drops it in the meantime, the request is retried from the start of the file on resume. """
+
+    # How often a wait elsewhere (for the rate limiter, or for the server to take requests again) checks whether
+    # the uploads were cancelled, in seconds
+    poll_interval = 0.1
+
+    def __init__(self):
+        self.paused: bool = False
+        self.cancelled: bool = False
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def pause(self) -> None:
+        with self._condition:
+            self.paused = True
+        logging.info("Upload paused.")
+
+    def resume(self) -> None:
+        with self._condition:
+            self.paused = False
+            self._condition.notify_all()
+        logging.info("Upload resumed.")
+
+    def cancel(self) -> None:
+        """ Cancels the uploads, waking any paused worker so it stops too. """
+
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify_all()
+        logging.info("Upload cancelled.")
+
+    def checkpoint(self) -> None:
+        """ Waits while the uploads are paused, and raises UploadCancelled if they were cancelled. """
+
+        if not self.paused and not self.cancelled:
+            return
+        start = time.monotonic()
+        with self._condition:
+            while self.paused and not self.cancelled:
+                self._condition.wait()
+        self._local.waited = self.waited() + time.monotonic() - start
+        if self.cancelled:
+            raise UploadCancelled('The upload was cancelled.')
+
+    def wait(self, condition: threading.Condition, timeout: Optional[float] = None) -> None:
+        """ Waits on condition (whose lock the caller holds) as condition.wait(timeout) does, but for at most
+        poll_interval seconds at a time, raising UploadCancelled once the uploads are cancelled. The caller
+        waits in a loop which checks what it is waiting for, as it must for condition.wait() anyway. """
+
+        if self.cancelled:
+            raise UploadCancelled('The upload was cancelled.')
+        condition.wait(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        if self.cancelled:
+            raise UploadCancelled('The upload was cancelled.')
+
+    def call(self, function: Callable[..., T], *args, **kwargs) -> T:
+        """ Returns function(*args, **kwargs), but raises UploadCancelled as soon as the uploads are cancelled
+        rather than once the function returns. It is for blocking calls which never reach a checkpoint(), such
+        as a request without a body waiting for its response; the function runs on a thread of its own, which
+        is left to finish (or time out) by itself if the call is cancelled. """
+
+        # concurrent.futures isn't otherwise imported by the time the GUI starts
+        from concurrent.futures import Future
+
+        self.checkpoint()
+        future: Future = Future()
+
+        def run() -> None:
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as err:
+                future.set_exception(err)
+            with self._condition:
+                self._condition.notify_all()
+
+        threading.Thread(target=run, name='m2mtool-call', daemon=True).start()
+        with self._condition:
+            while not future.done():
+                self.wait(self._condition)
+        return future.result()
+
+    def waited(self) -> float:
+        """ Returns how many seconds the calling thread has spent paused in checkpoint(). """
+        return getattr(self._local, 'waited', 0.0)
+
+    def checked(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """ Yields the chunks, calling checkpoint() before each one. """
+
+        for chunk in chunks:
+            self.checkpoint()
+            yield chunk
+
+
+@contextmanager
+def cancel_on_interrupt(control: UploadControl):
+    """ Within the block, the first SIGINT (Ctrl-C) cancels the uploads cooperatively rather than raising
+    KeyboardInterrupt wherever the main thread happens to be; a second one raises it as usual. Signals can
+    only be handled in the main thread, so elsewhere this does nothing. """
+
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def interrupt(signum, frame):
+        if control.cancelled:
+            raise KeyboardInterrupt
+        logging.warning("Cancelling the upload, press Ctrl-C again to exit at once.")
+        control.cancel()
+
+    previous = signal.signal(signal.SIGINT, interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
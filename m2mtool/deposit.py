@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import itertools
+import logging
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+from m2mtool import tracing
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.bundle import group_small_files
+from m2mtool.cache import DiskCache
+from m2mtool.classifier import FileClassifier
+from m2mtool.configuration import configuration
+from m2mtool.control import UploadCancelled, UploadControl
+from m2mtool.hashing import DigestFutures, hash_files_async
+from m2mtool.helpers import ApiSession
+from m2mtool.manifest import UploadManifest
+from m2mtool.metadata import DepositionMetadata
+from m2mtool.ratelimit import TokenBucket
+from m2mtool.schedule import get_scheduler
+from m2mtool.selection import UNKNOWN, FileSelection, SelectionView
+from m2mtool.telemetry import TELEMETRY_FILE_SUFFIX, Coalescer, UploadTelemetry
+from m2mtool.upload import UploadPool, deduplicate, max_concurrency
+
+# Set up logging
+logging.basicConfig()
+
+
+class UploadListener:
+    """ Receives the progress of a Deposition. The default implementation ignores everything. """
+
+    def on_start_upload(self) -> None:
+        """ Called when the preparatory steps are done and the files start to upload. """
+
+    def on_file_uploaded(self, uploaded_count: int) -> None:
+        """ Called as files are uploaded, with the number uploaded so far. """
+
+    def on_bytes_uploaded(self, sent_bytes: int, total_bytes: int) -> None:
+        """ Called periodically, from the upload workers, with the number of bytes sent so far. """
+
+    def on_upload_finished(self, session_url: str) -> None:
+        """ Called once every file was uploaded and the deposition was finalized. """
+
+    def on_upload_cancelled(self) -> None:
+        """ Called once the deposition stopped after being cancelled. What was uploaded is recorded in the
+        manifest, so running m2mtool again resumes it. """
+
+    def on_error(self, err: Exception, error_data: str) -> None:
+        """ Called if the deposition fails. error_data is "retrieve_metadata_error", the name of the
+        file that failed to upload, or an empty string. """
+
+
+class Deposition:
+    """ This class runs the processes that prepare for and complete the actual file upload.
+
+    It has no GUI dependency: the Qt Uploader and the headless command line mode both drive it, and
+    receive its progress through an UploadListener. """
+
+    def __init__(self, directory: str, nickname: str, files: Iterable[str], session_file: str,
+                 manifest: UploadManifest = None, listener: UploadListener = None):
+        self.directory: str = directory
+        self.nickname: str = nickname
+        # the selection is iterated rather than copied, as it may hold millions of files
+        self.files: FileSelection = FileSelection.from_paths(files)
+        self.session_file: str = session_file
+        self.manifest: UploadManifest = manifest
+        self.listener: UploadListener = listener or UploadListener()
+        # the digests and sizes of the files are worked out in the background, see prepare()
+        self.digests: DigestFutures = DigestFutures()
+        self.preparation: Optional[Future] = None
+        # the upload categories the files could be assigned to automatically
+        self.categories: Dict[str, str] = {}
+        self.error_occurred: bool = False
+        self.telemetry: UploadTelemetry = UploadTelemetry()
+        self.metadata_cache: DiskCache = DiskCache('metadata', configuration.get('metadata_cache_ttl', 0))
+        self.metadata_key: Optional[Tuple[str, str, str]] = None
+
+        # byte level progress is updated from the upload workers, and is reported at most every interval seconds
+        self.byte_progress: Coalescer = Coalescer(0.2)
+        self.total_bytes: int = 0
+        self.sent_bytes: int = 0
+        self.progress_lock = threading.Lock()
+        # limits the upload bandwidth of all the workers together; the limit can be changed while uploading
+        self.rate_limiter: TokenBucket = TokenBucket(configuration.get('upload_rate_limit'))
+        # pauses, resumes or cancels the deposition from another thread
+        self.control: UploadControl = UploadControl()
+
+    def bytes_sent(self, sent: int) -> None:
+        # called by the upload workers as each chunk of a file is sent
+        with self.progress_lock:
+            self.sent_bytes += sent
+            sent_bytes = self.sent_bytes
+        if self.byte_progress.due(final=sent_bytes >= self.total_bytes):
+            self.listener.on_bytes_uploaded(sent_bytes, self.total_bytes)
+
+    def save_telemetry(self) -> None:
+        # writes the timings of this run next to the session file
+        if self.manifest:
+            self.telemetry.save(self.session_file + TELEMETRY_FILE_SUFFIX)
+
+    def report_error(self, err: Exception, error_data: str = '') -> None:
+        self.error_occurred = True
+        self.listener.on_error(err, error_data)
+
+    @staticmethod
+    def get_vm_version() -> str:
+        # returns the version of the VM that is running
+        try:
+            with open('/etc/nmrbox.d/motd-identifier', 'r') as motd:
+                return motd.readline().split(":")[1].strip()
+        except (IOError, ValueError):
+            logging.error('Could not determine the version of NMRbox running on this machine.')
+            return 'unknown'
+
+    def prepare(self) -> None:
+        """ Starts the local preparation of the upload in the background: measuring, scheduling, hashing and
+        grouping the files. It overlaps the requests made before the first file can be uploaded. """
+
+        if self.preparation:
+            return
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='m2mtool-prepare')
+        self.preparation = executor.submit(self.plan_uploads)
+        executor.shutdown(wait=False)
+
+    def plan_uploads(self) -> Tuple[array, Dict[str, SelectionView], SelectionView]:
+        # returns the size of every file (by its position in the selection), and the files grouped into bundles
+        # and those uploaded on their own, in the order they are to be uploaded; the plan is held in arrays of
+        # positions, and the paths are only built as the files are taken from it
+        started = time.monotonic()
+        sizes = array('q', self.files.sizes)
+        for position, size in enumerate(sizes):
+            if size == UNKNOWN:
+                sizes[position] = os.path.getsize(os.path.join(self.directory, self.files[position]))
+
+        # the files are scheduled by what their names tell of them, and (if they are to be deduplicated) hashed
+        # in that order, which is the order deduplicate() needs their digests in, while the others are
+        # classified by their contents
+        classifier = FileClassifier.load()
+        # the schedule reserves workers for the large files out of as many as the upload pool may run
+        scheduler = get_scheduler(configuration.get('upload_schedule'), max_concurrency())
+        with tracing.span('schedule', policy=scheduler.name):
+            order = scheduler.order(self.files, sizes, classifier.classify(self.directory, self.files, sniff=False))
+        files = SelectionView(self.files, order)
+        if configuration.get('deduplicate_uploads'):
+            # the files a sync hashed already aren't hashed again
+            self.digests = hash_files_async(self.directory, files, configuration.get('hash_processes'),
+                                            known=self.manifest.digests if self.manifest else None)
+            if files:
+                self.digests[files[-1]].add_done_callback(lambda _: self.telemetry.add_phase('hashing', started))
+            if self.error_occurred or self.control.cancelled:
+                self.cancel_preparation()
+
+        # a deposition which already stopped won't use the plan (but waits for it), so the contents aren't sniffed
+        if configuration.get('classify_files', True) and not (self.error_occurred or self.control.cancelled):
+            with tracing.span('classify', files=len(files)):
+                self.categories = classifier.classify(self.directory, files)
+            logging.info("Assigned upload categories to %d of %d files.", len(self.categories), len(self.files))
+        bundles, single = group_small_files(order, sizes, configuration.get('bundle_threshold', 0),
+                                            configuration.get('bundle_max_size', 0))
+        tracing.add_span('plan_uploads', started, files=len(files), bundles=len(bundles))
+        return sizes, {name: SelectionView(self.files, positions) for name, positions in bundles.items()}, \
+            SelectionView(self.files, single)
+
+    def known_digest(self, file_name: str) -> Optional[str]:
+        # the digest of the file, if it was hashed to be deduplicated, or by the sync which selected it
+        future = self.digests.get(file_name)
+        if future:
+            return future.result()
+        return self.manifest.digests.get(file_name) if self.manifest else None
+
+    def cancel_preparation(self) -> None:
+        # stops hashing files which will not be uploaded, and waits for the hashing processes to exit
+        self.digests.cancel()
+        self.digests.join()
+
+    def run(self) -> None:
+        # handles the processes that prepare the file upload, as well as actual file upload
+        try:
+            with tracing.profiled(), tracing.span('deposition', files=len(self.files)):
+                self.prepare()
+                self.deposit()
+        except UploadCancelled:
+            pass
+        finally:
+            # the hashing only starts once the files are scheduled, so wait for that first
+            if self.preparation:
+                wait([self.preparation])
+            if self.error_occurred or self.control.cancelled:
+                self.cancel_preparation()
+            self.digests.join()
+            # the uploads recorded in the journal are on disk before the deposition ends
+            if self.manifest:
+                self.manifest.flush()
+            self.save_telemetry()
+            tracing.save()
+        if self.control.cancelled:
+            self.listener.on_upload_cancelled()
+
+    def deposit(self) -> None:
+        # resume an interrupted deposition
+        self.control.checkpoint()
+        if self.manifest:
+            try:
+                self.listener.on_start_upload()
+                with BMRBDepSession(sid=self.manifest.sid) as bmrbdep_session:
+                    self.upload_files(bmrbdep_session)
+            except IOError as err:
+                self.report_error(err)
+            return
+
+        # fetch the software list, while the files are hashed
+        text = self.fetch_metadata()
+        if text is None:
+            return
+
+        try:
+            with tracing.span('parse_metadata', 'metadata'):
+                metadata = DepositionMetadata(text)
+                user_email = metadata.user_email
+        except ValueError as err:
+            self.metadata_cache.invalidate(*self.metadata_key)
+            self.report_error(err, "retrieve_metadata_error")
+            return
+
+        self.control.checkpoint()
+        try:
+            # create the deposition, and journal it before any file is uploaded
+            creating = time.monotonic()
+            with BMRBDepSession(nmrstar_file=metadata.nmrstar_file,
+                                user_email=user_email,
+                                nickname=self.nickname) as bmrbdep_session:
+                self.telemetry.add_phase('create_deposition', creating)
+                self.manifest = UploadManifest(self.session_file, bmrbdep_session.sid, nickname=self.nickname)
+                self.manifest.add_files(self.files)
+                self.manifest.save()
+
+                # upload the files, starting as soon as the deposition exists
+                self.listener.on_start_upload()
+                self.upload_files(bmrbdep_session)
+
+        except IOError as err:
+            # the metadata may be what the deposition was rejected for, so fetch it again next time
+            if not self.manifest:
+                self.metadata_cache.invalidate(*self.metadata_key)
+            self.report_error(err)
+
+    def fetch_metadata(self) -> Optional[str]:
+        # returns the generated NMR-STAR metadata for the deposition, from the cache if it is recent enough
+        # (the metadata depends on the deposited directory and the software on the VM)
+        self.metadata_key = (configuration['api_root_url'], os.path.abspath(self.directory), self.get_vm_version())
+        metadata = self.metadata_cache.get(*self.metadata_key)
+        if metadata is not None:
+            logging.info("Using cached deposition metadata.")
+            return metadata
+
+        # a cancel stops waiting for the login and the metadata, which the server may take a while to generate
+        try:
+            with ApiSession(self.control) as api:
+                url = f"{configuration['api_root_url']}/user/get-bmrbdep-metadata"
+                with self.telemetry.phase('metadata'):
+                    r = self.control.call(api.get, url, json={'path': self.directory, 'vm_id': self.metadata_key[2]})
+                r.raise_for_status()
+        except requests.exceptions.RequestException as err:
+            self.report_error(err, "retrieve_metadata_error")
+            return None
+
+        self.metadata_cache.put(r.text, *self.metadata_key)
+        return r.text
+
+    def upload_files(self, bmrbdep_session: BMRBDepSession) -> None:
+        # uploads the files, recording each one in the manifest, then finalizes the deposition
+        self.prepare()
+        sizes, bundles, single = self.preparation.result()
+        self.total_bytes = sum(sizes)
+
+        # a sync deletes the deposited files which were removed locally
+        removed = self.manifest.removed_files()
+        if removed:
+            with self.telemetry.phase('delete'):
+                for file_name in removed:
+                    self.control.checkpoint()
+                    bmrbdep_session.delete_file(file_name, missing_ok=True)
+                    self.manifest.forget(file_name)
+
+        # send the contents of duplicate files, and of files the server already holds, only once; the files are
+        # checked as they are hashed, and are linked once all contents were sent
+        to_link: Dict[str, str] = {}
+        to_upload = single
+        if self.digests:
+            to_upload = deduplicate(single, self.digests, bmrbdep_session.find_blobs, to_link)
+
+        # the pool only exits once every worker has drained
+        with self.telemetry.phase('upload'), \
+                UploadPool(bmrbdep_session.sid, self.directory, callback=self.bytes_sent,
+                           telemetry=self.telemetry, categories=self.categories,
+                           rate_limiter=self.rate_limiter, control=self.control) as pool:
+            counter = 0
+            for file, digest, err in itertools.chain(pool.upload_bundles(bundles), pool.upload(to_upload),
+                                                     pool.link(to_link)):
+                if isinstance(err, UploadCancelled):
+                    # keep recording the uploads which finish while the others stop
+                    continue
+                if err:
+                    self.manifest.flush()
+                    self.report_error(err, file)
+                    break
+                if file in to_link:
+                    self.bytes_sent(sizes[self.files.position(file)])
+                # a bundle reports the digest of each of its files
+                digests = digest if file in bundles else {file: digest}
+                for uploaded_file in bundles.get(file, [file]):
+                    self.manifest.mark_uploaded(uploaded_file, digests.get(uploaded_file) or
+                                                self.known_digest(uploaded_file))
+                    counter += 1
+                self.listener.on_file_uploaded(counter)
+
+        if self.control.cancelled:
+            self.discard_partial_uploads(bmrbdep_session, pool.interrupted)
+        elif not self.error_occurred:
+            with self.telemetry.phase('finalize'):
+                # a synced deposition had it removed when it was first finalized
+                bmrbdep_session.delete_file('m2mtool_generated.str', missing_ok=True)
+                self.manifest.complete = True
+                self.manifest.save()
+            self.save_telemetry()
+            self.listener.on_upload_finished(bmrbdep_session.session_url)
+
+    def discard_partial_uploads(self, bmrbdep_session: BMRBDepSession, file_names: List[str]) -> None:
+        # deletes whatever the server kept of the uploads which were cancelled part way; the files are still
+        # pending in the manifest, so the next run uploads them again
+        with self.telemetry.phase('cancel'):
+            for file_name in file_names:
+                try:
+                    bmrbdep_session.delete_file(file_name, missing_ok=True)
+                except IOError as err:
+                    logging.warning("Could not delete the partial upload of '%s': %s", file_name, err)
+            self.manifest.flush()
+        logging.info("Deposition cancelled; %d partial uploads were discarded. Run m2mtool again to resume it.",
+                     len(file_names))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from typing import Callable, Iterator, List, Optional
+
+from m2mtool import tracing
+
+
+class FileNode:
+    """ A file or subdirectory in a FileIndex. """
+
+    __slots__ = ('name', 'path', 'is_dir', 'readable', 'size', 'mtime', 'parent', 'row', 'children',
+                 'contains_prohibited')
+
+    def __init__(self, name: str, path: str, is_dir: bool, readable: bool, size: int = 0, mtime: float = 0,
+                 parent: 'FileNode' = None):
+        self.name: str = name
+        # the path relative to the indexed directory, using '/' as the separator
+        self.path: str = path
+        self.is_dir: bool = is_dir
+        # whether the user may upload the file (or read and enter the subdirectory)
+        self.readable: bool = readable
+        self.size: int = size
+        self.mtime: float = mtime
+        # the containing directory, and the position of the node within its contents
+        self.parent: Optional[FileNode] = parent
+        self.row: int = 0
+        # the scanned contents of a subdirectory, None until it is scanned
+        self.children: Optional[List['FileNode']] = None
+        # whether the subdirectory contains anything that cannot be uploaded, None until it is checked
+        self.contains_prohibited: Optional[bool] = None
+
+
+class FileIndex:
+    """ An in-memory index of a directory tree, with the permission and size of every entry.
+
+    Each directory is read with a single os.scandir() call the first time its contents are needed, and
+    the result is kept, so checking permissions and collecting the files to upload share one walk. The index
+    may be used from several threads; a directory scanned by two threads at once is only stored once. """
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.root: FileNode = FileNode('', '', True, True)
+        self._lock = threading.Lock()
+
+    def children(self, node: FileNode) -> List[FileNode]:
+        """ Returns the contents of a subdirectory (subdirectories first, then alphabetically), scanning it
+        if it hasn't been scanned yet. Entries which are neither files nor directories are left out. """
+
+        if node.children is not None:
+            return node.children
+        if not node.is_dir or not node.readable:
+            return []
+
+        children = []
+        with tracing.span('scan_directory', 'filesystem', path=node.path), \
+                os.scandir(os.path.join(self.directory, node.path)) as entries:
+            for entry in entries:
+                path = f'{node.path}/{entry.name}' if node.path else entry.name
+                if entry.is_file():
+                    readable = os.access(entry.path, os.R_OK)
+                    stat = entry.stat() if readable else None
+                    children.append(FileNode(entry.name, path, False, readable, stat.st_size if stat else 0,
+                                             stat.st_mtime if stat else 0, node))
+                elif entry.is_dir():
+                    children.append(FileNode(entry.name, path, True, os.access(entry.path, os.X_OK | os.R_OK),
+                                             parent=node))
+        children.sort(key=lambda child: (not child.is_dir, child.name.lower()))
+        for row, child in enumerate(children):
+            child.row = row
+
+        with self._lock:
+            if node.children is None:
+                node.children = children
+        return node.children
+
+    def check_prohibited(self, node: FileNode, cancelled: Callable[[], bool] = None) -> Optional[bool]:
+        """ Returns True if the subdirectory contains any file or folder that the user cannot upload.
+
+        The walk stops at the first prohibited entry it finds. If cancelled() becomes true before the answer
+        is known, None is returned and nothing is recorded. """
+
+        if node.contains_prohibited is not None:
+            return node.contains_prohibited
+
+        contains_prohibited = False
+        for child in self.children(node):
+            if cancelled and cancelled():
+                return None
+            if not child.readable:
+                contains_prohibited = True
+                break
+            if child.is_dir:
+                child_contains_prohibited = self.check_prohibited(child, cancelled)
+                if child_contains_prohibited is None:
+                    return None
+                if child_contains_prohibited:
+                    contains_prohibited = True
+                    break
+        node.contains_prohibited = contains_prohibited
+        return contains_prohibited
+
+    def iter_files(self, node: FileNode) -> Iterator[FileNode]:
+        """ Yields every file in the subdirectory (recursively) which the user can upload. """
+
+        for child in self.children(node):
+            if not child.readable:
+                continue
+            if child.is_dir:
+                yield from self.iter_files(child)
+            else:
+                yield child
@@ -0,0 +1,242 @@
+import queue
+from typing import Dict, Iterator, Set
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QIcon
+from PyQt5.QtWidgets import QApplication, QStyle
+
+from m2mtool import tracing
+from m2mtool.file_index import FileIndex, FileNode
+from m2mtool.manifest import SESSION_FILES
+from m2mtool.selection import FileSelection
+
+
+class Scanner(QtCore.QThread):
+    """ This class checks, in the background, whether subdirectories contain anything the user does not have
+    permission to upload."""
+
+    # Define class level variable (signal emitted to gui)
+    resolved = pyqtSignal(object)
+
+    def __init__(self, index: FileIndex):
+        super().__init__()
+        self.file_index: FileIndex = index
+        self.queue: queue.Queue = queue.Queue()
+        self.stopped: bool = False
+
+    def enqueue(self, node: FileNode) -> None:
+        # queue a subdirectory to be checked
+        self.queue.put(node)
+
+    def run(self):
+        # check queued subdirectories until stopped
+        while not self.stopped:
+            node = self.queue.get()
+            if node is None:
+                break
+            with tracing.span('check_prohibited', 'filesystem', path=node.path):
+                resolved = self.file_index.check_prohibited(node, lambda: self.stopped) is not None
+            if resolved:
+                self.resolved.emit(node)
+
+    def stop_thread(self):
+        self.stopped = True
+        self.queue.put(None)
+        self.wait()
+
+
+class FileTreeModel(QAbstractItemModel):
+    """ A lazy tree model of the files and subdirectories that can be selected for upload.
+
+    Subdirectories are only read when they are expanded, and their permission warnings are filled in as the
+    Scanner resolves them."""
+
+    # emitted when something the user does not have permission to upload is found
+    prohibited_found = pyqtSignal()
+
+    def __init__(self, index: FileIndex, parent=None):
+        super().__init__(parent)
+        self.file_index: FileIndex = index
+        self.fetched: Set[FileNode] = set()
+        # check states set by the user; other nodes inherit the state of their closest ancestor
+        self.check_states: Dict[FileNode, int] = {}
+        self.explicit_ancestors: Set[FileNode] = set()
+
+        self.file_icon = QIcon(QApplication.style().standardIcon(QStyle.SP_FileIcon))
+        self.dir_icon = QIcon(QApplication.style().standardIcon(QStyle.SP_DirIcon))
+
+        self.scanner: Scanner = Scanner(index)
+        self.scanner.resolved.connect(self.permission_resolved)
+
+        # the top level entries are read immediately, everything below them is read on demand
+        self.file_index.children(self.file_index.root)
+        self.fetched.add(self.file_index.root)
+        self.queue_subdirectories(self.file_index.root)
+        self.scanner.start()
+
+    @property
+    def has_prohibited_entry(self) -> bool:
+        # whether any top level entry is already known to be prohibited
+        return any(not node.readable for node in self.file_index.root.children)
+
+    def node(self, index: QModelIndex) -> FileNode:
+        return index.internalPointer() if index.isValid() else self.file_index.root
+
+    def queue_subdirectories(self, node: FileNode) -> None:
+        # queue the permission check of every readable subdirectory of node
+        for child in node.children:
+            if child.is_dir and child.readable and child.contains_prohibited is None:
+                self.scanner.enqueue(child)
+
+    def permission_resolved(self, node: FileNode) -> None:
+        model_index = self.createIndex(node.row, 0, node)
+        self.dataChanged.emit(model_index, model_index)
+        if node.contains_prohibited:
+            self.prohibited_found.emit()
+
+    # QAbstractItemModel interface
+
+    def index(self, row: int, column: int, parent: QModelIndex = QModelIndex()) -> QModelIndex:
+        parent_node = self.node(parent)
+        if parent_node not in self.fetched or not 0 <= row < len(parent_node.children) or column != 0:
+            return QModelIndex()
+        return self.createIndex(row, column, parent_node.children[row])
+
+    def parent(self, index: QModelIndex) -> QModelIndex:
+        if not index.isValid():
+            return QModelIndex()
+        parent_node = index.internalPointer().parent
+        if parent_node is None or parent_node is self.file_index.root:
+            return QModelIndex()
+        return self.createIndex(parent_node.row, 0, parent_node)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        parent_node = self.node(parent)
+        return len(parent_node.children) if parent_node in self.fetched else 0
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 1
+
+    def hasChildren(self, parent: QModelIndex = QModelIndex()) -> bool:
+        parent_node = self.node(parent)
+        if parent_node in self.fetched:
+            return bool(parent_node.children)
+        return parent_node.is_dir and parent_node.readable
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        parent_node = self.node(parent)
+        return parent_node.is_dir and parent_node.readable and parent_node not in self.fetched
+
+    def fetchMore(self, parent: QModelIndex) -> None:
+        parent_node = self.node(parent)
+        children = self.file_index.children(parent_node)
+        if not children:
+            self.fetched.add(parent_node)
+            return
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        self.fetched.add(parent_node)
+        self.endInsertRows()
+        self.queue_subdirectories(parent_node)
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if not self.node(index).readable:
+            return Qt.ItemIsEnabled
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = self.node(index)
+        item_type = 'subdirectory' if node.is_dir else 'file'
+
+        if role == Qt.DisplayRole:
+            return f'{node.name} ⚠️' if not node.readable or node.contains_prohibited else node.name
+        if role == Qt.DecorationRole:
+            return self.dir_icon if node.is_dir else self.file_icon
+        if role == Qt.CheckStateRole:
+            return self.check_state(node)
+        if role == Qt.ForegroundRole:
+            if not node.readable:
+                return QColor(255, 0, 0)
+            if node.contains_prohibited:
+                return QColor(255, 130, 0)
+        if role == Qt.ToolTipRole:
+            if not node.readable:
+                return f'You do not have permission to upload this {item_type}'
+            if node.contains_prohibited:
+                return 'At least some files/folders in this subdirectory cannot be uploaded (you do not have ' \
+                       'permission)'
+            if node.is_dir and node.contains_prohibited is None:
+                return 'Checking permissions...'
+        return None
+
+    def setData(self, index: QModelIndex, value, role: int = Qt.EditRole) -> bool:
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        node = self.node(index)
+
+        # the new state replaces any state set on the contents of a subdirectory
+        prefix = f'{node.path}/'
+        for other in [other for other in self.check_states if other.path.startswith(prefix)]:
+            del self.check_states[other]
+        self.check_states[node] = Qt.Checked if value == Qt.Checked else Qt.Unchecked
+        ancestor = node.parent
+        while ancestor is not None:
+            self.explicit_ancestors.add(ancestor)
+            ancestor = ancestor.parent
+
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.emit_subtree_changed(node)
+        return True
+
+    def emit_subtree_changed(self, node: FileNode) -> None:
+        # update the check boxes of the loaded contents of a subdirectory
+        if node not in self.fetched or not node.children:
+            return
+        first = self.createIndex(0, 0, node.children[0])
+        last = self.createIndex(len(node.children) - 1, 0, node.children[-1])
+        self.dataChanged.emit(first, last, [Qt.CheckStateRole])
+        for child in node.children:
+            self.emit_subtree_changed(child)
+
+    # selection
+
+    def check_state(self, node: FileNode) -> int:
+        if not node.readable:
+            return Qt.Unchecked
+        while node is not None:
+            if node in self.check_states:
+                return self.check_states[node]
+            node = node.parent
+        return Qt.Checked
+
+    def selected_files(self) -> FileSelection:
+        """ Returns the selected files which the user has permission to upload, with the sizes and modification
+        times read while scanning them. """
+
+        selection = FileSelection()
+        with tracing.span('collect_selection', 'filesystem'):
+            for node in self.selected_nodes(self.file_index.root):
+                # the session files m2mtool writes itself are never uploaded
+                if node.path in SESSION_FILES:
+                    continue
+                selection.add(node.path, node.size, node.mtime)
+        return selection
+
+    def selected_nodes(self, node: FileNode) -> Iterator[FileNode]:
+        """ Yields the selected files in the subdirectory (recursively) which the user can upload. """
+
+        for child in self.file_index.children(node):
+            if not child.readable:
+                continue
+            checked = self.check_state(child) == Qt.Checked
+            if not child.is_dir:
+                if checked:
+                    yield child
+            elif child in self.explicit_ancestors:
+                yield from self.selected_nodes(child)
+            elif checked:
+                yield from self.file_index.iter_files(child)
@@ -0,0 +1,27 @@
+import importlib
+import os
+
+from PyQt5 import QtWidgets
+
+# The Python modules generated from the .ui files when the package is built (see setup.py) are named after
+# them with this prefix, e.g. ui_bar for bar.ui
+COMPILED_FORM_PREFIX = 'ui_'
+
+
+def load_form(widget: QtWidgets.QWidget, name: str) -> None:
+    """ Sets up the widget from the form in name.ui, adding its child widgets as attributes as uic.loadUi does.
+
+    The form class generated at build time is used if it was installed; otherwise (as when running from a
+    source checkout) the .ui file is parsed. """
+
+    try:
+        module = importlib.import_module(f'{__package__}.{COMPILED_FORM_PREFIX}{name}')
+    except ImportError:
+        from PyQt5 import uic
+        uic.loadUi(os.path.join(os.path.dirname(__file__), f'{name}.ui'), widget)
+        return
+
+    form = module.Ui_Form()
+    form.setupUi(widget)
+    for attribute, value in vars(form).items():
+        setattr(widget, attribute, value)
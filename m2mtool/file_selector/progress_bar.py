@@ -1,38 +1,39 @@
-import os
 import sys
-import json
 import logging
 import time
 import webbrowser
-from typing import List
-from tempfile import NamedTemporaryFile
+from typing import Callable
 
-import pynmrstar
-import requests
-from PyQt5 import QtWidgets, QtCore, uic
+from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import QMessageBox, QDesktopWidget
 
-from m2mtool.bmrbdep import BMRBDepSession
-from m2mtool.configuration import configuration
-from m2mtool.helpers import ApiSession
+from m2mtool.deposit import Deposition, UploadListener
+from m2mtool.file_selector.forms import load_form
+from m2mtool.manifest import UploadManifest
+from m2mtool.selection import FileSelection
+from m2mtool.telemetry import Coalescer, ThroughputMeter
 
 logging.basicConfig()
 
+# The unit of the upload speed limit in the progress window, in bytes
+MEGABYTE = 1024 * 1024
+
 
 class ProgressBar(QtWidgets.QWidget):
-    def __init__(self, directory: str, nickname: str, files: List[str], session_file: str):
+    def __init__(self, directory: str, nickname: str, files: FileSelection, session_file: str,
+                 manifest: UploadManifest = None):
         super().__init__()
 
-        ui_path = os.path.join(os.path.dirname(__file__), 'bar.ui')
-        uic.loadUi(ui_path, self)
+        load_form(self, 'bar')
 
         self.directory: str = directory
         self.nickname: str = nickname
-        self.files: List[str] = files
+        self.files: FileSelection = files
         self.count: int = len(files)
         self.session_file: str = session_file
         self.upload_complete: bool = False
+        self.stopping: bool = False
 
         # center window on screen
         qt_rectangle = self.frameGeometry()
@@ -46,19 +47,30 @@ class ProgressBar(QtWidgets.QWidget):
 
         # set up file upload progress bar (to be displayed later)
         self.label_upload.setText(f'0 of {self.count} files uploaded...')
+        self.label_throughput.setText('')
         self.progressBar_upload.setValue(0)
+        self.throughput: ThroughputMeter = ThroughputMeter()
 
         # initialize Uploader and Timer objects, and connect signals from both to gui
-        self.uploader: Uploader = Uploader(self.directory, self.nickname, self.files, self.session_file)
+        self.uploader: Uploader = Uploader(self.directory, self.nickname, self.files, self.session_file, manifest)
         self.uploader.start()
         self.timer: Timer = Timer()
         self.timer.start()
         self.timer.tick.connect(self.update_init_progress_bar)
         self.uploader.start_upload.connect(self.start_upload)
         self.uploader.file_uploaded.connect(self.update_upload_progress_bar)
+        self.uploader.bytes_uploaded.connect(self.update_throughput)
         self.uploader.upload_finished.connect(self.upload_finished)
         self.uploader.error.connect(self.handle_error)
 
+        # the upload speed limit (0 for none) can be changed while uploading
+        rate = self.uploader.deposition.rate_limiter.rate
+        self.spinBox_rate_limit.setValue(rate / MEGABYTE if rate else 0)
+        self.spinBox_rate_limit.valueChanged.connect(self.set_rate_limit)
+
+        # the upload can be paused to free the network for a while, without losing its progress
+        self.pushButton_pause.clicked.connect(self.toggle_pause)
+
     def update_init_progress_bar(self, bar_value: int) -> None:
         # animates the initial bar that appears during processes executed before file upload
         self.progressBar_init.setValue(bar_value)
@@ -69,9 +81,43 @@ class ProgressBar(QtWidgets.QWidget):
         self.stackedWidget.setCurrentWidget(self.page_upload)
 
     def update_upload_progress_bar(self, uploaded_count: int) -> None:
-        # updates display of progress bar text/image when each file uploads
+        # updates display of progress bar text when each file uploads
         self.label_upload.setText(f'{uploaded_count} of {self.count} files uploaded...')
-        self.progressBar_upload.setValue(int(uploaded_count / self.count * 100))
+
+    def update_throughput(self, sent_bytes: int, total_bytes: int) -> None:
+        # updates the progress bar image, throughput and estimated time remaining as bytes are sent
+        if not total_bytes:
+            return
+        self.progressBar_upload.setValue(int(sent_bytes / total_bytes * 100))
+        if self.uploader.deposition.control.paused:
+            return
+
+        rate = self.throughput.update(sent_bytes)
+        remaining = self.throughput.remaining(sent_bytes, total_bytes, rate)
+        if remaining is None:
+            return
+        self.label_throughput.setText(f'{format_bytes(sent_bytes)} of {format_bytes(total_bytes)} '
+                                      f'({format_bytes(rate)}/s, {format_duration(remaining)} remaining)')
+
+    def set_rate_limit(self, megabytes_per_second: float) -> None:
+        # applies a new upload speed limit to every upload in progress
+        self.uploader.deposition.rate_limiter.set_rate(megabytes_per_second * MEGABYTE)
+        logging.info("Upload speed limit set to %s.",
+                     f'{megabytes_per_second:.1f} MB/s' if megabytes_per_second else 'unlimited')
+
+    def toggle_pause(self) -> None:
+        # pauses the uploads in progress (each stops before its next chunk) or resumes them
+        control = self.uploader.deposition.control
+        if control.paused:
+            control.resume()
+            # the rate measured before the pause would make the estimate too optimistic
+            self.throughput = ThroughputMeter()
+            self.pushButton_pause.setText('Pause')
+            self.label_throughput.setText('')
+        else:
+            control.pause()
+            self.pushButton_pause.setText('Resume')
+            self.label_throughput.setText('Paused')
 
     def upload_finished(self, session_url: str) -> None:
         # this runs after file upload finished
@@ -83,14 +129,12 @@ class ProgressBar(QtWidgets.QWidget):
         webbrowser.open_new_tab(session_url)
 
     def closeEvent(self, event) -> None:
-        # handles user closing window in middle of upload
+        # handles user closing window in middle of upload: the window stays open (but disabled) until the
+        # deposition has stopped and discarded its partial uploads, rather than freezing while it does
         if not self.upload_complete:
-            if self.timer.isRunning():
-                self.timer.stop_thread()
-            if self.uploader.isRunning():
-                self.uploader.stop_thread()
-            self.show_cancel()
-            sys.exit()
+            event.ignore()
+            self.label_throughput.setText('Cancelling...')
+            self.stop_upload(self.upload_cancelled)
 
     def handle_error(self, err: Exception, error_data: str = None) -> None:
         if error_data == "retrieve_metadata_error":
@@ -99,10 +143,37 @@ class ProgressBar(QtWidgets.QWidget):
             logging.exception("Encountered error when uploading file: %s\n%s", error_data, err)
         else:
             logging.exception("Encountered error: %s", err)
+        self.stop_upload(self.upload_failed)
+
+    def stop_upload(self, stopped: Callable[[], None]) -> None:
+        # cancels the deposition and disables the window, then calls stopped once the uploader thread has
+        # finished (at once if it has already)
+        if self.stopping:
+            return
+        self.stopping = True
+        self.setEnabled(False)
         if self.timer.isRunning():
             self.timer.stop_thread()
+
+        called = []
+
+        def finished() -> None:
+            # the thread may finish between connecting to its signal and checking it
+            if not called:
+                called.append(True)
+                stopped()
+
+        self.uploader.finished.connect(finished)
         if self.uploader.isRunning():
             self.uploader.stop_thread()
+        else:
+            finished()
+
+    def upload_cancelled(self) -> None:
+        self.show_cancel()
+        sys.exit()
+
+    def upload_failed(self) -> None:
         self.show_error()
         sys.exit(1)
 
@@ -119,7 +190,7 @@ class ProgressBar(QtWidgets.QWidget):
         # show cancellation message if window closed before upload done
         msg = QMessageBox()
         msg.setWindowTitle("Upload cancelled")
-        msg.setText("Your deposition upload was cancelled.")
+        msg.setText("Your deposition upload was cancelled.\n\nRun m2mtool on the same folder again to resume it.")
         msg.exec_()
 
     @staticmethod
@@ -131,86 +202,56 @@ class ProgressBar(QtWidgets.QWidget):
         msg.exec_()
 
 
-class Uploader(QtCore.QThread):
-    """ This class runs the processes that prepare for and complete the actual file upload."""
+class Uploader(QtCore.QThread, UploadListener):
+    """ This class runs the Deposition (the processes that prepare for and complete the actual file upload) in the
+    background, and relays its progress to the gui as signals.
+
+    Progress is coalesced, so the gui is updated at most every refresh_interval seconds however many files are
+    uploaded."""
+
+    refresh_interval = 0.1
 
     # Define class level variables (signals emitted to gui)
     start_upload = pyqtSignal()
     file_uploaded = pyqtSignal(int)
+    bytes_uploaded = pyqtSignal(object, object)
     upload_finished = pyqtSignal(str)
     error = pyqtSignal(Exception, str)
 
-    def __init__(self, directory: str, nickname: str, files: List[str], session_file: str):
+    def __init__(self, directory: str, nickname: str, files: FileSelection, session_file: str,
+                 manifest: UploadManifest = None):
         super().__init__()
-        self.directory: str = directory
-        self.nickname: str = nickname
-        self.files: List[str] = files
-        self.session_file: str = session_file
-        self.error_occurred: bool = False
+        self.deposition: Deposition = Deposition(directory, nickname, files, session_file, manifest, listener=self)
+        self.file_count: int = len(files)
+        self.file_progress: Coalescer = Coalescer(self.refresh_interval)
+        self.byte_progress: Coalescer = Coalescer(self.refresh_interval)
 
-    @staticmethod
-    def get_vm_version() -> str:
-        # returns the version of the VM that is running
-        try:
-            with open('/etc/nmrbox.d/motd-identifier', 'r') as motd:
-                return motd.readline().split(":")[1].strip()
-        except (IOError, ValueError):
-            logging.error('Could not determine the version of NMRbox running on this machine.')
-            return 'unknown'
+    def on_start_upload(self) -> None:
+        self.start_upload.emit()
+
+    def on_file_uploaded(self, uploaded_count: int) -> None:
+        if self.file_progress.due(final=uploaded_count >= self.file_count):
+            self.file_uploaded.emit(uploaded_count)
+
+    def on_bytes_uploaded(self, sent_bytes: int, total_bytes: int) -> None:
+        if self.byte_progress.due(final=sent_bytes >= total_bytes):
+            self.bytes_uploaded.emit(sent_bytes, total_bytes)
+
+    def on_upload_finished(self, session_url: str) -> None:
+        self.upload_finished.emit(session_url)
+
+    def on_error(self, err: Exception, error_data: str) -> None:
+        self.error.emit(err, error_data)
 
     def run(self):
         # handles the processes that prepare the file upload, as well as actual file upload
-
-        # fetch the software list
-        with ApiSession() as api:
-            try:
-                url = f"{configuration['api_root_url']}/user/get-bmrbdep-metadata"
-                r = api.get(url, json={'path': self.directory, 'vm_id': self.get_vm_version()})
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as err:
-                self.error_occurred: bool = True
-                self.error.emit(err, "retrieve_metadata_error")
-
-            if not self.error_occurred:
-                try:
-                    with NamedTemporaryFile() as star_file:
-                        star_file.write(r.text.encode())
-                        star_file.flush()
-                        star_file.seek(0)
-
-                        user_email = pynmrstar.Entry.from_string(r.text).get_tag('_Contact_person.Email_address')[0]
-                        self.start_upload.emit()
-
-                        # upload the files
-                        with BMRBDepSession(nmrstar_file=star_file,
-                                            user_email=user_email,
-                                            nickname=self.nickname) as bmrbdep_session:
-                            counter = 0
-                            for file in self.files:
-                                try:
-                                    bmrbdep_session.upload_file(file, self.directory)
-                                except Exception as err:
-                                    self.error_occurred: bool = True
-                                    self.error.emit(err, file)
-                                    break
-                                counter += 1
-                                self.file_uploaded.emit(counter)
-
-                            if not self.error_occurred:
-                                bmrbdep_session.delete_file('m2mtool_generated.str')
-
-                        if not self.error_occurred:
-                            with open(self.session_file, "w") as session_log:
-                                session_info = {"sid": bmrbdep_session.sid, "ctime": time.time()}
-                                session_log.write(json.dumps(session_info))
-
-                            self.upload_finished.emit(bmrbdep_session.session_url)
-
-                except IOError as err:
-                    self.error.emit(err)
+        self.deposition.run()
 
     def stop_thread(self):
-        self.terminate()
+        # cancels the deposition without waiting for it to stop (finished is emitted once it has): the uploads in
+        # flight stop before their next chunk, and what the server received of them is deleted, so running
+        # m2mtool again resumes the deposition
+        self.deposition.control.cancel()
 
 
 class Timer(QtCore.QThread):
@@ -220,25 +261,54 @@ class Timer(QtCore.QThread):
     # Define class level variable (signal emitted to gui)
     tick = pyqtSignal(int)
 
+    # The bar is advanced every tick_interval seconds, and a request to stop is noticed within poll_interval
+    tick_interval = 1.0
+    poll_interval = 0.05
+
     def __init__(self):
         super().__init__()
 
     def run(self):
-        # run timer to periodically animate initial bar
+        # run timer to periodically animate initial bar, until asked to stop
         bar_value = 0
-        while True:
+        next_tick = time.monotonic() + self.tick_interval
+        while not self.isInterruptionRequested():
+            time.sleep(self.poll_interval)
+            if time.monotonic() < next_tick:
+                continue
+            next_tick += self.tick_interval
             bar_value += 25
             if bar_value > 100:
                 bar_value = 0
-            time.sleep(1)
             self.tick.emit(bar_value)
 
     def stop_thread(self):
-        self.terminate()
+        self.requestInterruption()
+        self.wait()
+
+
+def format_bytes(size: float) -> str:
+    # formats a byte count for display
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def format_duration(seconds: float) -> str:
+    # formats a number of seconds for display
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 3600:
+        return f'{seconds // 60}m {seconds % 60}s'
+    return f'{seconds // 3600}h {seconds % 3600 // 60}m'
 
 
-def run_progress_bar(directory: str, nickname: str, files: List[str], session_file: str):
+def run_progress_bar(directory: str, nickname: str, files: FileSelection, session_file: str,
+                     manifest: UploadManifest = None):
     app = QtWidgets.QApplication([])
-    widget = ProgressBar(directory, nickname, files, session_file)
+    widget = ProgressBar(directory, nickname, files, session_file, manifest)
     widget.show()
     app.exec_()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Union
+
+# The digest algorithm used to identify file contents
+DIGEST_ALGORITHM = 'sha256'
+_READ_SIZE = 1024 * 1024
+
+
+def new_digest():
+    """ Returns a new, empty hash object of the type used to identify file contents. """
+    return hashlib.new(DIGEST_ALGORITHM)
+
+
+def file_digest(path: str) -> str:
+    """ Returns the hex digest of the contents of the file at path. """
+
+    digest = new_digest()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _digest_batch(paths: List[str]) -> List[Union[str, OSError]]:
+    # a file which can't be read doesn't fail the rest of its batch
+    digests = []
+    for path in paths:
+        try:
+            digests.append(file_digest(path))
+        except OSError as err:
+            digests.append(err)
+    return digests
+
+
+class DigestFutures(dict):
+    """ The futures of the digests worked out by hash_files_async(), keyed by file name, along with the thread
+    which hashes them. """
+
+    def __init__(self, files: Iterable[str] = ()):
+        super().__init__((file_name, Future()) for file_name in files)
+        self.thread: Optional[threading.Thread] = None
+
+    def cancel(self) -> None:
+        """ Stops hashing the files which haven't been hashed yet. """
+        for future in self.values():
+            future.cancel()
+
+    def join(self) -> None:
+        """ Waits until the hashing has stopped and its worker processes have exited. """
+        if self.thread:
+            self.thread.join()
+
+
+def hash_files_async(directory: str, files: Iterable[str], processes: int = None,
+                     known: Dict[str, str] = None) -> DigestFutures:
+    """ Starts hashing the files (relative to directory) in the background, and returns a future for the
+    digest of each file, keyed by file name. The futures of the files whose digests are known already are
+    completed with them, rather than hashing the files again.
+
+    The files are hashed in parallel using a pool of worker processes, and their futures complete in the
+    order the files were given. If a file can't be read, its future holds the error; if the pool fails, the
+    futures of every file not hashed yet do. Cancelling the future of a file which hasn't been hashed yet stops
+    the hashing once the batch being hashed is done; join() the returned futures to wait for that. """
+
+    files = list(files)
+    futures = DigestFutures(files)
+    known = known or {}
+    for file_name in files:
+        if file_name in known and futures[file_name].set_running_or_notify_cancel():
+            futures[file_name].set_result(known[file_name])
+    files = [file_name for file_name in files if file_name not in known]
+    if not files:
+        return futures
+
+    def run() -> None:
+        worker_count = min(processes or os.cpu_count() or 1, len(files))
+        # send the file names to the workers in batches, to keep the inter-process overhead low for small files
+        batch_size = max(1, len(files) // (worker_count * 8))
+        batches = [files[start:start + batch_size] for start in range(0, len(files), batch_size)]
+        executor: Optional[ProcessPoolExecutor] = None
+        pending: deque = deque()
+        position = 0
+        try:
+            executor = ProcessPoolExecutor(max_workers=worker_count)
+            for batch in batches:
+                pending.append(executor.submit(_digest_batch, [os.path.join(directory, file_name)
+                                                               for file_name in batch]))
+            for batch in batches:
+                digests = pending.popleft().result()
+                for file_name, digest in zip(batch, digests):
+                    if not futures[file_name].set_running_or_notify_cancel():
+                        return
+                    if isinstance(digest, OSError):
+                        futures[file_name].set_exception(digest)
+                    else:
+                        futures[file_name].set_result(digest)
+                    position += 1
+        except Exception as err:
+            for file_name in files[position:]:
+                if futures[file_name].set_running_or_notify_cancel():
+                    futures[file_name].set_exception(err)
+        finally:
+            for batch_future in pending:
+                batch_future.cancel()
+            # the worker processes are waited for here, rather than left to exit with the interpreter (which
+            # hangs on Python 3.8); the thread isn't a daemon, so the interpreter waits for this too
+            if executor:
+                executor.shutdown(wait=True)
+
+    futures.thread = threading.Thread(target=run, name='m2mtool-hash')
+    futures.thread.start()
+    return futures
+
+
+def hash_files(directory: str, files: Iterable[str], processes: int = None) -> Dict[str, str]:
+    """ Returns the digests of the contents of the files (relative to directory), keyed by file name.
+
+    The files are hashed in parallel using a pool of worker processes. """
+
+    futures = hash_files_async(directory, files, processes)
+    try:
+        return {file_name: future.result() for file_name, future in futures.items()}
+    finally:
+        futures.cancel()
+        futures.join()
@@ -1,40 +1,105 @@
 import logging
 import os
+from typing import Optional, Tuple
 
-import dbus
 import requests
 
+from m2mtool import tracing
+from m2mtool.cache import DiskCache
 from m2mtool.configuration import configuration
+from m2mtool.control import UploadControl
+
+# Responses which mean that the (possibly cached) login session is no longer valid
+AUTHENTICATION_ERRORS = {401, 403}
+
+
+class TimeoutSession(requests.Session):
+    """ A requests Session whose requests time out after timeout (connect, read) seconds unless told otherwise. """
+
+    def __init__(self, timeout: Tuple[float, float]):
+        super().__init__()
+        self.timeout: Tuple[float, float] = timeout
+
+    def request(self, *args, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
 
 
 class ApiSession:
-    def __init__(self):
-        pass
+    """ A requests Session logged in to the NMRbox API.
+
+    The session cookies are cached on disk, so a repeated run doesn't need a new token. If the API rejects
+    a cached session, it is discarded, and the request is repeated after logging in again.
+
+    The requests time out after the api_connect_timeout and api_read_timeout settings. If a control is given,
+    logging in is cancelled along with it, as are the requests made through control.call(). """
+
+    def __init__(self, control: Optional[UploadControl] = None):
+        self.cache: DiskCache = DiskCache('login', configuration.get('login_cache_ttl', 0))
+        self.cached_login: bool = False
+        self.control: Optional[UploadControl] = control
 
     def __enter__(self) -> requests.Session:
-        self.session = requests.Session()
+        self.session = TimeoutSession((configuration.get('api_connect_timeout', 10),
+                                       configuration.get('api_read_timeout', 300)))
+        if tracing.enabled():
+            self.session.hooks['response'].append(tracing.trace_response)
+        self.session.hooks['response'].append(self._reauthenticate)
+
+        cookies = self.cache.get(configuration['api_root_url'])
+        if cookies:
+            self.session.cookies.update(cookies)
+            self.cached_login = True
+        elif self.control:
+            self.control.call(self.login)
+        else:
+            self.login()
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.session.close()
+
+    def login(self) -> None:
         try:
             url = f"{configuration['api_root_url']}/user/automatic-login"
             r = self.session.get(url, params={'token': get_token()})
             r.raise_for_status()
         except requests.exceptions.HTTPError as err:
             logging.exception("Encountered error when logging in using token: \n%s", err)
-        return self.session
+            return
+        self.cache.put(requests.utils.dict_from_cookiejar(self.session.cookies), configuration['api_root_url'])
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
+    def _reauthenticate(self, r, *args, **kwargs):
+        # response hook: replaces a response rejecting a cached login with that of a fresh attempt
+        if r.status_code not in AUTHENTICATION_ERRORS or not self.cached_login:
+            return None
+
+        logging.info("The cached login session was rejected, logging in again.")
+        self.cached_login = False
+        self.cache.invalidate(configuration['api_root_url'])
+        self.session.cookies.clear()
+        self.login()
+
+        request = r.request.copy()
+        request.headers.pop('Cookie', None)
+        request.prepare_cookies(self.session.cookies)
+        return self.session.send(request, **kwargs)
 
 
 def get_token() -> str:
     """ Gets a token to log in for the current user """
 
-    # get the session bus
-    bus = dbus.SystemBus()
-    # get the object
-    the_object = bus.get_object("org.nmrbox.notices", "/org/nmrbox/notices")
-    # get the interface
-    the_interface = dbus.Interface(the_object, "org.nmrbox.notices")
+    # dbus is only needed to log in, and the cached login session usually makes that unnecessary
+    import dbus
+
+    with tracing.span('get_token', 'dbus'):
+        # get the session bus
+        bus = dbus.SystemBus()
+        # get the object
+        the_object = bus.get_object("org.nmrbox.notices", "/org/nmrbox/notices")
+        # get the interface
+        the_interface = dbus.Interface(the_object, "org.nmrbox.notices")
 
-    # NOTE: calling login_token with a uid other than that of the calling process will result in an error
-    token = the_interface.login_token(os.getuid())
+        # NOTE: calling login_token with a uid other than that of the calling process will result in an error
+        token = the_interface.login_token(os.getuid())
     return token
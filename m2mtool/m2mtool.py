@@ -22,30 +22,55 @@
 #
 #
 
-import json
+import argparse
 import logging
 import os
 import sys
 import webbrowser
 
-import m2mtool.bmrbdep as bmrbdep
-import m2mtool.file_selector as file_selector
+from m2mtool import tracing
+from m2mtool.configuration import configuration
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from m2mtool.ratelimit import parse_rate
+from m2mtool.schedule import SCHEDULERS
 
 # Set up logging
 logging.basicConfig()
 
 
-def create_deposition(path) -> None:
+def open_session(manifest: UploadManifest) -> None:
+    logging.info("Loading existing session...")
+    webbrowser.open_new_tab(manifest.session_url)
+    sys.exit(0)
+
+
+def create_deposition(path, sync: bool = False) -> None:
     # If the sessions exists, re-open it
+    session_file = os.path.join(path, SESSION_FILE_NAME)
+    manifest = UploadManifest.load(session_file) if os.path.isfile(session_file) else None
+    if manifest and manifest.complete and not sync:
+        open_session(manifest)
 
-    session_file = os.path.join(path, '.bmrbdep_session')
-    if os.path.isfile(session_file):
-        logging.info("Loading existing session...")
-        session_info = json.loads(open(session_file, "r").read())
+    # The GUI is only imported when it is used, so neither the headless mode nor opening an existing session
+    # loads PyQt
+    import m2mtool.file_selector as file_selector
 
-        bmrbdep_session = bmrbdep.BMRBDepSession(sid=session_info['sid'])
-        webbrowser.open_new_tab(bmrbdep_session.session_url)
-        sys.exit(0)
+    if manifest:
+        # Bring the deposition up to date with the files now selected, if anything was added, changed or removed
+        if sync:
+            _, selected_files = file_selector.run_file_selector(path, manifest.nickname)
+            files = manifest.sync(selected_files)
+            manifest.save()
+            if manifest.complete:
+                logging.info("The deposition is up to date.")
+                open_session(manifest)
+            file_selector.run_progress_bar(path, manifest.nickname, files, session_file, manifest)
+            return
+
+        # If the upload was interrupted, upload whatever is missing or changed
+        logging.info("Resuming incomplete session...")
+        file_selector.run_progress_bar(path, manifest.nickname, manifest.pending_files(), session_file, manifest)
+        return
 
     # Run the file selector
     nickname, selected_files = file_selector.run_file_selector(path)
@@ -54,12 +79,88 @@ def create_deposition(path) -> None:
     file_selector.run_progress_bar(path, nickname, selected_files, session_file)
 
 
+def rate_argument(text: str) -> float:
+    try:
+        return parse_rate(text) or 0
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def parse_arguments(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='m2mtool', description='Deposit a folder of NMR data to BMRBdep.')
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help='The path to the folder that is being deposited. Several folders are deposited as a '
+                             'batch.')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without the GUI, reporting progress on stdout as one JSON object per line.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Update an existing deposition of the folder: upload the files which are new or '
+                             'changed since it was deposited, and delete those which were removed.')
+    parser.add_argument('--nickname',
+                        help='The deposition nickname (required for new headless depositions). A batch names each '
+                             'deposition after its folder, or the nickname given in the batch file, so this can '
+                             'only be given with a single path.')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='In headless mode, only upload files whose relative path matches this pattern. '
+                             'May be repeated.')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='In headless mode, skip files whose relative path matches this pattern. May be repeated.')
+    parser.add_argument('--batch', metavar='FILE', action='append', default=[],
+                        help='Deposit every folder listed in FILE (one per line, optionally followed by a tab and '
+                             'the nickname, or a JSON list) as a batch, without the GUI. May be repeated.')
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help='The number of folders of a batch deposited at once (batch_jobs in config.json).')
+    parser.add_argument('--max-connections', type=int, metavar='N',
+                        help='The most upload connections all the folders of a batch may use at once '
+                             '(batch_max_connections in config.json).')
+    parser.add_argument('--rate-limit', type=rate_argument, metavar='RATE',
+                        help='Limit the upload bandwidth to this many bytes per second, such as 500K or 2M '
+                             '(overrides upload_rate_limit in config.json). It can be changed from the progress '
+                             'window.')
+    parser.add_argument('--schedule', choices=sorted(SCHEDULERS),
+                        help='The order the files are uploaded in (upload_schedule in config.json): interleaved '
+                             'sends the NMR-STAR files and peak lists first, then large files alongside small '
+                             'ones; lpt the largest first; fifo in the order they were selected.')
+    parser.add_argument('--trace', metavar='FILE', default=os.environ.get(tracing.TRACE_VARIABLE),
+                        help='Record how long each phase of the deposition, directory scan and request takes, and '
+                             'write it to FILE as a trace for chrome://tracing or ui.perfetto.dev (or set '
+                             f'{tracing.TRACE_VARIABLE}).')
+    parser.add_argument('--profile', metavar='FILE', default=os.environ.get(tracing.PROFILE_VARIABLE),
+                        help='Profile the deposition (and its upload threads) with cProfile, and write the '
+                             f'statistics to FILE (or set {tracing.PROFILE_VARIABLE}).')
+    args = parser.parse_args(argv)
+    if not args.paths and not args.batch:
+        parser.error('a path (or --batch) is required')
+    if args.nickname and len(args.paths) > 1:
+        parser.error('--nickname can only be given with a single path; the depositions of a batch are named after '
+                     'their folders, or the nicknames in a --batch file')
+    return args
+
+
 # Run the code in this module
 def run_m2mtool():
-    if len(sys.argv) != 2:
-        raise ValueError('Please supply the path to the folder that is being deposited.')
+    # report progress at the INFO level, as when pynmrstar (which sets it on import) was used to read the metadata
+    logging.getLogger().setLevel(logging.INFO)
+    args = parse_arguments()
+    if args.rate_limit is not None:
+        configuration['upload_rate_limit'] = args.rate_limit or None
+    if args.schedule:
+        configuration['upload_schedule'] = args.schedule
+    tracing.start(args.trace, args.profile)
+    # the upload modules (and requests) are only imported by the modes which upload, so opening an existing
+    # deposition starts quickly
     try:
-        create_deposition(sys.argv[1])
+        if args.batch or len(args.paths) > 1:
+            from m2mtool.batch import read_directory_list, run_batch
+            # batches run in worker processes, which can't show the GUI
+            directories = [(path, args.nickname) for path in args.paths]
+            for list_file in args.batch:
+                directories.extend(read_directory_list(list_file))
+            sys.exit(run_batch(directories, args.jobs, args.max_connections, args.include, args.exclude, args.sync))
+        if args.headless:
+            from m2mtool.cli import run_headless
+            sys.exit(run_headless(args.paths[0], args.nickname, args.include, args.exclude, sync=args.sync))
+        create_deposition(args.paths[0], args.sync)
     except Exception as err:
         logging.critical(str(err))
         raise err
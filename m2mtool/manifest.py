@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from m2mtool.configuration import configuration
+from m2mtool.selection import FileSelection
+from m2mtool.telemetry import TELEMETRY_FILE_SUFFIX
+
+# Set up logging
+logging.basicConfig()
+
+# The name of the file, in the deposited directory, which holds the manifest
+SESSION_FILE_NAME = '.bmrbdep_session'
+# The file the changes made to the manifest since it was last written are appended to
+JOURNAL_SUFFIX = '.journal'
+# The files m2mtool writes to the deposited directory itself (the manifest, its copy while it is saved, its
+# journal, and the telemetry of the last run), which are never uploaded
+SESSION_FILES = {SESSION_FILE_NAME, f'{SESSION_FILE_NAME}.tmp', SESSION_FILE_NAME + JOURNAL_SUFFIX,
+                 SESSION_FILE_NAME + TELEMETRY_FILE_SUFFIX}
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+# deposited, but removed locally since, so to be deleted from the deposition
+REMOVED = 'removed'
+
+# The upload states as they are stored, one byte per file; a file which was forgotten keeps its position
+_STATES = (PENDING, UPLOADED, REMOVED)
+_CODES = {state: code for code, state in enumerate(_STATES)}
+_FORGOTTEN = 255
+# The size of the digests (of m2mtool.hashing.DIGEST_ALGORITHM) stored, in bytes; zeros stand for none
+_DIGEST_SIZE = 32
+_NO_DIGEST = bytes(_DIGEST_SIZE)
+# The version of the session file written by save(), which holds a header line, then a line for each file
+_FORMAT = 2
+
+
+class Journal:
+    """ An append-only file of changes, one JSON object per line.
+
+    append() only queues a change: a background thread writes the changes queued meanwhile together, and
+    fsyncs them, at most every interval seconds, so the thread making the changes never waits for the disk.
+    The thread exits once there is nothing left to write. flush() waits until every change appended so far
+    is on disk. A failure to write is logged, and the changes are dropped, rather than failing the caller. """
+
+    def __init__(self, path: str, interval: float = 1.0):
+        self.path: str = path
+        self.interval: float = interval
+        self._lines: List[str] = []
+        self._appended: int = 0
+        self._written: int = 0
+        self._flushing: bool = False
+        self._thread: Optional[threading.Thread] = None
+        self._condition = threading.Condition()
+
+    def append(self, change: dict) -> None:
+        with self._condition:
+            self._lines.append(json.dumps(change))
+            self._appended += 1
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='m2mtool-journal')
+                self._thread.start()
+
+    def flush(self) -> None:
+        """ Waits until the changes appended so far are written. """
+
+        with self._condition:
+            appended = self._appended
+            self._flushing = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._written >= appended)
+            self._flushing = False
+
+    def clear(self) -> None:
+        """ Removes the journal file, once the changes in it were saved elsewhere. """
+
+        self.flush()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def read(path: str) -> Iterator[dict]:
+        """ Yields the changes in the journal file at path, if there is one. A line left incomplete by an
+        interrupted write ends it. """
+
+        try:
+            journal = open(path, 'r')
+        except FileNotFoundError:
+            return
+        with journal:
+            for line in journal:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                # changes made within interval of each other are written together, unless they are waited for
+                self._condition.wait_for(lambda: self._flushing, self.interval)
+                lines, self._lines = self._lines, []
+                if not lines:
+                    self._thread = None
+                    return
+            try:
+                with open(self.path, 'a') as journal:
+                    journal.write(''.join(line + '\n' for line in lines))
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            except OSError as err:
+                logging.warning("Could not write the upload journal '%s': %s", self.path, err)
+            with self._condition:
+                self._written += len(lines)
+                self._condition.notify_all()
+
+
+class UploadManifest:
+    """ The journal of a deposition, stored in the SESSION_FILE_NAME file of the deposited directory.
+
+    Besides the session ID, it records the size, modification time, digest and upload state of every
+    selected file. If an upload is interrupted, a later run can reopen the session and upload only the files
+    which are missing or have changed since, and a sync of a finished deposition does the same for the files
+    added, changed or removed since.
+
+    The session file holds a snapshot of the manifest, written by save(). The files uploaded or forgotten
+    since are appended to a Journal next to it as they are, so recording an upload doesn't rewrite the whole
+    manifest; loading the manifest replays the journal, and save() folds it into the snapshot. """
+
+    # Write the changes to the journal at most this often while uploading (in seconds)
+    journal_interval = 1.0
+
+    def __init__(self, session_file: str, sid: str, nickname: str = None, ctime: float = None,
+                 complete: bool = False):
+        self.session_file: str = session_file
+        self.sid: str = sid
+        self.nickname: str = nickname
+        self.ctime: float = ctime if ctime is not None else time.time()
+        self.complete: bool = complete
+        # the files, by position: their paths, and the sizes and modification times they had when they were
+        # recorded, and alongside those the digest of their uploaded contents and their upload state
+        self.selection: FileSelection = FileSelection()
+        self.states: bytearray = bytearray()
+        self._digests: bytearray = bytearray()
+        self.journal: Journal = Journal(session_file + JOURNAL_SUFFIX, self.journal_interval)
+        # the digests of the current contents of the files hashed to tell whether they changed, which the upload
+        # reuses rather than hashing them again
+        self.digests: Dict[str, str] = {}
+
+    @classmethod
+    def load(cls, session_file: str) -> 'UploadManifest':
+        """ Loads the manifest from a session file.
+
+        Session files written before the journal existed only hold a sid and a ctime, and are treated
+        as complete depositions. Those written before the files were stored a line each hold them all in
+        one object. """
+
+        with open(session_file, 'r') as session_log:
+            session_info = json.loads(session_log.readline())
+            manifest = cls(session_file, session_info['sid'],
+                           nickname=session_info.get('nickname'),
+                           ctime=session_info.get('ctime'),
+                           complete=session_info.get('complete', True))
+            if session_info.get('format') is None:
+                for file_name, record in session_info.get('files', {}).items():
+                    manifest._set(file_name, record)
+            else:
+                for line in session_log:
+                    file_name, size, mtime, digest, state = json.loads(line)
+                    manifest._set(file_name, {'size': size, 'mtime': mtime, 'digest': digest, 'state': state})
+
+        # replay the changes made since the snapshot was written, and fold them into it
+        replayed = 0
+        for change in Journal.read(manifest.journal.path):
+            file_name = change.pop('file')
+            if change.get('forget'):
+                manifest.forget(file_name, journal=False)
+            else:
+                manifest._set(file_name, change)
+            replayed += 1
+        if replayed:
+            manifest.save()
+        return manifest
+
+    @property
+    def directory(self) -> str:
+        return os.path.dirname(self.session_file)
+
+    @property
+    def session_url(self) -> str:
+        # as BMRBDepSession.session_url; opening it is all some runs do, so they don't import requests for it
+        return f"{configuration['bmrbdep_root_url']}/entry/load/{self.sid}"
+
+    def __len__(self) -> int:
+        return len(self.states) - self.states.count(_FORGOTTEN)
+
+    def save(self) -> None:
+        """ Writes a snapshot of the manifest to disk atomically, replacing the journal. The files are written
+        a line at a time, rather than building the whole snapshot in memory. """
+
+        header = {'sid': self.sid, 'ctime': self.ctime, 'nickname': self.nickname, 'complete': self.complete,
+                  'format': _FORMAT}
+        temp_file = f'{self.session_file}.tmp'
+        with open(temp_file, 'w') as session_log:
+            session_log.write(json.dumps(header) + '\n')
+            for position, (file_name, size, mtime) in enumerate(self.selection.records()):
+                if self.states[position] != _FORGOTTEN:
+                    session_log.write(json.dumps([file_name, size, mtime, self._digest(position),
+                                                  _STATES[self.states[position]]]) + '\n')
+        os.replace(temp_file, self.session_file)
+        self.journal.clear()
+
+    def flush(self) -> None:
+        """ Waits until the changes journaled so far are on disk. """
+        self.journal.flush()
+
+    def record(self, file_name: str) -> Optional[dict]:
+        """ Returns the size, modification time, digest and upload state recorded for a file, or None if it
+        isn't in the manifest. """
+
+        position = self._position(file_name)
+        if position < 0:
+            return None
+        return {'size': self.selection.sizes[position], 'mtime': self.selection.mtimes[position],
+                'digest': self._digest(position), 'state': _STATES[self.states[position]]}
+
+    def records(self) -> Iterator[Tuple[str, dict]]:
+        """ Yields each file in the manifest with its record (see record()). """
+
+        for position, file_name in enumerate(self.selection):
+            if self.states[position] != _FORGOTTEN:
+                yield file_name, self.record(file_name)
+
+    def add_files(self, files: Iterable[str], digests: Optional[Dict[str, str]] = None) -> None:
+        """ Records the files selected for upload as pending, along with their digests if known. The sizes and
+        modification times recorded in a FileSelection are used rather than reading them again. """
+
+        digests = digests or {}
+        # the files of a new manifest are appended without looking them up
+        position = -1 if not self.states else None
+        for file_name, size, mtime in FileSelection.from_paths(files).records(self.directory):
+            self._set(file_name, {'size': size, 'mtime': mtime, 'digest': digests.get(file_name), 'state': PENDING},
+                      position)
+
+    def mark_uploaded(self, file_name: str, digest: Optional[str]) -> None:
+        """ Records that a file was uploaded, along with the digest of the uploaded contents. """
+
+        if self._position(file_name) < 0:
+            raise KeyError(file_name)
+        stat = os.stat(os.path.join(self.directory, file_name))
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest, 'state': UPLOADED}
+        self._set(file_name, record)
+        self.journal.append({'file': file_name, **record})
+
+    def pending_files(self) -> FileSelection:
+        """ Returns the files which still need to be uploaded: those which were never uploaded, and those
+        whose contents changed since they were. A file which was only touched (same size and digest, but a
+        new modification time) is not uploaded again. """
+
+        def records() -> Iterator[Tuple[str, int, float]]:
+            for position, file_name in enumerate(self.selection):
+                if self.states[position] in (_CODES[REMOVED], _FORGOTTEN):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, file_name))
+                except OSError:
+                    logging.warning("File '%s' no longer exists and will not be uploaded.", file_name)
+                    continue
+                yield file_name, stat.st_size, stat.st_mtime
+
+        return self._changed_files(records())
+
+    def sync(self, selection: FileSelection) -> FileSelection:
+        """ Compares the files selected in the deposited directory with the deposited ones, and returns those
+        which are new or changed. Deposited files which no longer exist in the directory are marked to be
+        deleted from the deposition (see removed_files()). If anything has to be uploaded or deleted, the
+        deposition is marked as incomplete until it is. """
+
+        # the deposited files the selection holds are flagged as it is compared, by their positions
+        selected = bytearray(len(self.states))
+        changed = self._changed_files(selection.records(self.directory), selected)
+        removed = 0
+        for position, file_name in enumerate(self.selection):
+            if position >= len(selected):
+                break
+            if selected[position] or self.states[position] in (_CODES[REMOVED], _FORGOTTEN):
+                continue
+            if not os.path.lexists(os.path.join(self.directory, file_name)):
+                self.states[position] = _CODES[REMOVED]
+                removed += 1
+
+        logging.info("Sync: %d new or changed files to upload, %d removed files to delete.", len(changed), removed)
+        if changed or removed:
+            self.complete = False
+        return changed
+
+    def removed_files(self) -> List[str]:
+        """ Returns the deposited files which were removed locally, and still have to be deleted from the
+        deposition. """
+        return [self.selection[position] for position, state in enumerate(self.states) if state == _CODES[REMOVED]]
+
+    def forget(self, file_name: str, journal: bool = True) -> None:
+        """ Drops a file which was deleted from the deposition. """
+
+        position = self._position(file_name)
+        if position >= 0:
+            self.states[position] = _FORGOTTEN
+        if journal:
+            self.journal.append({'file': file_name, 'forget': True})
+
+    def _position(self, file_name: str) -> int:
+        # the position of a file which is in the manifest (and wasn't forgotten), or -1
+        position = self.selection.position(file_name)
+        if position >= 0 and self.states[position] == _FORGOTTEN:
+            return -1
+        return position
+
+    def _digest(self, position: int) -> Optional[str]:
+        digest = self._digests[position * _DIGEST_SIZE:(position + 1) * _DIGEST_SIZE]
+        return digest.hex() if digest != _NO_DIGEST else None
+
+    def _set(self, file_name: str, record: dict, position: int = None) -> int:
+        # records a file, adding it if it isn't in the manifest yet, and returns its position; a record without
+        # a digest keeps the one recorded before
+        digest = bytes.fromhex(record['digest']) if record.get('digest') else _NO_DIGEST
+        if len(digest) != _DIGEST_SIZE:
+            raise ValueError(f"Invalid digest '{record['digest']}' of '{file_name}'.")
+        if position is None:
+            position = self.selection.position(file_name)
+        if position < 0:
+            self.selection.add(file_name, record['size'], record['mtime'])
+            self.states.append(_CODES[record['state']])
+            self._digests += digest
+            return len(self.states) - 1
+
+        if 'digest' in record or self.states[position] == _FORGOTTEN:
+            self._digests[position * _DIGEST_SIZE:(position + 1) * _DIGEST_SIZE] = digest
+        self.selection.sizes[position] = record['size']
+        self.selection.mtimes[position] = record['mtime']
+        self.states[position] = _CODES[record['state']]
+        return position
+
+    def _changed_files(self, files: Iterable[Tuple[str, int, float]], selected: Optional[bytearray] = None) \
+            -> FileSelection:
+        """ Returns the given (file_name, size, mtime) whose contents are not known to be uploaded, and records
+        them as pending (adding the files which are new to the manifest). If selected is given, the byte of
+        each file which was in the manifest is set in it.
+
+        A file with the size and modification time recorded when it was uploaded is taken as unchanged. Files
+        which only differ in their modification time are hashed (in parallel) and compared with the digest of
+        the uploaded contents, so a file which was only touched is not uploaded again. A file which can't be
+        hashed is taken as changed. """
+
+        from m2mtool.hashing import file_digest, hash_files_async
+
+        changed = FileSelection()
+        # the positions, sizes and modification times of the files which were only touched
+        touched: Dict[str, Tuple[int, int, float]] = {}
+        sizes, mtimes, uploaded = self.selection.sizes, self.selection.mtimes, _CODES[UPLOADED]
+        for file_name, size, mtime in files:
+            position = self._position(file_name)
+            if 0 <= position < len(selected or ()):
+                selected[position] = 1
+            if position >= 0 and self.states[position] == uploaded and sizes[position] == size:
+                if mtimes[position] == mtime:
+                    continue
+                if self._digest(position):
+                    touched[file_name] = (position, size, mtime)
+                    continue
+            self._set(file_name, {'size': size, 'mtime': mtime, 'state': PENDING}, position if position >= 0 else None)
+            changed.add(file_name, size, mtime)
+
+        futures = hash_files_async(self.directory, touched)
+        try:
+            for file_name, future in futures.items():
+                position, size, mtime = touched[file_name]
+                try:
+                    digest = future.result()
+                except OSError as err:
+                    logging.warning("Could not hash '%s': %s", file_name, err)
+                    digest = None
+                except Exception as err:
+                    # the hashing processes failed (a BrokenProcessPool, say), so this one hashes the rest
+                    logging.warning("Hashing '%s' in a worker process failed, hashing it here: %s", file_name, err)
+                    try:
+                        digest = file_digest(os.path.join(self.directory, file_name))
+                    except OSError:
+                        digest = None
+                if digest and digest == self._digest(position):
+                    mtimes[position] = mtime
+                    continue
+                if digest:
+                    self.digests[file_name] = digest
+                self._set(file_name, {'size': size, 'mtime': mtime, 'state': PENDING}, position)
+                changed.add(file_name, size, mtime)
+        finally:
+            futures.cancel()
+            futures.join()
+        return changed
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import io
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# The tag holding the email address the deposition is registered to
+EMAIL_TAG = '_Contact_person.Email_address'
+
+# NMR-STAR tokens: comments, semicolon delimited (multi-line) values, quoted values and bare words
+_TOKEN = re.compile(r"""
+      (?P<comment>\#[^\n]*)
+    | ^;(?P<semicolon>[\s\S]*?\n);(?=\s|$)
+    | '(?P<single>[^\n]*?)'(?=\s|$)
+    | "(?P<double>[^\n]*?)"(?=\s|$)
+    | (?P<bare>\S+)
+""", re.MULTILINE | re.VERBOSE)
+
+
+class DepositionMetadata:
+    """ The NMR-STAR metadata NMRbox generates for a deposition, and the values of the tags m2mtool needs
+    from it.
+
+    The text is read once: the tags are picked out in a single scan (which stops as soon as they have all
+    been found) rather than by building a full pynmrstar Entry, and the NMR-STAR file sent to BMRBdep is an
+    in-memory buffer rather than a temporary file. """
+
+    def __init__(self, text: str, tags: Iterable[str] = (EMAIL_TAG,)):
+        self.content: bytes = text.encode()
+        self.tags: Dict[str, Optional[str]] = find_tags(text, tags)
+
+    @property
+    def user_email(self) -> str:
+        email = self.tags.get(EMAIL_TAG)
+        if not email:
+            raise ValueError('The deposition metadata does not include a contact email address.')
+        return email
+
+    @property
+    def nmrstar_file(self) -> io.BytesIO:
+        """ Returns a new file object holding the NMR-STAR text, to be uploaded with the deposition. """
+        return io.BytesIO(self.content)
+
+
+def _tokens(text: str) -> Iterator[Tuple[str, bool]]:
+    """ Yields the tokens of NMR-STAR text, along with whether each one is a (quoted) value. As in pynmrstar,
+    a semicolon delimited value keeps the line break before its closing semicolon. """
+
+    for match in _TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        value = match.group(kind)
+        if kind == 'semicolon' and value.startswith('\n'):
+            value = value[1:]
+        yield value, kind != 'bare'
+
+
+def find_tags(text: str, tags: Iterable[str]) -> Dict[str, Optional[str]]:
+    """ Returns the first value of each of the tags (in saveframes or loops) in NMR-STAR text, or None for
+    tags which are missing or only have null values ('.' or '?'). Tag names are matched case insensitively. """
+
+    wanted = {tag.lower(): tag for tag in tags}
+    found: Dict[str, Optional[str]] = {tag: None for tag in wanted.values()}
+
+    def store(tag: str, value: str, quoted: bool) -> None:
+        tag = wanted.pop(tag.lower(), None)
+        if tag and (quoted or value not in ('.', '?')):
+            found[tag] = value
+        elif tag:
+            # a null value; a later row of a loop may still have one
+            wanted[tag.lower()] = tag
+
+    # outside of loops, a tag is followed by its value; a loop lists its tags, then the values row by row
+    pending_tag: Optional[str] = None
+    loop_tags: List[str] = []
+    loop_mode: Optional[str] = None
+    column = 0
+    for token, quoted in _tokens(text):
+        if not wanted:
+            break
+        keyword = None if quoted else token.lower()
+        if keyword == 'loop_':
+            loop_mode, loop_tags, column, pending_tag = 'tags', [], 0, None
+            continue
+        if loop_mode == 'tags':
+            if keyword and token.startswith('_'):
+                loop_tags.append(token)
+                continue
+            loop_mode = 'values' if loop_tags else None
+        if loop_mode == 'values':
+            if keyword == 'stop_':
+                loop_mode = None
+            else:
+                store(loop_tags[column], token, quoted)
+                column = (column + 1) % len(loop_tags)
+            continue
+
+        if pending_tag:
+            store(pending_tag, token, quoted)
+            pending_tag = None
+        elif keyword and token.startswith('_'):
+            pending_tag = token
+    return found
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import socket
+import ssl
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from m2mtool.control import UploadControl
+from m2mtool.hashing import new_digest
+from m2mtool.ratelimit import TokenBucket
+
+
+def _quote(value: str) -> str:
+    """ Escapes a header parameter value the way browsers do for multipart/form-data. """
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _preamble(boundary: str, field_name: str, file_name: str, fields: Optional[Dict[str, str]]) -> bytes:
+    """ Returns the multipart body which precedes the file contents: any plain fields, then the file headers. """
+
+    preamble = b''
+    for name, value in (fields or {}).items():
+        preamble += (f'--{boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'
+                     f'{value}\r\n').encode()
+    preamble += (f'--{boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{_quote(field_name)}"; filename="{_quote(file_name)}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return preamble
+
+
+def multipart_stream(field_name: str, file_name: str, chunks: Iterable[bytes],
+                     fields: Optional[Dict[str, str]] = None) -> Tuple[str, Iterator[bytes]]:
+    """ Returns the content type and a generator of a multipart/form-data body whose file contents are
+    produced on the fly by chunks. As the length isn't known in advance, requests sends it chunked. """
+
+    boundary = uuid.uuid4().hex
+
+    def body() -> Iterator[bytes]:
+        yield _preamble(boundary, field_name, file_name, fields)
+        for chunk in chunks:
+            # an empty chunk would end a chunked request early
+            if chunk:
+                yield chunk
+        yield f'\r\n--{boundary}--\r\n'.encode()
+
+    return f'multipart/form-data; boundary={boundary}', body()
+
+
+class MultipartFileEncoder(io.RawIOBase):
+    """ A read-only multipart/form-data body which streams one file from disk.
+
+    The file is read in fixed-size chunks as the body is sent, so memory use does not depend on the size
+    of the file. The encoder supports tell() and seek() so that urllib3 can rewind it when a request is
+    retried. The callback, if given, is called with the number of file bytes sent since the last call
+    (negative if the body was rewound). The digest of the file contents is computed as they are sent. If a
+    rate_limiter is given, every read waits for it, which paces the whole body. If a control is given, every
+    read is a checkpoint of it, so the upload can be paused or cancelled between chunks. """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, field_name: str, file_name: str, path: str, fields: Optional[Dict[str, str]] = None,
+                 callback: Optional[Callable[[int], None]] = None, rate_limiter: Optional[TokenBucket] = None,
+                 control: Optional[UploadControl] = None):
+        super().__init__()
+        self.boundary: str = uuid.uuid4().hex
+        self.callback: Optional[Callable[[int], None]] = callback
+        self.rate_limiter: Optional[TokenBucket] = rate_limiter
+        self.control: Optional[UploadControl] = control
+
+        self._preamble: bytes = _preamble(self.boundary, field_name, file_name, fields)
+        self._epilogue: bytes = f'\r\n--{self.boundary}--\r\n'.encode()
+
+        self._file = open(path, 'rb')
+        self.file_size: int = os.fstat(self._file.fileno()).st_size
+        self.len: int = len(self._preamble) + self.file_size + len(self._epilogue)
+        self._position: int = 0
+        self._digest = new_digest()
+        self._digest_offset: int = 0
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def hexdigest(self) -> Optional[str]:
+        """ The digest of the file contents, or None if the file has not been sent in full. """
+        if self._digest_offset != self.file_size:
+            return None
+        return self._digest.hexdigest()
+
+    @property
+    def sent_file_bytes(self) -> int:
+        """ The number of bytes of the file which have been read into the body so far. """
+        return self._file_offset(self._position)
+
+    def __len__(self) -> int:
+        return self.len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def _file_offset(self, position: int) -> int:
+        return min(max(position - len(self._preamble), 0), self.file_size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.len
+        position = min(max(offset, 0), self.len)
+
+        sent_delta = self._file_offset(position) - self._file_offset(self._position)
+        self._position = position
+        if self._file_offset(position) < self._digest_offset:
+            # the body was rewound, so the file contents will be hashed again as they are resent
+            self._digest = new_digest()
+            self._digest_offset = 0
+        if sent_delta and self.callback:
+            self.callback(sent_delta)
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            raise ValueError('I/O operation on closed multipart body.')
+        if self.control:
+            self.control.checkpoint()
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+
+        start = self._position
+        preamble_end = len(self._preamble)
+        file_end = preamble_end + self.file_size
+
+        if start < preamble_end:
+            chunk = self._preamble[start:start + size]
+        elif start < file_end:
+            self._file.seek(start - preamble_end)
+            chunk = self._file.read(min(size, file_end - start))
+            if not chunk:
+                raise IOError(f'File {self._file.name} was truncated while it was being uploaded.')
+            self._hash(start - preamble_end, chunk)
+            if self.callback:
+                self.callback(len(chunk))
+        else:
+            chunk = self._epilogue[start - file_end:start - file_end + size]
+
+        if self.rate_limiter:
+            self.rate_limiter.consume(len(chunk), self.control)
+        self._position += len(chunk)
+        return chunk
+
+    def _hash(self, file_offset: int, data) -> None:
+        # hashes the file contents read from file_offset, if they continue those hashed so far
+        if file_offset == self._digest_offset:
+            self._digest.update(data)
+            self._digest_offset += len(data)
+
+    def readinto(self, buffer) -> int:
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self) -> None:
+        """ Closes the underlying file. """
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class ZeroCopyFileEncoder(MultipartFileEncoder):
+    """ A MultipartFileEncoder which a ZeroCopyAdapter connection writes straight to its socket, so only the
+    multipart headers are copied through Python.
+
+    On a plain socket the file contents go with socket.sendfile(), so they never leave the kernel. On a TLS
+    socket, which sendfile() can't write to, they are read into one reusable buffer and sent as views of it,
+    in large chunks rather than http.client's 8 KiB blocks. The contents are still hashed as they are sent:
+    each chunk sendfile() sent is read back with pread(), from the page cache it was just sent from. Read
+    through read() (as it is by any other connection, or when urllib3 can't use send_to()), it is a
+    MultipartFileEncoder. """
+
+    send_chunk_size = 1024 * 1024
+
+    def send_to(self, sock: socket.socket) -> None:
+        """ Sends the rest of the body, from the current position, to the connected socket. """
+
+        preamble_end = len(self._preamble)
+        file_end = preamble_end + self.file_size
+        if self._position < preamble_end:
+            self._send_bytes(sock, self._preamble[self._position:])
+        if self._position < file_end:
+            if isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket):
+                self._send_file(sock, file_end)
+            else:
+                # TLS (including pyOpenSSL's sockets) has to encrypt the contents in user space
+                self._send_buffered(sock, file_end)
+        if self._position < self.len:
+            self._send_bytes(sock, self._epilogue[self._position - file_end:])
+
+    def _send_bytes(self, sock: socket.socket, data: bytes) -> None:
+        if self.control:
+            self.control.checkpoint()
+        if self.rate_limiter:
+            self.rate_limiter.consume(len(data), self.control)
+        sock.sendall(data)
+        self._position += len(data)
+
+    def _chunk_size(self) -> int:
+        # a rate limited chunk is no larger than the limiter's bucket, so sending it doesn't leave a debt which
+        # holds up the next chunk (and a cancel) for longer than the bucket takes to fill
+        if self.rate_limiter and self.rate_limiter.rate:
+            return max(1, min(self.send_chunk_size, int(self.rate_limiter.burst)))
+        return self.send_chunk_size
+
+    def _sent_file_bytes(self, count: int) -> None:
+        self._position += count
+        if self.callback:
+            self.callback(count)
+
+    def _send_file(self, sock: socket.socket, file_end: int) -> None:
+        # the kernel copies the file to the socket; socket.sendfile() itself falls back to send() if it must
+        while self._position < file_end:
+            if self.control:
+                self.control.checkpoint()
+            count = min(self._chunk_size(), file_end - self._position)
+            if self.rate_limiter:
+                self.rate_limiter.consume(count, self.control)
+            file_offset = self._position - len(self._preamble)
+            sent = sock.sendfile(self._file, file_offset, count)
+            if not sent:
+                raise IOError(f'File {self._file.name} was truncated while it was being uploaded.')
+            if file_offset == self._digest_offset:
+                self._hash(file_offset, os.pread(self._file.fileno(), sent, file_offset))
+            self._sent_file_bytes(sent)
+
+    def _send_buffered(self, sock: socket.socket, file_end: int) -> None:
+        buffer = bytearray(min(self.send_chunk_size, file_end - self._position))
+        with memoryview(buffer) as view:
+            self._file.seek(self._position - len(self._preamble))
+            while self._position < file_end:
+                if self.control:
+                    self.control.checkpoint()
+                count = self._file.readinto(view[:min(self._chunk_size(), file_end - self._position)])
+                if not count:
+                    raise IOError(f'File {self._file.name} was truncated while it was being uploaded.')
+                if self.rate_limiter:
+                    self.rate_limiter.consume(count, self.control)
+                sock.sendall(view[:count])
+                self._hash(self._position - len(self._preamble), view[:count])
+                self._sent_file_bytes(count)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import re
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+from m2mtool.control import UploadControl
+
+# A byte rate, such as 500K or 2.5M (per second); the suffixes are binary multiples
+_RATE = re.compile(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([kmgt]?)i?b?(?:/s)?\s*$', re.IGNORECASE)
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_rate(text: str) -> Optional[float]:
+    """ Returns the bytes per second given by text such as '500K', '2.5M' or '1G/s', or None for '0' or
+    'unlimited'. """
+
+    if text.strip().lower() in ('unlimited', 'none', 'off'):
+        return None
+    match = _RATE.match(text)
+    if not match:
+        raise ValueError(f"Invalid rate '{text}', expected a number of bytes per second such as 500K or 2M.")
+    rate = float(match.group(1)) * _UNITS[match.group(2).lower()]
+    return rate or None
+
+
+class TokenBucket:
+    """ Limits the rate at which bytes are sent, across every thread sharing the bucket.
+
+    Tokens (bytes) accumulate at rate per second, up to burst_seconds worth of them (and at least
+    min_burst). consume() blocks until there are tokens for the bytes about to be sent; a chunk larger
+    than the bucket is let through once it is full, and the debt is paid off by whoever sends next. The
+    rate can be changed at any time with set_rate(), which also wakes the threads waiting for the old
+    one. A rate of None (or 0) means no limit. """
+
+    # How many seconds of sending the bucket can save up
+    burst_seconds = 0.5
+    # The smallest bucket, so that a low rate doesn't split every chunk into several waits
+    min_burst = 64 * 1024
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate: Optional[float] = None
+        self.tokens: float = 0
+        self.updated: float = time.monotonic()
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self.set_rate(rate)
+
+    @property
+    def burst(self) -> float:
+        return max(self.rate * self.burst_seconds, self.min_burst) if self.rate else 0
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        """ Changes the limit, in bytes per second (None or 0 for none). """
+
+        with self._condition:
+            self._refill()
+            self.rate = float(rate) if rate else None
+            # start full, and don't carry over savings (or a debt) larger than the new bucket
+            self.tokens = self.burst if self.rate else 0
+            self._condition.notify_all()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: int, control: Optional[UploadControl] = None) -> None:
+        """ Waits until amount bytes may be sent. If a control is given, the wait stops (raising UploadCancelled)
+        once the uploads are cancelled. """
+
+        if not self.rate or amount <= 0:
+            return
+        start = time.monotonic()
+        with self._condition:
+            while self.rate:
+                self._refill()
+                needed = min(amount, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    break
+                if control:
+                    control.wait(self._condition, (needed - self.tokens) / self.rate)
+                else:
+                    self._condition.wait((needed - self.tokens) / self.rate)
+        self._local.waited = self.waited() + time.monotonic() - start
+
+    def waited(self) -> float:
+        """ Returns how many seconds the calling thread has spent waiting in consume(). """
+        return getattr(self._local, 'waited', 0.0)
+
+    def limit(self, chunks: Iterable[bytes], control: Optional[UploadControl] = None) -> Iterator[bytes]:
+        """ Yields the chunks, no faster than the rate allows (until the uploads are cancelled, with a control). """
+
+        for chunk in chunks:
+            self.consume(len(chunk), control)
+            yield chunk
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import abc
+import heapq
+from array import array
+from typing import Dict, List, Sequence, Tuple, Type
+
+# The upload categories of the files which make a deposition usable in BMRBdep (the NMR-STAR files holding
+# the assigned chemical shifts, and the peak lists), which are sent before the others
+CRITICAL_CATEGORIES = {'upload_category_1', 'upload_category_18'}
+
+
+class UploadScheduler(abc.ABC):
+    """ Decides the order in which the files of a deposition are uploaded.
+
+    The upload workers take the files in this order, each starting the next one as soon as it is free, so
+    the order also decides which files are sent at the same time. A policy implements order(); they are
+    registered by name in SCHEDULERS, and chosen with the upload_schedule setting.
+
+    The files are handled by their positions in the selection, and the order is an array of those, so
+    scheduling doesn't build an object per file. """
+
+    name = None
+
+    def __init__(self, concurrency: int = 1):
+        self.concurrency: int = max(1, int(concurrency))
+
+    @staticmethod
+    def is_critical(file_name: str, categories: Dict[str, str]) -> bool:
+        return categories.get(file_name) in CRITICAL_CATEGORIES
+
+    @abc.abstractmethod
+    def order(self, files: Sequence[str], sizes: Sequence[int], categories: Dict[str, str]) -> array:
+        """ Returns the positions of the files (the paths, in the order they were selected, with sizes holding
+        the size of each) in the order to upload them. categories holds the upload category of the files whose
+        type is known. """
+
+    def critical_first(self, files: Sequence[str], sizes: Sequence[int], categories: Dict[str, str]) \
+            -> Tuple[array, array]:
+        # splits the files into the critical ones (smallest first, so most are usable soonest) and the others
+        critical, others = array('I'), array('I')
+        for position, file_name in enumerate(files):
+            (critical if self.is_critical(file_name, categories) else others).append(position)
+        return array('I', sorted(critical, key=sizes.__getitem__)), others
+
+
+class FifoScheduler(UploadScheduler):
+    """ Uploads the files in the order they were selected. """
+
+    name = 'fifo'
+
+    def order(self, files: Sequence[str], sizes: Sequence[int], categories: Dict[str, str]) -> array:
+        return array('I', range(len(sizes)))
+
+
+class LongestFirstScheduler(UploadScheduler):
+    """ Uploads the critical files, then the others largest first (LPT), so that no large file is left
+    to be sent on its own at the end. """
+
+    name = 'lpt'
+
+    def order(self, files: Sequence[str], sizes: Sequence[int], categories: Dict[str, str]) -> array:
+        critical, others = self.critical_first(files, sizes, categories)
+        critical.extend(sorted(others, key=sizes.__getitem__, reverse=True))
+        return critical
+
+
+class InterleavedScheduler(UploadScheduler):
+    """ Uploads the critical files, then interleaves the large files with the small ones.
+
+    The large files (large_file_size bytes or more, such as time-domain data) are started as early as
+    possible, largest first, but at most half of the workers send one at a time; the other workers get
+    through the small files, whose time is mostly spent waiting for the server rather than sending. The
+    order is worked out by replaying the workers taking files as they become free, estimating the time
+    of a file as its size plus request_cost. """
+
+    name = 'interleaved'
+
+    # Files at least this large (in bytes) are sent by the workers reserved for them
+    large_file_size = 64 * 1024 * 1024
+    # The number of bytes that could be sent in the time the round trips of a request take
+    request_cost = 512 * 1024
+
+    def order(self, files: Sequence[str], sizes: Sequence[int], categories: Dict[str, str]) -> array:
+        critical, others = self.critical_first(files, sizes, categories)
+        large = array('I', sorted((position for position in others if sizes[position] >= self.large_file_size),
+                                  key=sizes.__getitem__, reverse=True))
+        small = array('I', (position for position in others if sizes[position] < self.large_file_size))
+        large_slots = max(1, self.concurrency // 2) if small else self.concurrency
+
+        order = array('I', critical)
+        # (the time each worker becomes free, and whether it is sending a large file until then)
+        workers: List[Tuple[float, int, bool]] = [(0, worker, False) for worker in range(self.concurrency)]
+        for position in critical:
+            free_at, worker, _ = heapq.heappop(workers)
+            heapq.heappush(workers, (free_at + sizes[position] + self.request_cost, worker, False))
+
+        next_large = next_small = 0
+        while next_large < len(large) or next_small < len(small):
+            free_at, worker, _ = heapq.heappop(workers)
+            sending_large = sum(1 for busy_until, _, is_large in workers if is_large and busy_until > free_at)
+            if next_large < len(large) and (sending_large < large_slots or next_small == len(small)):
+                position, is_large = large[next_large], True
+                next_large += 1
+            else:
+                position, is_large = small[next_small], False
+                next_small += 1
+            order.append(position)
+            heapq.heappush(workers, (free_at + sizes[position] + self.request_cost, worker, is_large))
+        return order
+
+
+# The scheduling policies, by name
+SCHEDULERS: Dict[str, Type[UploadScheduler]] = {scheduler.name: scheduler for scheduler in
+                                                (FifoScheduler, LongestFirstScheduler, InterleavedScheduler)}
+
+
+def get_scheduler(name: str = None, concurrency: int = 1) -> UploadScheduler:
+    """ Returns the named scheduling policy (the interleaved one by default). """
+
+    name = name or InterleavedScheduler.name
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown upload schedule '{name}', expected one of {', '.join(sorted(SCHEDULERS))}.")
+    return SCHEDULERS[name](concurrency)
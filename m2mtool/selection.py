@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Stands for a size or modification time which was not recorded
+UNKNOWN = -1
+
+
+def _encode(name: str) -> bytes:
+    # file names which aren't valid UTF-8 survive the round trip as surrogates, as with os.fsencode
+    return name.encode('utf-8', 'surrogateescape')
+
+
+class FileSelection:
+    """ The files selected for a deposition, stored compactly enough for trees of millions of files.
+
+    Rather than a list of full paths, every directory is stored once in a table, and each file is a record in
+    flat arrays: the index of its directory, its name (UTF-8, in one shared buffer), and its size and
+    modification time if they were known when it was selected. Paths are only built when the selection is
+    iterated, so it can be handed from the file selector to the uploader without copying it. The upload
+    state of the files is kept by the UploadManifest. """
+
+    def __init__(self):
+        self.directories: List[str] = []
+        self._directory_ids: Dict[str, int] = {}
+        self._directory: array = array('I')
+        self._names: bytearray = bytearray()
+        self._name_ends: array = array('Q')
+        self.sizes: array = array('q')
+        self.mtimes: array = array('d')
+        # a hash table of the positions of the files, by path, built by the first position() call
+        self._table: Optional[array] = None
+
+    @classmethod
+    def from_paths(cls, paths: Iterable[str]) -> 'FileSelection':
+        """ Returns the selection of the given paths, relative to the deposited directory. """
+
+        if isinstance(paths, cls):
+            return paths
+        selection = cls()
+        for path in paths:
+            selection.add(path)
+        return selection
+
+    def add(self, path: str, size: int = UNKNOWN, mtime: float = UNKNOWN) -> None:
+        """ Adds a file, given by its path relative to the deposited directory (with '/' as the separator). """
+
+        slash = path.rfind('/')
+        directory, name = path[:slash + 1], path[slash + 1:]
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self._directory_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+
+        self._directory.append(directory_id)
+        self._names += _encode(name)
+        self._name_ends.append(len(self._names))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        if self._table is not None:
+            self._index(path, len(self) - 1)
+
+    def __len__(self) -> int:
+        return len(self._directory)
+
+    def __bool__(self) -> bool:
+        return len(self._directory) > 0
+
+    def __getitem__(self, position: int) -> str:
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('FileSelection index out of range')
+        start = self._name_ends[position - 1] if position else 0
+        name = self._names[start:self._name_ends[position]].decode('utf-8', 'surrogateescape')
+        return self.directories[self._directory[position]] + name
+
+    def __iter__(self) -> Iterator[str]:
+        directories, names = self.directories, self._names
+        start = 0
+        for directory_id, end in zip(self._directory, self._name_ends):
+            yield directories[directory_id] + names[start:end].decode('utf-8', 'surrogateescape')
+            start = end
+
+    def position(self, path: str) -> int:
+        """ Returns the position of the file at path, or -1 if it isn't selected.
+
+        The positions are found in a hash table of the positions alone, which takes a few bytes per file rather
+        than a dictionary of every path; it is built by the first call, and kept up to date by add(). """
+
+        if self._table is None:
+            self._rebuild(len(self))
+        table, mask = self._table, len(self._table) - 1
+        slot = hash(path) & mask
+        while table[slot] >= 0:
+            if self[table[slot]] == path:
+                return table[slot]
+            slot = (slot + 1) & mask
+        return -1
+
+    def _rebuild(self, count: int) -> None:
+        # makes a table (at most half full) for count files, and adds every file to it
+        size = 8
+        while size < 2 * count:
+            size *= 2
+        self._table = array('i', [-1]) * size
+        for position, path in enumerate(self):
+            self._index(path, position)
+
+    def _index(self, path: str, position: int) -> None:
+        if 2 * len(self) > len(self._table):
+            self._rebuild(len(self) * 2)
+            return
+        table, mask = self._table, len(self._table) - 1
+        slot = hash(path) & mask
+        while table[slot] >= 0:
+            if table[slot] == position:
+                return
+            slot = (slot + 1) & mask
+        table[slot] = position
+
+    def records(self, directory: Optional[str] = None) -> Iterator[Tuple[str, int, float]]:
+        """ Yields the (path, size, mtime) of every file. If directory (the deposited directory) is given,
+        the sizes and modification times which were not recorded are read from the files. """
+
+        for path, size, mtime in zip(self, self.sizes, self.mtimes):
+            if directory is not None and (size == UNKNOWN or mtime == UNKNOWN):
+                stat = os.stat(os.path.join(directory, path))
+                size, mtime = stat.st_size, stat.st_mtime
+            yield path, size, mtime
+
+
+class SelectionView(Sequence[str]):
+    """ The files of a FileSelection at the given positions, in that order. The paths are built as the files
+    are looked up or iterated, rather than copied. """
+
+    def __init__(self, selection: FileSelection, positions: Sequence[int]):
+        self.selection: FileSelection = selection
+        self.positions: Sequence[int] = positions
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SelectionView(self.selection, self.positions[index])
+        return self.selection[self.positions[index]]
+
+    def __iter__(self) -> Iterator[str]:
+        selection = self.selection
+        for position in self.positions:
+            yield selection[position]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+
+from m2mtool import tracing
+
+# Set up logging
+logging.basicConfig()
+
+# The summary of a deposition is written next to its session file, with this suffix
+TELEMETRY_FILE_SUFFIX = '.telemetry.json'
+
+
+class Coalescer:
+    """ Decides when a stream of progress updates, possibly from several threads, is passed on, so that
+    listeners are updated at most every interval seconds however often the progress changes. """
+
+    def __init__(self, interval: float):
+        self.interval: float = interval
+        self.last: float = 0
+        self.lock = threading.Lock()
+
+    def due(self, final: bool = False) -> bool:
+        """ Returns whether an update should be passed on now. Final updates always are. """
+
+        with self.lock:
+            now = time.monotonic()
+            if not final and now - self.last < self.interval:
+                return False
+            self.last = now
+            return True
+
+
+class ThroughputMeter:
+    """ Estimates the current transfer rate from the byte counts seen over the last window seconds. """
+
+    def __init__(self, window: float = 10):
+        self.window: float = window
+        self.samples: Deque[Tuple[float, int]] = deque()
+
+    def update(self, sent_bytes: int) -> float:
+        """ Records the number of bytes sent so far, and returns the recent rate in bytes per second. """
+
+        now = time.monotonic()
+        self.samples.append((now, sent_bytes))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        first_time, first_bytes = self.samples[0]
+        if now <= first_time:
+            return 0
+        return (sent_bytes - first_bytes) / (now - first_time)
+
+    @staticmethod
+    def remaining(sent_bytes: int, total_bytes: int, rate: float) -> Optional[float]:
+        """ Returns the estimated number of seconds until total_bytes are sent, or None if unknown. """
+
+        if rate <= 0:
+            return None
+        return max(0, total_bytes - sent_bytes) / rate
+
+
+class UploadTelemetry:
+    """ Records how long each phase of a deposition took, and the latency, size and retry count of every
+    request made for the files, so that slow depositions can be diagnosed after the fact. """
+
+    def __init__(self):
+        self.started: float = time.time()
+        self.start: float = time.monotonic()
+        self.phases: Dict[str, float] = {}
+        self.uploads: List[dict] = []
+        # how the adaptive concurrency controller ended up, if one was used
+        self.concurrency: Optional[dict] = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Times the enclosed block as the named phase of the deposition. """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start)
+
+    def add_phase(self, name: str, start: float) -> None:
+        """ Records the time since start (a time.monotonic() value) as the named phase of the deposition. """
+        self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+        tracing.add_span(name, start)
+
+    def record(self, name: str, kind: str, start: float, size: int, retries: int,
+               error: Optional[Exception] = None) -> None:
+        """ Records a finished request. start is the time.monotonic() at which it was started. """
+
+        now = time.monotonic()
+        entry = {'name': name, 'kind': kind, 'offset': round(start - self.start, 4),
+                 'seconds': round(now - start, 4), 'bytes': size, 'retries': retries}
+        if error:
+            entry['error'] = str(error)
+        with self.lock:
+            self.uploads.append(entry)
+        tracing.add_span(name, start, now, 'upload', kind=kind, bytes=size, retries=retries,
+                         error=entry.get('error'))
+
+    def summary(self) -> dict:
+        """ Returns the telemetry as a dictionary which can be serialized as JSON. """
+
+        with self.lock:
+            uploads = list(self.uploads)
+        latencies = sorted(entry['seconds'] for entry in uploads)
+        total_bytes = sum(entry['bytes'] for entry in uploads if 'error' not in entry)
+        upload_seconds = self.phases.get('upload', time.monotonic() - self.start)
+
+        def percentile(fraction: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {'started': self.started,
+                'seconds': round(time.monotonic() - self.start, 3),
+                'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                'requests': len(uploads),
+                'failed_requests': sum(1 for entry in uploads if 'error' in entry),
+                'retries': sum(entry['retries'] for entry in uploads),
+                'concurrency': self.concurrency,
+                'bytes': total_bytes,
+                'bytes_per_second': round(total_bytes / upload_seconds, 1) if upload_seconds > 0 else None,
+                'latency': {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                            'max': latencies[-1] if latencies else None},
+                'slowest': sorted(uploads, key=lambda entry: entry['seconds'], reverse=True)[:10],
+                'uploads': uploads}
+
+    def save(self, path: str) -> None:
+        """ Writes the summary to path as JSON. Failing to do so doesn't fail the deposition. """
+
+        try:
+            with open(path, 'w') as telemetry_file:
+                json.dump(self.summary(), telemetry_file, indent=1)
+        except (IOError, OSError) as err:
+            logging.warning("Could not write the upload telemetry to '%s': %s", path, err)
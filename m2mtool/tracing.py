@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Set up logging
+logging.basicConfig()
+
+# The environment variables which turn tracing on: the trace file to write, and the file to write the profile of
+# the deposition to (see the --trace and --profile arguments)
+TRACE_VARIABLE = 'M2MTOOL_TRACE'
+PROFILE_VARIABLE = 'M2MTOOL_PROFILE'
+
+# What span() returns when tracing is off, so an untraced phase costs a function call
+_DISABLED = nullcontext()
+
+# A deposition ID in the path of a request, left out of the name of its span so the same requests share one name
+_DEPOSITION_ID = re.compile(r'/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)')
+
+
+class Tracer:
+    """ Collects timed spans of the work m2mtool does, from every thread, and writes them as a trace file in
+    the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev can open.
+
+    Times are time.monotonic() values. Each span is recorded as a complete ('X') event once it ends, on the
+    thread it ran in, and the threads are named after their Python names. """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.pid: int = os.getpid()
+        self.origin: float = time.monotonic()
+        self.events: List[dict] = []
+        self.threads: Dict[int, str] = {}
+
+    def add(self, name: str, category: str, start: float, end: float = None, **args) -> None:
+        """ Records a span which ran from start until end (or now). """
+
+        end = time.monotonic() if end is None else end
+        thread_id = threading.get_native_id()
+        if thread_id not in self.threads:
+            self.threads[thread_id] = threading.current_thread().name
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round((start - self.origin) * 1e6, 1),
+                 'dur': round((end - start) * 1e6, 1), 'pid': self.pid, 'tid': thread_id}
+        if args:
+            event['args'] = args
+        # appending to a list is atomic, so the threads don't need a lock
+        self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, **args)
+
+    def save(self) -> None:
+        """ Writes the spans recorded so far to the trace file. Failing to do so doesn't fail the deposition. """
+
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread_id, 'args': {'name': name}}
+                 for thread_id, name in list(self.threads.items())]
+        trace = {'traceEvents': names + list(self.events), 'displayTimeUnit': 'ms',
+                 'otherData': {'started': time.time() - (time.monotonic() - self.origin)}}
+        try:
+            temp_file = f'{self.path}.tmp'
+            with open(temp_file, 'w') as trace_file:
+                json.dump(trace, trace_file)
+            os.replace(temp_file, self.path)
+        except (IOError, OSError) as err:
+            logging.warning("Could not write the trace to '%s': %s", self.path, err)
+
+
+# The tracer, and the file the profile of the deposition is written to, if they are on
+_tracer: Optional[Tracer] = None
+_profile_file: Optional[str] = None
+
+
+def start(trace_file: str = None, profile_file: str = None) -> None:
+    """ Turns tracing on, writing the trace to trace_file when m2mtool exits (and each time a deposition ends),
+    and turns profiling of the deposition on, writing it to profile_file. None leaves either off. """
+
+    global _tracer, _profile_file
+    _tracer = Tracer(trace_file) if trace_file else None
+    _profile_file = profile_file or None
+
+
+def files() -> Tuple[Optional[str], Optional[str]]:
+    """ Returns the trace and profile files, to pass to start_worker() in a worker process. """
+    return _tracer and _tracer.path, _profile_file
+
+
+def start_worker(trace_file: str = None, profile_file: str = None) -> None:
+    """ Starts tracing in a worker process (such as those of a batch) as start() does, writing to files named
+    after trace_file and profile_file and the process id, so the workers don't overwrite each other. """
+
+    def process_file(path: Optional[str]) -> Optional[str]:
+        if not path:
+            return None
+        root, extension = os.path.splitext(path)
+        return f'{root}.{os.getpid()}{extension}'
+
+    start(process_file(trace_file), process_file(profile_file))
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, category: str = 'phase', **args):
+    """ Returns a context manager which records the enclosed block as a span, if tracing is on. """
+    return _tracer.span(name, category, **args) if _tracer else _DISABLED
+
+
+def add_span(name: str, start: float, end: float = None, category: str = 'phase', **args) -> None:
+    """ Records a span which ran from start (a time.monotonic() value) until end or now, if tracing is on. """
+    if _tracer:
+        _tracer.add(name, category, start, end, **args)
+
+
+def trace_response(r, *args, **kwargs) -> None:
+    """ A requests response hook which records the request as a span (sending it, and waiting for the
+    response headers) in the thread which made it. """
+
+    if not _tracer:
+        return
+    end = time.monotonic()
+    request = r.request
+    path = urlsplit(request.url).path
+    _tracer.add(f"{request.method} {_DEPOSITION_ID.sub('/{id}', path)}", 'http', end - r.elapsed.total_seconds(),
+                end, path=path, status=r.status_code, sent_bytes=int(request.headers.get('Content-Length') or 0))
+
+
+def save() -> None:
+    """ Writes the trace, if tracing is on. """
+    if _tracer:
+        _tracer.save()
+
+
+@contextmanager
+def profiled():
+    """ Profiles the enclosed block with cProfile, if profiling is on, and writes the statistics (which pstats or
+    snakeviz can read) to the profile file. The threads started by the block, such as the upload workers, are
+    profiled too, and their statistics merged with those of the calling thread. """
+
+    if not _profile_file:
+        yield
+        return
+
+    import cProfile
+    import pstats
+    import sys
+    profile = cProfile.Profile()
+    # before Python 3.12 a profile only sees the thread which enabled it, so every thread started meanwhile
+    # enables one of its own, on the first event it reports to the profile function threading gives it
+    per_thread = sys.version_info < (3, 12)
+    thread_profiles: List[cProfile.Profile] = []
+
+    def profile_thread(frame, event, arg) -> None:
+        thread_profile = cProfile.Profile()
+        thread_profiles.append(thread_profile)
+        thread_profile.enable()
+
+    if per_thread:
+        threading.setprofile(profile_thread)
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if per_thread:
+            threading.setprofile(None)
+        try:
+            stats = pstats.Stats(profile)
+            for thread_profile in list(thread_profiles):
+                stats.add(thread_profile)
+            stats.dump_stats(_profile_file)
+        except (IOError, OSError) as err:
+            logging.warning("Could not write the profile to '%s': %s", _profile_file, err)
+
+
+start(os.environ.get(TRACE_VARIABLE), os.environ.get(PROFILE_VARIABLE))
+atexit.register(save)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.concurrency import THROTTLE_STATUSES, AdaptiveConcurrency, retry_after_seconds
+from m2mtool.configuration import configuration
+from m2mtool.control import UploadCancelled, UploadControl
+from m2mtool.ratelimit import TokenBucket
+from m2mtool.telemetry import UploadTelemetry
+
+# Set up logging
+logging.basicConfig()
+
+# A semaphore (possibly shared with other processes) which every upload request holds while it is in flight,
+# to cap the connections of several depositions running at once; see limit_connections()
+_connection_slots = None
+
+
+def limit_connections(semaphore) -> None:
+    """ Makes every upload request made by this process hold the semaphore (a threading or multiprocessing
+    semaphore) while it is in flight, or removes the limit if semaphore is None. """
+
+    global _connection_slots
+    _connection_slots = semaphore
+
+
+def max_concurrency(concurrency: int = None, adaptive: bool = None) -> int:
+    """ Returns the most uploads an UploadPool with this concurrency (upload_concurrency by default) has in flight
+    at once: up to max_upload_concurrency when its concurrency is adaptive (adaptive_concurrency by default). """
+
+    if concurrency is None:
+        concurrency = configuration.get('upload_concurrency', 1)
+    concurrency = max(1, int(concurrency))
+    if adaptive is None:
+        adaptive = configuration.get('adaptive_concurrency', False)
+    if adaptive:
+        return max(concurrency, int(configuration.get('max_upload_concurrency') or concurrency))
+    return concurrency
+
+
+class UploadPool:
+    """ Uploads files to an existing deposition using a pool of worker threads.
+
+    Every worker uses its own BMRBDepSession, and therefore its own pooled HTTP connection. The callback,
+    if given, receives the byte counts reported by BMRBDepSession.upload_file from every worker thread. If
+    telemetry is given, the latency, size and retry count of every request is recorded in it. Files with an
+    entry in categories are sent with that upload category.
+
+    If adaptive concurrency is enabled (the adaptive_concurrency setting, by default), concurrency is only the
+    initial number of requests in flight: an AdaptiveConcurrency controller adjusts it, up to
+    max_upload_concurrency, from the latency of the requests and the 429 and 503 responses of the server, which
+    it retries itself after the delay the server asks for. If a rate_limiter is given, the uploads of all the
+    workers together are kept to its rate.
+
+    If a control is given, the workers can be paused and cancelled through it. Once cancelled, no further
+    request is started, and the transfers in flight fail with UploadCancelled; the names of the files and
+    bundles which were interrupted part way, and which the server may hold a part of, are kept in
+    interrupted. """
+
+    def __init__(self, sid: str, directory: str, concurrency: int = None,
+                 callback: Optional[Callable[[int], None]] = None, telemetry: Optional[UploadTelemetry] = None,
+                 categories: Optional[Dict[str, str]] = None, adaptive: bool = None,
+                 rate_limiter: Optional[TokenBucket] = None, control: Optional[UploadControl] = None):
+        self.sid: str = sid
+        self.directory: str = directory
+        self.callback: Optional[Callable[[int], None]] = callback
+        self.telemetry: Optional[UploadTelemetry] = telemetry
+        self.categories: Dict[str, str] = categories or {}
+        self.rate_limiter: Optional[TokenBucket] = rate_limiter
+        self.control: Optional[UploadControl] = control
+        self.interrupted: List[str] = []
+        if concurrency is None:
+            concurrency = configuration.get('upload_concurrency', 1)
+        self.concurrency: int = max(1, int(concurrency))
+
+        if adaptive is None:
+            adaptive = configuration.get('adaptive_concurrency', False)
+        self.controller: Optional[AdaptiveConcurrency] = None
+        if adaptive:
+            maximum = max_concurrency(self.concurrency, adaptive)
+            self.controller = AdaptiveConcurrency(self.concurrency, maximum)
+            self.concurrency = maximum
+        # the number of times a request is repeated after the server throttled it
+        self.throttle_retries: int = 10
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions: List[BMRBDepSession] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='m2mtool-upload')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Wait for every worker to drain, then close the worker sessions. """
+
+        self._executor.shutdown(wait=True)
+        for session in self._sessions:
+            session.__exit__(None, None, None)
+        self._sessions = []
+        if self.controller and self.telemetry:
+            self.telemetry.concurrency = {'final_limit': int(self.controller.limit),
+                                          'decreases': self.controller.decreases}
+
+    def _worker_session(self) -> BMRBDepSession:
+        """ Returns the session belonging to the calling worker thread, creating it if needed. """
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            # with a controller, throttling responses are left to it rather than retried by urllib3
+            retry_statuses = None
+            if self.controller:
+                retry_statuses = [status for status in BMRBDepSession.retry_statuses
+                                  if status not in THROTTLE_STATUSES]
+            session = BMRBDepSession(sid=self.sid, retry_statuses=retry_statuses, rate_limiter=self.rate_limiter,
+                                     control=self.control).__enter__()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _request(self, name: str, kind: str, size: int,
+                 request: Callable[[BMRBDepSession, Optional[Callable[[int], None]]], Optional[str]]) -> Optional[str]:
+        """ Makes a request with the worker session, passing it the progress callback. The request is paced by
+        the controller and recorded in the telemetry, if there are any, and waits while the pool is paused. """
+
+        session = self._worker_session()
+        if self.control:
+            self.control.checkpoint()
+        try:
+            return self._send(name, kind, size, session, request)
+        except UploadCancelled:
+            # the server may have kept what was sent before the transfer stopped
+            if kind != 'link':
+                with self._lock:
+                    self.interrupted.append(name)
+            raise
+
+    def _send(self, name: str, kind: str, size: int, session: BMRBDepSession,
+              request: Callable[[BMRBDepSession, Optional[Callable[[int], None]]], Optional[str]]) -> Optional[str]:
+        if not self.telemetry and not self.controller:
+            with _connection_slots or nullcontext():
+                return request(session, self.callback)
+
+        throttled = 0
+        while True:
+            sent = [0]
+
+            def callback(sent_bytes: int) -> None:
+                sent[0] += sent_bytes
+                if self.callback:
+                    self.callback(sent_bytes)
+
+            if self.controller:
+                self.controller.acquire(self.control)
+            session.last_retries = 0
+            if self.rate_limiter:
+                self._local.rate_limited = self.rate_limiter.waited()
+            if self.control:
+                self._local.paused = self.control.waited()
+            start = time.monotonic()
+            try:
+                # a connection is only claimed once the controller lets the request start, and the time spent
+                # waiting for one (with other depositions) isn't taken as latency
+                with _connection_slots or nullcontext():
+                    start = time.monotonic()
+                    result = request(session, callback)
+            except Exception as err:
+                response = getattr(err, 'response', None)
+                status = response.status_code if response is not None else None
+                if self.controller:
+                    retry_after = retry_after_seconds(response.headers.get('Retry-After')) if status else None
+                    self.controller.release(self._latency(start), size, status, retry_after)
+                    if status in THROTTLE_STATUSES and throttled < self.throttle_retries and \
+                            not (self.control and self.control.cancelled):
+                        # the attempt will be sent again in full
+                        throttled += 1
+                        if self.callback and sent[0]:
+                            self.callback(-sent[0])
+                        continue
+                if self.telemetry:
+                    self.telemetry.record(name, kind, start, size, session.last_retries + throttled, err)
+                raise
+
+            if self.controller:
+                self.controller.release(self._latency(start), size, 200)
+            if self.telemetry:
+                self.telemetry.record(name, kind, start, size, session.last_retries + throttled)
+            return result
+
+    def _latency(self, start: float) -> float:
+        # the time a request started at start took, leaving out any time it was held back by the rate limiter
+        # or paused
+        elapsed = time.monotonic() - start
+        if self.rate_limiter:
+            elapsed -= self.rate_limiter.waited() - self._local.rate_limited
+        if self.control:
+            elapsed -= self.control.waited() - self._local.paused
+        return elapsed
+
+    def _size(self, file_name: str) -> int:
+        if not self.telemetry and not self.controller:
+            return 0
+        return os.path.getsize(os.path.join(self.directory, file_name))
+
+    def _upload(self, file_name: str) -> str:
+        return self._request(file_name, 'file', self._size(file_name),
+                             lambda session, callback: session.upload_file(file_name, self.directory, callback,
+                                                                           self.categories.get(file_name)))
+
+    def _link(self, file_name: str, digest: str) -> str:
+        return self._request(file_name, 'link', 0,
+                             lambda session, callback: session.link_file(file_name, digest,
+                                                                         self.categories.get(file_name)))
+
+    def _upload_bundle(self, bundle_name: str, file_names: List[str]) -> Dict[str, str]:
+        return self._request(bundle_name, 'bundle', sum(self._size(file_name) for file_name in file_names),
+                      lambda session, callback: session.upload_bundle(bundle_name, self.directory, file_names,
+                                                                      callback))
+
+    @staticmethod
+    def _result(file_name: str, future: Future) -> Tuple[str, Optional[str], Optional[Exception]]:
+        try:
+            digest = future.result()
+        except Exception as err:
+            return file_name, None, err
+        return file_name, digest, None
+
+    def _run(self, task: Callable[..., str], calls: Iterable[tuple]) \
+            -> Iterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        """ Runs task(*call) for every call on the workers, yielding (file_name, digest, error) as they finish.
+
+        The first argument of every call is the file name. The calls are started in order, but are reported
+        as soon as they finish, so a large file doesn't hold up the small ones queued after it (see
+        m2mtool.schedule). Only a small window of calls is queued ahead of the workers, so closing the iterator
+        early stops them promptly. Once the pool is cancelled, no more calls are queued, and those already
+        queued are reported as they finish. """
+
+        pending: Dict[Future, str] = {}
+        window = self.concurrency * 2
+        try:
+            for call in calls:
+                if self.control and self.control.cancelled:
+                    break
+                pending[self._executor.submit(task, *call)] = call[0]
+                while len(pending) >= window:
+                    yield from self._finished(pending)
+            while pending:
+                yield from self._finished(pending)
+        finally:
+            # Don't start anything that is still queued if the caller stopped early
+            for future in pending:
+                future.cancel()
+
+    def _finished(self, pending: Dict[Future, str]) -> Iterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        # waits for at least one of the pending calls to finish, and reports (and forgets) those which have
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield self._result(pending.pop(future), future)
+
+    def upload(self, files: Iterable[str]) -> Iterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        """ Uploads the files in the order they were given, yielding (file_name, digest, error) as each finishes.
+
+        error is None if the file was uploaded successfully, in which case digest is the digest of the
+        uploaded contents. """
+
+        return self._run(self._upload, ((file_name,) for file_name in files))
+
+    def upload_bundles(self, bundles: Dict[str, List[str]]) \
+            -> Iterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        """ Uploads groups of files as compressed archives, given as a mapping of archive name to file names.
+        Yields (bundle_name, digests, error) as each finishes, like upload(), where digests maps each file of
+        the bundle to the digest of its contents. """
+
+        return self._run(self._upload_bundle, bundles.items())
+
+    def link(self, links: Dict[str, str]) -> Iterator[Tuple[str, Optional[str], Optional[Exception]]]:
+        """ Adds files whose contents the server already holds, given as a mapping of file name to digest.
+        Yields (file_name, digest, error) as each finishes, like upload(). """
+
+        return self._run(self._link, links.items())
+
+
+def deduplicate(files: Sequence[str], digests: Dict[str, Future], find_blobs: Callable[[Set[str]], Optional[Set[str]]],
+                to_link: Dict[str, str], batch_size: int = 1000) -> Iterator[str]:
+    """ Yields the files whose contents have to be uploaded, and records those which can be linked to contents
+    the server already holds (or will hold, once the yielded files have been sent) in to_link, with their digests.
+
+    Only the first file with each digest is uploaded, and only if the server doesn't already have it. The files
+    are classified as their digests become available, so uploads can start before every file is hashed: the
+    server is asked about the digests which are known at the time, batch_size at most at once. find_blobs
+    returns None if the server can't link files, in which case every file is yielded. """
+
+    seen: Set[str] = set()
+    known: Set[str] = set()
+    queried = 0
+    for position, file_name in enumerate(files):
+        digest = digests[file_name].result()
+        if position >= queried:
+            batch, queried = {digest}, position + 1
+            while queried < min(len(files), position + batch_size) and digests[files[queried]].done():
+                batch.add(digests[files[queried]].result())
+                queried += 1
+            present = find_blobs(batch)
+            if present is None:
+                yield from files[position:]
+                return
+            known |= present
+
+        if digest in seen or digest in known:
+            to_link[file_name] = digest
+        else:
+            seen.add(digest)
+            yield file_name
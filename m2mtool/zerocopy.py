@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class _SendToConnectionMixin:
+    """ Lets a request body which has a send_to(sock) method (a ZeroCopyFileEncoder) write itself to the
+    socket once the headers are sent, rather than http.client reading it through Python 8 KiB at a time. The
+    Content-Length is already set by requests, and any other body is sent as usual. """
+
+    def request(self, method, url, body=None, headers=None):
+        if not hasattr(body, 'send_to'):
+            return super().request(method, url, body=body, headers=headers)
+        super().request(method, url, body=None, headers=headers)
+        body.send_to(self.sock)
+
+
+class ZeroCopyHTTPConnection(_SendToConnectionMixin, HTTPConnection):
+    pass
+
+
+class ZeroCopyHTTPSConnection(_SendToConnectionMixin, HTTPSConnection):
+    pass
+
+
+class ZeroCopyHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = ZeroCopyHTTPConnection
+
+
+class ZeroCopyHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = ZeroCopyHTTPSConnection
+
+
+class ZeroCopyAdapter(HTTPAdapter):
+    """ An HTTPAdapter whose connections send ZeroCopyFileEncoder bodies with send_to(). Requests through a
+    proxy use the usual connections, which read the body like any other file. """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': ZeroCopyHTTPConnectionPool,
+                                                   'https': ZeroCopyHTTPSConnectionPool}
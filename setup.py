@@ -1,6 +1,32 @@
 #!/usr/bin/env python3
 
+import glob
+import os
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+
+class BuildWithForms(build_py):
+    """ Also compiles the Qt Designer forms (file_selector/*.ui) to Python modules, so they don't have to be
+    parsed every time the GUI starts. If PyQt5 isn't available, the .ui files are loaded at runtime instead. """
+
+    def run(self):
+        super().run()
+        try:
+            from PyQt5 import uic
+        except ImportError:
+            self.warn('PyQt5 is not installed, the forms will be loaded from the .ui files at runtime.')
+            return
+
+        form_directory = os.path.join(self.build_lib, 'm2mtool', 'file_selector')
+        for ui_file in glob.glob(os.path.join('m2mtool', 'file_selector', '*.ui')):
+            name = os.path.splitext(os.path.basename(ui_file))[0]
+            module = os.path.join(form_directory, f'ui_{name}.py')
+            self.announce(f'compiling {ui_file} -> {module}', level=2)
+            with open(ui_file, 'r') as source, open(module, 'w') as target:
+                uic.compileUi(source, target)
+
 
 setup(name='m2mtool',
       version='1.0',
@@ -9,7 +35,10 @@ setup(name='m2mtool',
       author_email='wedell@uchc.edu',
       url='https://devel.nmrbox.org/svn/nmrbox/trunk/software/m2mtool',
       packages=['m2mtool'],
-      package_data={'m2mtool': ['file_selector/*', 'config.json']},
+      package_data={'m2mtool': ['file_selector/*', 'config.json', 'extensions.json']},
+      cmdclass={'build_py': BuildWithForms},
+      # the asyncio upload client (m2mtool.aiobmrbdep)
+      extras_require={'async': ['aiohttp']},
       entry_points={
           'console_scripts':
               [
@@ -0,0 +1,62 @@
+import os
+from typing import Dict, List
+
+import pytest
+import requests
+
+import m2mtool.helpers
+from benchmarks.mock_bmrbdep import MockOptions, MockServerProcess
+from m2mtool.configuration import configuration
+
+
+@pytest.fixture
+def settings():
+    """ The configuration, restored once the test is done with it. """
+
+    saved = dict(configuration)
+    yield configuration
+    configuration.clear()
+    configuration.update(saved)
+
+
+@pytest.fixture
+def mock_server(settings):
+    """ Starts a local mock BMRBdep server with the given MockOptions keyword arguments, and points the
+    configuration at it, for BMRBdep and the NMRbox API both. """
+
+    servers = []
+
+    def start(**options) -> MockServerProcess:
+        server = MockServerProcess(MockOptions(**options)).__enter__()
+        servers.append(server)
+        settings['bmrbdep_root_url'] = settings['api_root_url'] = server.url
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
+
+
+@pytest.fixture
+def api_server(mock_server, settings, tmp_path, monkeypatch):
+    """ Starts a mock server as mock_server does, to stand in for the NMRbox API, with the cache in a fresh
+    directory and a login token which doesn't need dbus. """
+
+    settings['cache_directory'] = str(tmp_path / 'cache')
+    monkeypatch.setattr(m2mtool.helpers, 'get_token', lambda: 'token')
+    return mock_server
+
+
+def server_stats(server: MockServerProcess) -> dict:
+    """ Returns the request statistics of a mock server. """
+    return requests.get(f'{server.url}/_stats').json()
+
+
+def write_files(directory: str, contents: Dict[str, bytes]) -> List[str]:
+    """ Writes the files (relative paths, and their contents) below directory, and returns their paths. """
+
+    for file_name, data in contents.items():
+        os.makedirs(os.path.join(directory, os.path.dirname(file_name)), exist_ok=True)
+        with open(os.path.join(directory, file_name), 'wb') as file:
+            file.write(data)
+    return list(contents)
@@ -0,0 +1,85 @@
+import asyncio
+import importlib
+import io
+import sys
+
+import pytest
+import requests
+
+from benchmarks.upload_benchmark import STAR
+from m2mtool.hashing import file_digest
+from tests.conftest import write_files
+
+aiobmrbdep = pytest.importorskip('m2mtool.aiobmrbdep', exc_type=ImportError)
+
+
+def upload(directory: str, file_names, concurrency: int, **options) -> list:
+    # uploads the files to a new deposition, returning the results and the most uploads in flight at once
+
+    async def run():
+        async with aiobmrbdep.AsyncBMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com',
+                                                  nickname='test', concurrency=concurrency,
+                                                  **options) as session:
+            in_flight, most = 0, 0
+            upload_file = session.upload_file
+
+            async def counted(*args, **kwargs):
+                nonlocal in_flight, most
+                in_flight += 1
+                most = max(most, in_flight)
+                try:
+                    return await upload_file(*args, **kwargs)
+                finally:
+                    in_flight -= 1
+
+            session.upload_file = counted
+            return [result async for result in session.upload_files(file_names, directory)], most
+
+    return asyncio.run(run())
+
+
+def test_uploads_are_bounded_and_complete(mock_server, tmp_path):
+    server = mock_server(latency=0.005)
+    files = write_files(str(tmp_path), {f'd/file{number:03d}.dat': b'%d' % number * 100 for number in range(60)})
+    # a generator, as a very large tree would be given
+    results, most = upload(str(tmp_path), (file_name for file_name in files), concurrency=4)
+
+    assert most <= 4
+    assert sorted(file_name for file_name, _, _ in results) == files
+    assert all(error is None for _, _, error in results)
+    assert all(digest == file_digest(str(tmp_path / file_name)) for file_name, digest, _ in results)
+    assert requests.get(f'{server.url}/_stats').json()['uploads'] == 60
+
+
+def test_failed_uploads_are_retried_then_reported(mock_server, tmp_path):
+    server = mock_server(error_rate=1)
+    files = write_files(str(tmp_path), {'a.dat': b'a', 'b.dat': b'b'})
+    results, _ = upload(str(tmp_path), files, concurrency=2, retries=2, backoff_factor=0.01)
+
+    assert sorted(file_name for file_name, _, _ in results) == files
+    assert all(error.status == 503 for _, _, error in results)
+    assert requests.get(f'{server.url}/_stats').json()['errors_injected'] == 6
+
+
+def test_closing_early_cancels_the_uploads(mock_server, tmp_path):
+    mock_server(latency=0.05)
+    files = write_files(str(tmp_path), {f'file{number}.dat': b'x' for number in range(20)})
+
+    async def run():
+        async with aiobmrbdep.AsyncBMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com',
+                                                  nickname='test', concurrency=2) as session:
+            uploads = session.upload_files(files, str(tmp_path))
+            first = await uploads.__anext__()
+            await uploads.aclose()
+            return first, [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    (_, _, error), left = asyncio.run(run())
+    assert error is None
+    assert not left
+
+
+def test_a_missing_aiohttp_is_explained(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'aiohttp', None)
+    monkeypatch.delitem(sys.modules, 'm2mtool.aiobmrbdep')
+    with pytest.raises(ImportError, match=r'm2mtool\[async\]'):
+        importlib.import_module('m2mtool.aiobmrbdep')
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from m2mtool.cache import DiskCache
+from m2mtool.control import UploadCancelled
+from m2mtool.deposit import Deposition
+from m2mtool.helpers import ApiSession
+from m2mtool.selection import FileSelection
+from tests.conftest import server_stats
+
+
+def metadata_url(server) -> str:
+    return f'{server.url}/user/get-bmrbdep-metadata'
+
+
+def expire_login(server) -> None:
+    # replaces the cached login with a session the server doesn't know
+    DiskCache('login', 60).put({'sessionid': 'expired'}, server.url)
+
+
+def test_the_login_is_cached(api_server, settings):
+    settings['login_cache_ttl'] = 60
+    server = api_server()
+    for _ in range(2):
+        with ApiSession() as session:
+            assert session.get(metadata_url(server)).status_code == 200
+    assert server_stats(server)['logins'] == 1
+
+
+@pytest.mark.parametrize('status', [401, 403])
+def test_a_rejected_cached_login_is_renewed_once(api_server, settings, status):
+    settings['login_cache_ttl'] = 60
+    server = api_server(auth_status=status)
+    expire_login(server)
+    with ApiSession() as session:
+        assert session.get(metadata_url(server)).status_code == 200
+        assert session.get(metadata_url(server)).status_code == 200
+    assert (server_stats(server)['logins'], server_stats(server)['metadata_requests']) == (1, 3)
+    # the new login replaced the rejected one in the cache
+    with ApiSession() as session:
+        assert session.get(metadata_url(server)).status_code == 200
+    assert server_stats(server)['logins'] == 1
+
+
+def test_a_failed_login_is_not_retried(api_server, settings):
+    settings['login_cache_ttl'] = 60
+    server = api_server(login_status=403)
+    expire_login(server)
+    with ApiSession() as session:
+        assert session.get(metadata_url(server)).status_code == 401
+        assert session.get(metadata_url(server)).status_code == 401
+    # the cached login was renewed once, and the response to that is returned rather than logging in again
+    assert (server_stats(server)['logins'], server_stats(server)['metadata_requests']) == (1, 3)
+
+
+def test_a_cancel_stops_waiting_for_the_metadata(api_server, settings, tmp_path):
+    server = api_server(metadata_latency=30)
+    settings['metadata_cache_ttl'] = 0
+    deposition = Deposition(str(tmp_path), 'test', FileSelection(), str(tmp_path / 'session'))
+    threading.Timer(0.5, deposition.control.cancel).start()
+
+    started = time.monotonic()
+    with pytest.raises(UploadCancelled):
+        deposition.fetch_metadata()
+    assert time.monotonic() - started < 5
+    assert server_stats(server)['metadata_requests'] == 1
+
+
+def test_the_metadata_request_times_out(api_server, settings, tmp_path):
+    api_server(metadata_latency=30)
+    settings.update({'metadata_cache_ttl': 0, 'api_read_timeout': 0.5})
+    errors = []
+    deposition = Deposition(str(tmp_path), 'test', FileSelection(), str(tmp_path / 'session'))
+    deposition.report_error = lambda err, *args: errors.append(err)
+
+    assert deposition.fetch_metadata() is None
+    assert isinstance(errors[0], requests.exceptions.Timeout)
@@ -0,0 +1,15 @@
+import pytest
+
+from m2mtool.m2mtool import parse_arguments
+
+
+def test_a_nickname_names_a_single_deposition():
+    args = parse_arguments(['--headless', 'data', '--nickname', 'sample'])
+    assert args.paths == ['data'] and args.nickname == 'sample'
+
+
+def test_a_nickname_is_rejected_for_several_paths(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        parse_arguments(['first', 'second', '--nickname', 'sample'])
+    assert exit_info.value.code == 2
+    assert '--nickname can only be given with a single path' in capsys.readouterr().err
@@ -0,0 +1,46 @@
+import io
+import json
+import os
+
+from m2mtool.batch import read_directory_list, run_batch
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from tests.conftest import server_stats, write_files
+
+
+def test_the_batch_file_lists_directories_and_nicknames(tmp_path):
+    batch_file = tmp_path / 'datasets.txt'
+    batch_file.write_text('# the datasets of the paper\n\nhsqc\n  \nnoesy\tNOESY spectra\n   # skipped too\n'
+                          f'{tmp_path}/cosy\t\n')
+    assert read_directory_list(str(batch_file)) == [(str(tmp_path / 'hsqc'), None),
+                                                    (str(tmp_path / 'noesy'), 'NOESY spectra'),
+                                                    (str(tmp_path / 'cosy'), None)]
+
+    batch_file = tmp_path / 'datasets.json'
+    batch_file.write_text(json.dumps(['hsqc', {'path': 'noesy', 'nickname': 'NOESY spectra'}]))
+    assert read_directory_list(str(batch_file)) == [(str(tmp_path / 'hsqc'), None),
+                                                    (str(tmp_path / 'noesy'), 'NOESY spectra')]
+
+
+def test_a_batch_shares_its_connections(api_server, settings, tmp_path):
+    server = api_server(bandwidth=1024 * 1024)
+    settings.update({'upload_concurrency': 4, 'adaptive_concurrency': False, 'metadata_cache_ttl': 0})
+    directories = []
+    for name in ('hsqc', 'noesy'):
+        files = write_files(str(tmp_path / name), {f'data/{number}.dat': os.urandom(64 * 1024) for number in range(8)})
+        directories.append((str(tmp_path / name), f'{name} nickname'))
+
+    stream = io.StringIO()
+    assert run_batch(directories, jobs=2, max_connections=2, stream=stream) == 0
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert sorted(event['path'] for event in events if event['event'] == 'deposition_finished') == \
+        sorted(path for path, _ in directories)
+    assert all(event['status'] == 'deposited' for event in events if event['event'] == 'deposition_finished')
+    assert events[-1]['event'] == 'batch_finished' and events[-1]['failed'] == []
+
+    stats = server_stats(server)
+    assert stats['uploads'] == 2 * len(files)
+    # each deposition would run four uploads at once on its own
+    assert 1 < stats['most_concurrent_uploads'] <= 2
+    for path, nickname in directories:
+        manifest = UploadManifest.load(os.path.join(path, SESSION_FILE_NAME))
+        assert manifest.complete and manifest.nickname == nickname
@@ -0,0 +1,46 @@
+import io
+import os
+import tarfile
+from array import array
+
+from m2mtool.bundle import BUNDLE_NAME, group_small_files, tar_stream
+from m2mtool.hashing import file_digest
+from tests.conftest import write_files
+
+CONTENTS = {'empty.dat': b'', 'peaks.list': b'1 8.25 120.5\n' * 100, 'data/1/fid': os.urandom(300000),
+            'data/2/fid': os.urandom(1000)}
+
+
+def test_the_streamed_archive_holds_the_files(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    sizes, digests = [], {}
+    archive = b''.join(tar_stream(str(tmp_path), files, sizes.append, digests))
+
+    with tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz') as tar:
+        members = tar.getmembers()
+        assert [member.name for member in members] == files
+        for member in members:
+            assert tar.extractfile(member).read() == CONTENTS[member.name]
+    assert sizes == [len(CONTENTS[file_name]) for file_name in files]
+    assert digests == {file_name: file_digest(str(tmp_path / file_name)) for file_name in files}
+
+
+def test_the_archive_is_streamed_a_file_at_a_time(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    chunks = list(tar_stream(str(tmp_path), files))
+    # a chunk for each file, and the end of the archive
+    assert len(chunks) == len(files) + 1
+
+
+def test_small_files_are_grouped_in_order():
+    sizes = array('q', [10, 500, 20, 30, 1000, 5, 100, 60])
+    bundles, single = group_small_files(array('I', [7, 0, 1, 2, 3, 4, 5, 6]), sizes, 100, 50)
+    # files of at least the threshold are sent on their own, and a small file larger than a bundle gets its own
+    assert list(single) == [1, 4, 6]
+    assert {name: list(positions) for name, positions in bundles.items()} == \
+        {BUNDLE_NAME.format(1): [7], BUNDLE_NAME.format(2): [0, 2], BUNDLE_NAME.format(3): [3, 5]}
+
+
+def test_a_zero_threshold_disables_bundling():
+    bundles, single = group_small_files(array('I', [2, 0, 1]), array('q', [1, 2, 3]), 0, 50)
+    assert (bundles, list(single)) == ({}, [2, 0, 1])
@@ -0,0 +1,48 @@
+import os
+from types import SimpleNamespace
+
+import m2mtool.cache
+from m2mtool.cache import DiskCache
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    cache = DiskCache('test', 60, str(tmp_path))
+    now = 1000000.0
+    monkeypatch.setattr(m2mtool.cache, 'time', SimpleNamespace(time=lambda: now))
+    cache.put({'value': 1}, 'key')
+    assert cache.get('key') == {'value': 1}
+    now += 59
+    assert cache.get('key') == {'value': 1}
+    now += 2
+    assert cache.get('key') is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    # each entry takes about 53 bytes on disk, so the cache holds three of them
+    cache = DiskCache('test', 60, str(tmp_path), max_size=180)
+    for number in range(3):
+        cache.put('x' * 10, str(number))
+        os.utime(cache._path((str(number),)), (number, number))
+    # reading an entry makes it the most recently used one
+    assert cache.get('0') == 'x' * 10
+    cache.put('x' * 10, '3')
+    assert [cache.get(str(number)) is not None for number in range(4)] == [True, False, True, True]
+
+
+def test_a_corrupt_entry_is_discarded(tmp_path):
+    cache = DiskCache('test', 60, str(tmp_path))
+    cache.put('value', 'key')
+    with open(cache._path(('key',)), 'w') as cache_file:
+        cache_file.write('{"stored": 1')
+    assert cache.get('key') is None
+    assert not os.path.exists(cache._path(('key',)))
+    cache.put('value', 'key')
+    assert cache.get('key') == 'value'
+
+
+def test_a_zero_ttl_disables_the_cache(tmp_path):
+    cache = DiskCache('test', 0, str(tmp_path))
+    cache.put('value', 'key')
+    assert cache.get('key') is None
+    assert os.listdir(str(tmp_path)) == []
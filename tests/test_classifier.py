@@ -0,0 +1,60 @@
+import pytest
+
+from m2mtool.classifier import FileClassifier
+from tests.conftest import write_files
+
+PNG = bytes.fromhex('89504e470d0a1a0a') + b'\0' * 100
+STAR = b'# generated\ndata_entry\n\nsave_entry_information\n_Entry.ID 1\nsave_\n'
+PDB = b'HEADER    PROTEIN\nATOM      1  N   MET A   1\n'
+
+
+@pytest.fixture(scope='module')
+def classifier() -> FileClassifier:
+    return FileClassifier.load()
+
+
+def test_files_are_recognised_by_name_then_extension(classifier):
+    assert classifier.known_type('1/fid') == 'application/x-bruker-timedomain'
+    assert classifier.known_type('2/SER') == 'application/x-bruker-timedomain'
+    assert classifier.known_type('peaks/hsqc.LIST') == 'text/x-peak-list'
+    assert classifier.known_type('shifts.str') == 'text/nmrstar'
+    # the name tier only matches whole names, and a leading dot doesn't start an extension
+    assert classifier.known_type('fid.tab') == 'text/talos'
+    assert classifier.known_type('data/.png') is None
+    assert classifier.known_type('notes.txt') is None
+
+
+def test_files_are_recognised_by_their_contents(classifier, tmp_path):
+    write_files(str(tmp_path), {'figure': PNG, 'entry': STAR, 'structure': PDB, 'notes': b'nothing to see'})
+    assert classifier.sniff(str(tmp_path / 'figure')) == 'image/png'
+    assert classifier.sniff(str(tmp_path / 'entry')) == 'text/nmrstar'
+    assert classifier.sniff(str(tmp_path / 'structure')) == 'chemical/x-pdb'
+    assert classifier.sniff(str(tmp_path / 'notes')) is None
+    assert classifier.sniff(str(tmp_path / 'missing')) is None
+
+
+def test_unknown_files_are_left_uncategorized(classifier, tmp_path):
+    files = write_files(str(tmp_path), {'1/fid': b'', 'figure': PNG, 'notes': b'nothing', 'image.png': b'not a png'})
+    assert classifier.classify(str(tmp_path), files) == {'1/fid': 'upload_category_34', 'figure': 'Image',
+                                                         'image.png': 'Image'}
+    # without reading the files, only their names are used
+    assert classifier.classify(str(tmp_path), files, sniff=False) == {'1/fid': 'upload_category_34',
+                                                                      'image.png': 'Image'}
+
+
+def test_a_type_without_a_category_is_left_uncategorized(tmp_path):
+    classifier = FileClassifier({'extensions': {'text/plain': ['.txt']}})
+    write_files(str(tmp_path), {'notes.txt': b''})
+    assert classifier.known_type('notes.txt') == 'text/plain'
+    assert classifier.classify(str(tmp_path), ['notes.txt']) == {}
+
+
+@pytest.mark.parametrize('definitions', [
+    {'categories': {'text/plain': 'upload_category_0'}},
+    {'magic': {'image/png': [{'offset': 0}]}},
+    {'magic': {'image/png': [{'hex': 'not hex'}]}},
+    {'magic': {'text/plain': [{'text': '('}]}},
+])
+def test_a_malformed_definition_is_rejected(definitions):
+    with pytest.raises(ValueError):
+        FileClassifier(definitions)
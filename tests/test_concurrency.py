@@ -0,0 +1,126 @@
+import io
+import threading
+import time
+
+import pytest
+import requests
+
+from benchmarks.upload_benchmark import STAR
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.concurrency import AdaptiveConcurrency, retry_after_seconds
+from m2mtool.control import UploadCancelled, UploadControl
+from m2mtool.telemetry import UploadTelemetry
+from m2mtool.upload import UploadPool
+from tests.conftest import write_files
+
+
+def new_deposition() -> str:
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com', nickname='test') as session:
+        return session.sid
+
+
+def upload(directory: str, files, concurrency: int, throttle_retries: int = None, backoff_factor: float = None):
+    # uploads the files with an adaptive pool, and returns the pool, its results and the telemetry
+    telemetry = UploadTelemetry()
+    with UploadPool(new_deposition(), directory, concurrency, telemetry=telemetry, adaptive=True) as pool:
+        if throttle_retries is not None:
+            pool.throttle_retries = throttle_retries
+        if backoff_factor is not None:
+            pool.controller.backoff_factor = backoff_factor
+        results = list(pool.upload(files))
+    return pool, results, telemetry
+
+
+def test_the_limit_rises_until_the_server_pushes_back():
+    controller = AdaptiveConcurrency(2, 8, cooldown=0)
+    for _ in range(40):
+        controller.acquire()
+        controller.release(0.01, 100, 200)
+    assert controller.limit == 8
+
+    controller.acquire()
+    controller.release(0.01, 100, 429, retry_after=0)
+    assert (controller.limit, controller.decreases) == (4, 1)
+    controller.acquire()
+    controller.release(0.01, 100, 503, retry_after=0)
+    assert (controller.limit, controller.decreases) == (2, 2)
+
+
+def test_decreases_are_spaced_by_the_cooldown():
+    controller = AdaptiveConcurrency(8, 8, cooldown=60)
+    for _ in range(3):
+        controller.acquire()
+        controller.release(0.01, 100, 429, retry_after=0)
+    assert (controller.limit, controller.decreases) == (4, 1)
+
+
+def test_requests_wait_for_retry_after():
+    controller = AdaptiveConcurrency(4, 4)
+    controller.acquire()
+    controller.release(0.01, 100, 429, retry_after=0.5)
+    start = time.monotonic()
+    controller.acquire()
+    assert time.monotonic() - start >= 0.45
+
+
+def test_cancelling_stops_the_wait_for_retry_after():
+    controller = AdaptiveConcurrency(4, 4)
+    controller.acquire()
+    controller.release(0.01, 100, 429, retry_after=30)
+    control = UploadControl()
+    threading.Timer(0.2, control.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(UploadCancelled):
+        controller.acquire(control)
+    assert time.monotonic() - start < 1
+    assert controller.in_flight == 0
+
+
+def test_retry_after_values():
+    assert retry_after_seconds('3') == 3
+    assert retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert retry_after_seconds('soon') is None
+    assert retry_after_seconds(None) is None
+
+
+def test_an_overloaded_server_lowers_the_limit(mock_server, settings, tmp_path):
+    server = mock_server(latency=0.02, capacity=2, retry_after=0)
+    settings['max_upload_concurrency'] = 8
+    files = write_files(str(tmp_path), {f'file{number:03d}.dat': b'x' * 1000 for number in range(80)})
+    # (the server doesn't ask for a pause, so a file may be turned away many times before the limit is down)
+    pool, results, telemetry = upload(str(tmp_path), files, concurrency=8, throttle_retries=100)
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert all(error is None for _, _, error in results)
+    assert stats['uploads'] == 80
+    assert stats['over_capacity'] > 0
+    assert pool.controller.decreases > 0
+    assert pool.controller.limit < 8
+    summary = telemetry.summary()
+    assert summary['concurrency'] == {'final_limit': int(pool.controller.limit),
+                                      'decreases': pool.controller.decreases}
+    # every rejected attempt was retried by the pool, none by urllib3
+    assert summary['retries'] == stats['over_capacity']
+
+
+def test_throttled_uploads_wait_for_retry_after(mock_server, tmp_path):
+    server = mock_server(throttle_rate=1, retry_after=1)
+    files = write_files(str(tmp_path), {'a.dat': b'a'})
+    start = time.monotonic()
+    _, results, telemetry = upload(str(tmp_path), files, concurrency=1, throttle_retries=1)
+
+    assert time.monotonic() - start >= 1
+    assert requests.get(f'{server.url}/_stats').json()['throttles_injected'] == 2
+    assert results[0][2].response.status_code == 429
+
+
+def test_throttle_retries_run_out(mock_server, tmp_path):
+    server = mock_server(error_rate=1)
+    files = write_files(str(tmp_path), {'a.dat': b'a', 'b.dat': b'b'})
+    # a 503 without Retry-After is backed off exponentially
+    _, results, telemetry = upload(str(tmp_path), files, concurrency=2, throttle_retries=2, backoff_factor=0.01)
+
+    assert [error.response.status_code for _, _, error in results] == [503, 503]
+    # 503s are retried by the pool (twice each), not by urllib3, which would retry every attempt three times
+    assert requests.get(f'{server.url}/_stats').json()['errors_injected'] == 6
+    assert [entry['retries'] for entry in telemetry.uploads] == [2, 2]
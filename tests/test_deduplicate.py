@@ -0,0 +1,86 @@
+import io
+import os
+
+import pytest
+import requests
+
+from benchmarks.upload_benchmark import BODIES, STAR
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.deposit import Deposition
+from m2mtool.hashing import file_digest
+from m2mtool.manifest import SESSION_FILE_NAME, UPLOADED, UploadManifest
+from tests.conftest import write_files
+
+# Three files with the same contents, and two with contents of their own
+CONTENTS = {'a/copy1.dat': b'same' * 1000, 'a/copy2.dat': b'same' * 1000, 'b/copy3.dat': b'same' * 1000,
+            'b/other.dat': b'other' * 1000, 'c.str': b'data_test\n'}
+
+
+def deposit(url: str, directory: str, retry_statuses=None) -> UploadManifest:
+    # deposits the files of CONTENTS from directory to the mock server, and returns the manifest
+    files = write_files(directory, CONTENTS)
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com', nickname='test',
+                        retry_statuses=retry_statuses) as bmrbdep_session:
+        manifest = UploadManifest(os.path.join(directory, SESSION_FILE_NAME), bmrbdep_session.sid, nickname='test')
+        manifest.add_files(files)
+        deposition = Deposition(directory, 'test', files, manifest.session_file, manifest)
+        deposition.upload_files(bmrbdep_session)
+    assert not deposition.error_occurred
+    return manifest
+
+
+def test_duplicates_are_sent_once(mock_server, settings, tmp_path):
+    server = mock_server(blobs=True)
+    settings['deduplicate_uploads'] = True
+    manifest = deposit(server.url, str(tmp_path))
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert stats['uploads'] == 3
+    assert stats['links'] == 2
+    assert manifest.complete
+    assert all(record['state'] == UPLOADED and record['digest'] for _, record in manifest.records())
+
+
+def test_everything_is_sent_without_blob_support(mock_server, settings, tmp_path):
+    server = mock_server(blobs=False)
+    settings['deduplicate_uploads'] = True
+    deposit(server.url, str(tmp_path))
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert (stats['uploads'], stats['links']) == (5, 0)
+
+
+def test_blob_query_errors_do_not_fail_the_deposition(mock_server, settings, tmp_path):
+    server = mock_server(blobs=True, blob_status=500)
+    settings['deduplicate_uploads'] = True
+    # without retries, so the test doesn't wait for the backoff
+    manifest = deposit(server.url, str(tmp_path), retry_statuses=[])
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert (stats['uploads'], stats['links']) == (5, 0)
+    assert manifest.complete
+
+
+@pytest.mark.parametrize('body', sorted(BODIES))
+def test_uploads_record_digests_without_deduplication(mock_server, settings, tmp_path, body):
+    server = mock_server(blobs=True)
+    settings['deduplicate_uploads'] = False
+    settings['zero_copy_uploads'] = BODIES[body]
+    manifest = deposit(server.url, str(tmp_path))
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert (stats['uploads'], stats['links']) == (5, 0)
+    # the digests are worked out as the files are sent, which a sync compares touched files with
+    assert {file_name: record['digest'] for file_name, record in manifest.records()} == \
+        {file_name: file_digest(str(tmp_path / file_name)) for file_name in CONTENTS}
+
+
+def test_bundled_files_record_digests(mock_server, settings, tmp_path):
+    server = mock_server()
+    settings.update({'deduplicate_uploads': False, 'bundle_threshold': 1024 * 1024})
+    manifest = deposit(server.url, str(tmp_path))
+
+    stats = requests.get(f'{server.url}/_stats').json()
+    assert stats['uploads'] == 1
+    assert {file_name: record['digest'] for file_name, record in manifest.records()} == \
+        {file_name: file_digest(str(tmp_path / file_name)) for file_name in CONTENTS}
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from m2mtool.hashing import file_digest, hash_files, hash_files_async
+from tests.conftest import write_files
+
+CONTENTS = {f'file{number}.dat': os.urandom(number * 1000) for number in range(20)}
+
+
+def test_digests(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    assert hash_files(str(tmp_path), files, processes=2) == {file_name: hashlib.sha256(data).hexdigest()
+                                                             for file_name, data in CONTENTS.items()}
+
+
+def test_an_unreadable_file_fails_only_itself(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    files.insert(10, 'missing.dat')
+    futures = hash_files_async(str(tmp_path), files, processes=2)
+    futures.join()
+    with pytest.raises(FileNotFoundError):
+        futures['missing.dat'].result()
+    for file_name in files[:10] + files[11:]:
+        assert futures[file_name].result() == file_digest(str(tmp_path / file_name))
+
+
+def test_known_digests_are_not_hashed_again(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    futures = hash_files_async(str(tmp_path), files + ['missing.dat'], processes=2, known={'missing.dat': 'abc'})
+    futures.join()
+    assert futures['missing.dat'].result() == 'abc'
+    assert futures['file3.dat'].result() == file_digest(str(tmp_path / 'file3.dat'))
+
+
+def test_a_failing_pool_fails_every_file(tmp_path, monkeypatch):
+    def submit(*args, **kwargs):
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+    monkeypatch.setattr(ProcessPoolExecutor, 'submit', submit)
+    futures = hash_files_async(str(tmp_path), write_files(str(tmp_path), CONTENTS))
+    for future in futures.values():
+        with pytest.raises(RuntimeError):
+            future.result(timeout=10)
+    futures.join()
+
+
+def test_the_process_exits_after_hashing(tmp_path):
+    files = write_files(str(tmp_path), CONTENTS)
+    script = ('import sys\n'
+              'from m2mtool.hashing import hash_files_async\n'
+              f'futures = hash_files_async({str(tmp_path)!r}, {files!r}, processes=2)\n'
+              'futures[sys.argv[1]].result()\n'
+              'futures.cancel()\n')
+    result = subprocess.run([sys.executable, '-c', script, files[0]], timeout=60,
+                            env=dict(os.environ, PYTHONPATH=os.getcwd()))
+    assert result.returncode == 0
@@ -0,0 +1,159 @@
+import json
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import m2mtool.hashing
+import m2mtool.manifest
+from m2mtool.hashing import DigestFutures, file_digest
+from m2mtool.manifest import PENDING, REMOVED, UPLOADED, UploadManifest
+from m2mtool.selection import FileSelection
+from tests.conftest import write_files
+
+CONTENTS = {f'data/file{number}.dat': bytes([number]) * 1000 for number in range(10)}
+
+
+def uploaded_manifest(directory: str) -> UploadManifest:
+    """ A manifest of a deposition of CONTENTS, all of them uploaded. """
+
+    manifest = UploadManifest(os.path.join(directory, '.bmrbdep_session'), 'sid', nickname='test')
+    manifest.add_files(write_files(directory, CONTENTS))
+    for file_name in CONTENTS:
+        manifest.mark_uploaded(file_name, file_digest(os.path.join(directory, file_name)))
+    return manifest
+
+
+def touch(directory: str, file_name: str) -> None:
+    path = os.path.join(directory, file_name)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+def test_sync_uploads_changed_files_and_removes_deleted_ones(tmp_path):
+    directory = str(tmp_path)
+    manifest = uploaded_manifest(directory)
+    touch(directory, 'data/file1.dat')
+    write_files(directory, {'data/file2.dat': b'x' * 1000, 'data/new.dat': b'new'})
+    touch(directory, 'data/file2.dat')
+    os.remove(os.path.join(directory, 'data/file3.dat'))
+
+    changed = manifest.sync(FileSelection.from_paths(name for name in list(CONTENTS) + ['data/new.dat']
+                                                     if name != 'data/file3.dat'))
+    assert sorted(changed) == ['data/file2.dat', 'data/new.dat']
+    assert manifest.record('data/file1.dat')['state'] == UPLOADED
+    assert manifest.record('data/file3.dat')['state'] == REMOVED
+    assert not manifest.complete
+    # the digest of the changed file is kept for the upload, which doesn't hash it again
+    assert manifest.digests == {'data/file2.dat': file_digest(os.path.join(directory, 'data/file2.dat'))}
+
+
+def test_an_unreadable_touched_file_is_taken_as_changed(tmp_path):
+    directory = str(tmp_path)
+    manifest = uploaded_manifest(directory)
+    for file_name in CONTENTS:
+        touch(directory, file_name)
+    # a directory in place of the file can't be read, whoever runs the tests
+    os.remove(os.path.join(directory, 'data/file2.dat'))
+    os.mkdir(os.path.join(directory, 'data/file2.dat'))
+
+    records = [(file_name, 1000, os.stat(os.path.join(directory, file_name)).st_mtime) for file_name in CONTENTS]
+    changed = manifest._changed_files(records)
+    # the files after it are still compared
+    assert list(changed) == ['data/file2.dat']
+    assert manifest.record('data/file2.dat')['state'] == PENDING
+
+
+def test_a_broken_pool_doesnt_abort_the_sync(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    manifest = uploaded_manifest(directory)
+    for file_name in CONTENTS:
+        touch(directory, file_name)
+    write_files(directory, {'data/file4.dat': b'y' * 1000})
+    touch(directory, 'data/file4.dat')
+
+    def broken(directory, files, processes=None, known=None):
+        futures = DigestFutures(files)
+        for future in futures.values():
+            future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+        return futures
+
+    monkeypatch.setattr(m2mtool.hashing, 'hash_files_async', broken)
+    changed = manifest.sync(FileSelection.from_paths(CONTENTS))
+    assert list(changed) == ['data/file4.dat']
+
+
+def test_uploads_are_journaled_and_replayed(tmp_path):
+    directory = str(tmp_path)
+    manifest = UploadManifest(os.path.join(directory, '.bmrbdep_session'), 'sid', nickname='test')
+    manifest.add_files(write_files(directory, CONTENTS))
+    manifest.save()
+    snapshot = open(manifest.session_file).read()
+
+    manifest.mark_uploaded('data/file1.dat', '1' * 64)
+    manifest.mark_uploaded('data/file2.dat', '2' * 64)
+    manifest.forget('data/file3.dat')
+    manifest.flush()
+    # recording the uploads appended them to the journal, rather than rewriting the manifest
+    assert open(manifest.session_file).read() == snapshot
+    assert len(open(manifest.journal.path).readlines()) == 3
+
+    loaded = UploadManifest.load(manifest.session_file)
+    assert dict(loaded.records()) == dict(manifest.records())
+    assert loaded.record('data/file1.dat')['state'] == UPLOADED
+    assert loaded.record('data/file3.dat') is None
+    # loading folded the journal into the snapshot
+    assert not os.path.exists(manifest.journal.path)
+    assert dict(UploadManifest.load(manifest.session_file).records()) == dict(manifest.records())
+
+
+def test_an_interrupted_journal_write_is_ignored(tmp_path):
+    directory = str(tmp_path)
+    manifest = UploadManifest(os.path.join(directory, '.bmrbdep_session'), 'sid', nickname='test')
+    manifest.add_files(write_files(directory, CONTENTS))
+    manifest.save()
+    manifest.mark_uploaded('data/file1.dat', '1' * 64)
+    manifest.flush()
+    with open(manifest.journal.path, 'a') as journal:
+        journal.write('{"file": "data/file2.dat", "si')
+
+    loaded = UploadManifest.load(manifest.session_file)
+    assert loaded.record('data/file1.dat')['state'] == UPLOADED
+    assert loaded.record('data/file2.dat')['state'] == PENDING
+
+
+def test_journal_writes_are_batched(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    manifest = UploadManifest(os.path.join(directory, '.bmrbdep_session'), 'sid', nickname='test')
+    manifest.add_files(write_files(directory, CONTENTS))
+    manifest.save()
+    syncs = []
+    monkeypatch.setattr(m2mtool.manifest.os, 'fsync', syncs.append)
+
+    for file_name in CONTENTS:
+        manifest.mark_uploaded(file_name, '0123' * 16)
+    manifest.flush()
+    assert len(syncs) == 1
+    assert len(open(manifest.journal.path).readlines()) == len(CONTENTS)
+
+
+def test_the_snapshot_is_written_a_file_per_line(tmp_path):
+    directory = str(tmp_path)
+    manifest = uploaded_manifest(directory)
+    manifest.forget('data/file9.dat')
+    manifest.save()
+    with open(manifest.session_file) as session_log:
+        assert json.loads(session_log.readline())['sid'] == 'sid'
+        assert len(session_log.readlines()) == len(manifest) == 9
+    assert dict(UploadManifest.load(manifest.session_file).records()) == dict(manifest.records())
+
+
+def test_a_manifest_saved_in_one_object_is_loaded(tmp_path):
+    directory = str(tmp_path)
+    write_files(directory, CONTENTS)
+    record = {'size': 1000, 'mtime': 1.5, 'digest': 'ab' * 32, 'state': UPLOADED}
+    with open(os.path.join(directory, '.bmrbdep_session'), 'w') as session_log:
+        json.dump({'sid': 'sid', 'ctime': 1.0, 'nickname': 'test', 'complete': False,
+                   'files': {'data/file1.dat': record}}, session_log)
+
+    manifest = UploadManifest.load(os.path.join(directory, '.bmrbdep_session'))
+    assert (manifest.sid, manifest.complete, len(manifest)) == ('sid', False, 1)
+    assert manifest.record('data/file1.dat') == record
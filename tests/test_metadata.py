@@ -0,0 +1,81 @@
+import pytest
+
+from m2mtool.metadata import EMAIL_TAG, DepositionMetadata, find_tags
+
+ENTRY = '''data_test
+
+# a comment, with _Entry.Title 'not a value'
+save_entry_information
+   _Entry.Sf_category   entry_information
+   _Entry.ID            .
+   _Entry.Title
+;
+A title; over
+two lines # not a comment
+;
+   _Entry.Details       'it''s here # not a comment'
+   _Entry.Version_type  "double quoted value"
+   _Entry.Type          ?
+
+   loop_
+      _Contact_person.ID
+      _Contact_person.Email_address
+      _Contact_person.Name_last
+
+      1 .                 'Van Dyke'
+      2 someone@bmrb.io   Smith   # the first address given
+   stop_
+save_
+
+save_citation
+   _Citation.Sf_category   citations
+   _Citation.Title         "Second saveframe"
+   _Citation.Status        '.'
+save_
+'''
+
+# The first value pynmrstar 3.1.1 (which m2mtool used to parse the metadata with) gives each tag of ENTRY that
+# has one which isn't null
+EXPECTED = {
+    '_Entry.Sf_category': 'entry_information',
+    '_Entry.Title': 'A title; over\ntwo lines # not a comment\n',
+    '_Entry.Details': "it''s here # not a comment",
+    '_Entry.Version_type': 'double quoted value',
+    '_Contact_person.ID': '1',
+    '_Contact_person.Email_address': 'someone@bmrb.io',
+    '_Contact_person.Name_last': 'Van Dyke',
+    '_Citation.Title': 'Second saveframe',
+    '_Citation.Status': '.',
+}
+
+
+def test_the_values_of_saveframe_and_loop_tags():
+    assert find_tags(ENTRY, EXPECTED) == EXPECTED
+
+
+def test_null_and_missing_values():
+    # a null value is skipped for a later row's, and a quoted '.' is a value rather than a null
+    assert find_tags(ENTRY, ['_Entry.ID', '_Entry.Type', '_Missing.Tag']) == \
+        {'_Entry.ID': None, '_Entry.Type': None, '_Missing.Tag': None}
+    assert find_tags(ENTRY, ['_Citation.Status']) == {'_Citation.Status': '.'}
+
+
+def test_tags_are_matched_case_insensitively():
+    assert find_tags(ENTRY, ['_contact_person.name_last']) == {'_contact_person.name_last': 'Van Dyke'}
+
+
+def test_the_same_values_as_pynmrstar():
+    pynmrstar = pytest.importorskip('pynmrstar')
+    entry = pynmrstar.Entry.from_string(ENTRY)
+    for tag, value in EXPECTED.items():
+        values = [found for found in entry.get_tag(tag) if found not in ('.', '?')] or entry.get_tag(tag)
+        assert values[0] == value, tag
+
+
+def test_the_contact_email():
+    metadata = DepositionMetadata(ENTRY)
+    assert metadata.user_email == 'someone@bmrb.io'
+    assert metadata.nmrstar_file.read() == ENTRY.encode()
+    with pytest.raises(ValueError):
+        DepositionMetadata(ENTRY.replace('someone@bmrb.io', '?')).user_email
+    assert EMAIL_TAG in metadata.tags
@@ -0,0 +1,37 @@
+import threading
+import time
+
+import pytest
+
+from m2mtool.control import UploadCancelled, UploadControl
+from m2mtool.ratelimit import TokenBucket, parse_rate
+
+
+def test_rates():
+    assert parse_rate('500K') == 500 * 1024
+    assert parse_rate('2.5M/s') == 2.5 * 1024 ** 2
+    assert parse_rate('0') is None
+    assert parse_rate('unlimited') is None
+    with pytest.raises(ValueError):
+        parse_rate('fast')
+
+
+def test_the_rate_is_kept():
+    bucket = TokenBucket(1024 * 1024)
+    start = time.monotonic()
+    for _ in range(12):
+        bucket.consume(64 * 1024)
+    # half a second of sending is saved up at first
+    assert 0.1 <= time.monotonic() - start < 1
+
+
+def test_cancelling_stops_the_wait_for_a_large_chunk():
+    # paying off a 1 MiB chunk at 100 KiB/s would take ten seconds
+    bucket = TokenBucket(100 * 1024)
+    bucket.consume(1024 * 1024)
+    control = UploadControl()
+    threading.Timer(0.2, control.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(UploadCancelled):
+        bucket.consume(64 * 1024, control)
+    assert time.monotonic() - start < 1
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import m2mtool.deposit
+from m2mtool.deposit import Deposition
+from m2mtool.manifest import SESSION_FILE_NAME
+from m2mtool.schedule import UploadScheduler, get_scheduler
+from m2mtool.selection import FileSelection
+from m2mtool.upload import max_concurrency
+from tests.conftest import write_files
+
+
+def test_a_policy_must_implement_order():
+    with pytest.raises(TypeError):
+        UploadScheduler()
+
+    class Unordered(UploadScheduler):
+        name = 'unordered'
+
+    with pytest.raises(TypeError):
+        Unordered()
+
+
+def test_the_most_uploads_in_flight(settings):
+    settings.update({'upload_concurrency': 2, 'max_upload_concurrency': 8, 'adaptive_concurrency': False})
+    assert max_concurrency() == 2
+    settings['adaptive_concurrency'] = True
+    assert max_concurrency() == 8
+    assert max_concurrency(12) == 12
+    assert max_concurrency(2, adaptive=False) == 2
+
+
+def test_the_schedule_plans_for_the_adaptive_maximum(settings, tmp_path, monkeypatch):
+    settings.update({'upload_concurrency': 2, 'max_upload_concurrency': 8, 'adaptive_concurrency': True,
+                     'classify_files': False, 'bundle_threshold': 0})
+    schedulers = []
+
+    def scheduler(name, concurrency):
+        schedulers.append(get_scheduler(name, concurrency))
+        return schedulers[-1]
+
+    monkeypatch.setattr(m2mtool.deposit, 'get_scheduler', scheduler)
+    files = write_files(str(tmp_path), {f'file{number}.dat': b'x' * number for number in range(4)})
+    deposition = Deposition(str(tmp_path), 'test', FileSelection.from_paths(files),
+                            os.path.join(str(tmp_path), SESSION_FILE_NAME))
+    _, _, single = deposition.plan_uploads()
+    assert schedulers[0].concurrency == 8
+    assert sorted(single) == sorted(files)
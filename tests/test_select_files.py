@@ -0,0 +1,35 @@
+from array import array
+
+from m2mtool.cli import select_files
+from m2mtool.selection import FileSelection, SelectionView
+from tests.conftest import write_files
+
+
+def test_only_the_session_files_are_left_out(tmp_path):
+    write_files(str(tmp_path), {'.bmrbdep_session': b'{}', '.bmrbdep_session.tmp': b'{}',
+                                '.bmrbdep_session.telemetry.json': b'{}', '.bmrbdep_session_notes': b'notes',
+                                '.bmrbdep_session_old/journal': b'{}', 'data/fid': b'fid'})
+    assert sorted(select_files(str(tmp_path))) == ['.bmrbdep_session_notes', '.bmrbdep_session_old/journal',
+                                                   'data/fid']
+
+
+def test_patterns(tmp_path):
+    write_files(str(tmp_path), {'a/fid': b'', 'a/ser': b'', 'b/peaks.list': b''})
+    assert sorted(select_files(str(tmp_path), include=['a/*'], exclude=['*/ser'])) == ['a/fid']
+
+
+def test_files_are_found_by_position():
+    selection = FileSelection.from_paths(['a/fid', 'a/ser', 'b/peaks.list'])
+    assert [selection.position(path) for path in ('a/fid', 'a/ser', 'b/peaks.list', 'b/fid')] == [0, 1, 2, -1]
+    # the index is kept up to date as files are added, past the size it was built for
+    for number in range(100):
+        selection.add(f'c/file{number}')
+    assert selection.position('c/file99') == 102
+    assert selection.position('a/ser') == 1
+
+
+def test_a_view_builds_the_paths_of_its_positions():
+    selection = FileSelection.from_paths(['a/fid', 'a/ser', 'b/peaks.list'])
+    view = SelectionView(selection, array('I', [2, 0]))
+    assert list(view) == ['b/peaks.list', 'a/fid']
+    assert (len(view), view[-1], list(view[1:])) == (2, 'a/fid', ['a/fid'])
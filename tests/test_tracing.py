@@ -0,0 +1,32 @@
+import io
+import os
+import pstats
+
+from benchmarks.upload_benchmark import STAR
+from m2mtool import tracing
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.deposit import Deposition
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from tests.conftest import write_files
+
+
+def test_the_profile_covers_the_upload_threads(mock_server, tmp_path, monkeypatch):
+    mock_server()
+    profile_file = str(tmp_path / 'profile.out')
+    monkeypatch.setattr(tracing, '_profile_file', profile_file)
+    directory = str(tmp_path / 'data')
+    files = write_files(directory, {f'file{number}.dat': b'x' * 1000 for number in range(4)})
+
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com',
+                        nickname='test') as bmrbdep_session:
+        manifest = UploadManifest(os.path.join(directory, SESSION_FILE_NAME), bmrbdep_session.sid)
+        manifest.add_files(files)
+        deposition = Deposition(directory, 'test', files, manifest.session_file, manifest)
+        with tracing.profiled():
+            deposition.upload_files(bmrbdep_session)
+
+    assert not deposition.error_occurred
+    # the files are uploaded by the workers of the upload pool, rather than the thread which was profiled
+    functions = {(os.path.basename(file_name), function) for file_name, _, function in pstats.Stats(profile_file).stats}
+    assert ('upload.py', '_upload') in functions
+    assert ('bmrbdep.py', 'upload_file') in functions
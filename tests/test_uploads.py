@@ -0,0 +1,73 @@
+import io
+import os
+import socket
+import threading
+
+import pytest
+import requests
+
+from benchmarks.mock_bmrbdep import PartDigest
+from benchmarks.upload_benchmark import BODIES, STAR
+from m2mtool.bmrbdep import BMRBDepSession
+from m2mtool.deposit import Deposition
+from m2mtool.hashing import file_digest
+from m2mtool.manifest import SESSION_FILE_NAME, UploadManifest
+from m2mtool.multipart import MultipartFileEncoder, ZeroCopyFileEncoder
+from m2mtool.ratelimit import TokenBucket
+from tests.conftest import write_files
+
+# Sizes around the block sizes of the encoders and the mock server, and an empty file
+CONTENTS = {f'sizes/{size}.dat': os.urandom(size) for size in (0, 1, 65535, 65537, 1024 * 1024 + 7, 3000001)}
+
+
+@pytest.mark.parametrize('body', sorted(BODIES))
+def test_the_server_receives_the_file_contents(mock_server, settings, tmp_path, body):
+    server = mock_server()
+    settings['zero_copy_uploads'] = BODIES[body]
+    files = write_files(str(tmp_path), CONTENTS)
+
+    with BMRBDepSession(nmrstar_file=io.BytesIO(STAR), user_email='test@example.com',
+                        nickname='test') as bmrbdep_session:
+        manifest = UploadManifest(os.path.join(str(tmp_path), SESSION_FILE_NAME), bmrbdep_session.sid)
+        manifest.add_files(files)
+        deposition = Deposition(str(tmp_path), 'test', files, manifest.session_file, manifest)
+        deposition.upload_files(bmrbdep_session)
+
+    assert not deposition.error_occurred
+    received = requests.get(f'{server.url}/_stats').json()['files']
+    for file_name in files:
+        assert received[file_name] == {'bytes': len(CONTENTS[file_name]),
+                                       'sha256': file_digest(str(tmp_path / file_name))}
+
+
+def test_part_digest_is_independent_of_how_the_body_arrives(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(os.urandom(200000))
+    with MultipartFileEncoder('file', 'data.bin', str(path), fields={'category': 'x'}) as encoder:
+        body = b''.join(encoder)
+
+    for block_size in (1, 7, 4096, len(body)):
+        parts = PartDigest(encoder.boundary)
+        for start in range(0, len(body), block_size):
+            parts.feed(body[start:start + block_size])
+        assert parts.files == {'data.bin': {'bytes': 200000, 'sha256': file_digest(str(path))}}
+
+
+def test_rate_limited_chunks_fit_the_bucket(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(os.urandom(256 * 1024))
+    rate_limiter = TokenBucket(256 * 1024)
+    chunks = []
+    sender, receiver = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(iter(lambda: receiver.recv(65536), b'')))
+    reader.start()
+    with sender, receiver:
+        with ZeroCopyFileEncoder('file', 'data.bin', str(path), callback=chunks.append,
+                                 rate_limiter=rate_limiter) as encoder:
+            encoder.send_to(sender)
+        sender.shutdown(socket.SHUT_WR)
+        reader.join()
+    assert sum(chunks) == 256 * 1024
+    assert max(chunks) <= rate_limiter.burst
+    assert len(b''.join(received)) == encoder.len